@@ -1,8 +1,11 @@
 from datetime import datetime, timedelta
 
 import sqlalchemy as sq
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by, insert
 from sqlalchemy.orm import sessionmaker
 
+import metrics
+from Database.migrations import upgrade
 from Database.models import create_table, User, UserOffer, Photo, Offer
 from Database.postgres_config import SQLSYS, USER, PASSWORD, HOST, PORT, DATABASE
 
@@ -15,16 +18,26 @@ db_name = DATABASE
 
 DSN = f'{SQLsystem}://{login}:{password}@{host}:{port}/{db_name}'
 engine = sq.create_engine(DSN)
+PHOTO_SET_TTL = timedelta(days=7)   # the photo sets of the offers fresher than this are not crawled again
 Session = sessionmaker(bind=engine)
 
 
 def create_tables():
+    """
+    Creates the tables missing in the database and upgrades the existing ones in place
+    by applying the pending migrations.
+    """
     create_table(engine)
+    upgrade(engine)
     
 
-def add_user(user_id: int, first_name: str, last_name: str, sex: int, bdate: str, city: int, interest: str):
+@metrics.timed('db.add_user')
+def add_user(user_id: int, first_name: str, last_name: str, sex: int, bdate: str, city: int, interest: str,
+             interest_tokens: list = None):
     """
         Function adds a user to the database.
+    In case the user is already there, the interests and their tokens are replaced, if the interests have changed
+    or the tokens are missing.
     :param user_id: id user
     :param first_name: first name user
     :param last_name: last name user
@@ -32,18 +45,127 @@ def add_user(user_id: int, first_name: str, last_name: str, sex: int, bdate: str
     :param bdate: date of birth
     :param city: city user
     :param interest: user's interests
+    :param interest_tokens: user's interests analysed by transformer.sort_interests
+    """
+    statement = insert(User).values(user_id=user_id, first_name=first_name, last_name=last_name, sex=sex,
+                                    bdate=bdate, city=city, interest=interest, interest_tokens=interest_tokens)
+    statement = statement.on_conflict_do_update(index_elements=['user_id'],
+                                                set_={'interest': statement.excluded.interest,
+                                                      'interest_tokens': statement.excluded.interest_tokens},
+                                                where=sq.or_(User.interest_tokens.is_(None),
+                                                             User.interest.is_distinct_from(
+                                                                 statement.excluded.interest)))
+    with Session.begin() as session:
+        session.execute(statement)
+
+
+@metrics.timed('db.get_interests')
+def get_interests(user_id):
+    """
+    :return: (interests, interest tokens) of the user saved to the database, the tokens may be None
+         OR: None, if the user is not there
     """
     with Session() as session:
-        user_find = session.query(User.user_id).all()
-        if user_id not in [user[0] for user in user_find]:
-            user = User(user_id=user_id, first_name=first_name, last_name=last_name, sex=sex, bdate=bdate, city=city, interest=interest)
-            session.add(user)
-            session.commit()
+        return session.query(User.interest, User.interest_tokens).filter(User.user_id == user_id).first()
+
+
+@metrics.timed('db.get_untokenized_offers')
+def get_untokenized_offers(limit):
+    """
+    :return: [(offer_id, interests), ...] - up to "limit" offers, the interests of which haven't been analysed
+             (the ones saved before the interest tokens were introduced)
+    """
+    with Session() as session:
+        return session.query(Offer.offer_id, Offer.interest). \
+            filter(Offer.interest_tokens.is_(None)). \
+            order_by(Offer.offer_id). \
+            limit(limit).all()
+
+
+@metrics.timed('db.set_interest_tokens')
+def set_interest_tokens(tokens):
+    """
+    Function saves the analysed interests of several offers with a single executemany statement.
+    :param tokens: {offer_id: [str, ...]}
+    """
+    statement = sq.update(Offer.__table__). \
+        where(Offer.__table__.c.offer_id == sq.bindparam('key')). \
+        values(interest_tokens=sq.bindparam('tokens'))
+    with Session.begin() as session:
+        session.execute(statement, [{'key': offer_id, 'tokens': value} for offer_id, value in tokens.items()])
+
+
+@metrics.timed('db.add_offers')
+def add_offers(user_id, offers):
+    """
+        Function saves a batch of offers along with their photos and links to the user.
+    All the records are written by set-based "INSERT ... ON CONFLICT" statements within a single transaction.
+    The offers and the links that are already present in the database are skipped, the photo sets of the offers
+    replace the ones on file (see bulk_write).
+    :param user_id: id user the offers are linked to. No links are made if None
+    :param offers: [{'offer_id': int,
+                     'first_name': str,
+                     'last_name': str,
+                     'sex': int,
+                     'bdate': datetime.date,
+                     'city': int,
+                     'interest': str,
+                     'interest_tokens': [str, ...],
+                     'photos': [str, ...] - the most liked first}, ...]
+    """
+    offer_rows = {}
+    photo_rows = {}
+    for offer in offers:
+        offer_rows[offer['offer_id']] = {'offer_id': offer['offer_id'],
+                                         'first_name': offer['first_name'],
+                                         'last_name': offer['last_name'],
+                                         'sex': offer['sex'],
+                                         'bdate': offer['bdate'],
+                                         'city': offer['city'],
+                                         'interest': offer.get('interest'),
+                                         'interest_tokens': offer.get('interest_tokens')}
+        for position, url in enumerate(offer.get('photos', [])):
+            photo_rows.setdefault(url, {'offer_id': offer['offer_id'], 'photo_url': url, 'position': position})
+    link_rows = [] if user_id is None else \
+        [{'user_id': user_id, 'offer_id': offer_id, 'black_list': 0, 'favorite_list': 0} for offer_id in offer_rows]
+    bulk_write(list(offer_rows.values()), link_rows, list(photo_rows.values()))
+
+
+def bulk_write(offer_rows=(), link_rows=(), photo_rows=()):
+    """
+        Function inserts the rows to the "offer", "user_offer" and "photo" tables within a single transaction,
+    skipping the ones that are already present.
+    The photo rows replace the photo sets of their offers: the photos of the offers missing in the rows are removed,
+    the positions of the photos present are updated and the refresh time of the photo sets that have expired
+    (PHOTO_SET_TTL) is renewed.
+    :param offer_rows: [{column: value, ...}, ...] for the Offer table
+    :param link_rows: [{column: value, ...}, ...] for the UserOffer table
+    :param photo_rows: [{column: value, ...}, ...] for the Photo table
+    """
+    with Session.begin() as session:
+        if offer_rows:
+            session.execute(insert(Offer).on_conflict_do_nothing(index_elements=['offer_id']), offer_rows)
+        if link_rows:
+            session.execute(insert(UserOffer).
+                            on_conflict_do_nothing(index_elements=['user_id', 'offer_id']), link_rows)
+        if photo_rows:
+            session.query(Photo). \
+                filter(Photo.offer_id.in_({row['offer_id'] for row in photo_rows})). \
+                filter(Photo.photo_url.notin_([row['photo_url'] for row in photo_rows])). \
+                delete(synchronize_session=False)
+            statement = insert(Photo)
+            expired = Photo.refreshed_at < sq.func.now() - PHOTO_SET_TTL
+            session.execute(statement.
+                            on_conflict_do_update(index_elements=['photo_url'],
+                                                  set_={'position': statement.excluded.position,
+                                                        'refreshed_at': sq.case((expired, sq.func.now()),
+                                                                                else_=Photo.refreshed_at)}),
+                            photo_rows)
 
 
 def add_offer(user_id: int, offer_id: int, first_name: str, last_name: str, sex: int, bdate: datetime.date, city: int, interest: str):
     """
-        Function adds an offer to the database.
+        Function adds an offer to the database. A thin wrapper over "add_offers".
     :param user_id: id user
     :param offer_id: id offer
     :param first_name: first name of offer
@@ -52,19 +174,13 @@ def add_offer(user_id: int, offer_id: int, first_name: str, last_name: str, sex:
     :param bdate: birthdate
     :param city: city offer
     """
-    with Session() as session:
-        offer_find = session.query(Offer.offer_id).all()
-        if offer_id not in [offer[0] for offer in offer_find]:
-            offer = Offer(offer_id=offer_id, first_name=first_name, last_name=last_name, sex=sex, bdate=bdate,
-                          city=city)
-            session.add(offer)
-        user_offer_find = session.query(UserOffer.user_offer_id). \
-            filter(UserOffer.user_id == user_id). \
-            filter(UserOffer.offer_id == offer_id).all()
-        if len(user_offer_find) == 0:
-            user_offer = UserOffer(user_id=user_id, offer_id=offer_id, black_list=0, favorite_list=0)
-            session.add(user_offer)
-        session.commit()
+    add_offers(user_id, [{'offer_id': offer_id,
+                          'first_name': first_name,
+                          'last_name': last_name,
+                          'sex': sex,
+                          'bdate': bdate,
+                          'city': city,
+                          'interest': interest}])
 
 
 def remove_records(offer_id):
@@ -72,11 +188,92 @@ def remove_records(offer_id):
     Function removes the records from the Offer table by "offer_id".
     Since cascade removal is adjusted, all relevant records from other tables are evenly removed.
     """
+    remove_offers([offer_id])
+
+
+@metrics.timed('db.remove_offers')
+def remove_offers(offer_ids):
+    """
+    Function removes the records of several offers from the Offer table with a single statement.
+    Since cascade removal is adjusted, all relevant records from other tables are evenly removed.
+    """
+    with Session.begin() as session:
+        session.query(Offer).filter(Offer.offer_id.in_(list(offer_ids))).delete()
+
+
+@metrics.timed('db.get_unchecked_offers')
+def get_unchecked_offers(max_age, limit):
+    """
+    :param max_age: timedelta, the offers verified earlier (or never) are due to be verified again
+    :param limit: the maximum number of offers returned
+    :return: [offer_id, ...] of the offers due to be verified, the ones verified the longest ago (or never) first
+    """
     with Session() as session:
-        session.query(Offer).filter(Offer.offer_id == offer_id).delete()
-        session.commit()
+        return [row[0] for row in session.query(Offer.offer_id).
+                filter(sq.or_(Offer.checked_at.is_(None), Offer.checked_at < sq.func.now() - max_age)).
+                order_by(Offer.checked_at.asc().nullsfirst()).
+                limit(limit).all()]
+
+
+@metrics.timed('db.mark_checked')
+def mark_checked(offer_ids):
+    """
+    Function records that the accounts of the offers have been verified to be active.
+    """
+    with Session.begin() as session:
+        session.query(Offer).filter(Offer.offer_id.in_(list(offer_ids))). \
+            update({'checked_at': sq.func.now()}, synchronize_session=False)
+
+
+@metrics.timed('db.evict_offers')
+def evict_offers(max_idle, limit):
+    """
+    Function evicts up to "limit" offers that haven't been shown to anyone for "max_idle" (or since they were found),
+    unless somebody has saved them to favorites or blacklisted them:
+        - the offers never shown to anyone are removed with their photos
+        - the photos of the offers shown before are removed, while the offers and their links are kept, so that
+          nobody is suggested the same account again. Such offers are not suggested until they are found
+          by a search and crawled again.
+    :param max_idle: timedelta
+    :return: the number of offers evicted
+    """
+    marked = sq.exists().where(UserOffer.offer_id == Offer.offer_id). \
+        where(sq.or_(UserOffer.black_list == 1, UserOffer.favorite_list == 1))
+    linked = sq.exists().where(UserOffer.offer_id == Offer.offer_id)
+    photographed = sq.exists().where(Photo.offer_id == Offer.offer_id)
+    with Session.begin() as session:
+        chunk = session.query(Offer.offer_id, linked). \
+            filter(sq.func.coalesce(Offer.last_shown_at, Offer.created_at) < sq.func.now() - max_idle). \
+            filter(~marked). \
+            filter(sq.or_(~linked, photographed)). \
+            limit(limit). \
+            all()
+        unlinked = [offer_id for offer_id, shown in chunk if not shown]
+        shown = [offer_id for offer_id, shown in chunk if shown]
+        if unlinked:
+            session.query(Offer).filter(Offer.offer_id.in_(unlinked)).delete(synchronize_session=False)
+        if shown:
+            session.query(Photo).filter(Photo.offer_id.in_(shown)).delete(synchronize_session=False)
+        return len(chunk)
+
+
+@metrics.timed('db.prune_photos')
+def prune_photos(limit):
+    """
+    Function removes up to "limit" photo records that are of no use:
+        - the ones the offer of which doesn't exist (left by the databases created without the foreign keys)
+        - the expired photo urls saved before the attachment identifiers were introduced,
+          that can't be sent as attachments
+    :return: the number of photo records removed
+    """
+    orphaned = ~sq.exists().where(Offer.offer_id == Photo.offer_id)
+    legacy = sq.and_(Photo.photo_url.notlike('photo%'), Photo.refreshed_at < sq.func.now() - PHOTO_SET_TTL)
+    with Session.begin() as session:
+        chunk = session.query(Photo.photo_id).filter(sq.or_(orphaned, legacy)).limit(limit).scalar_subquery()
+        return session.query(Photo).filter(Photo.photo_id.in_(chunk)).delete(synchronize_session=False)
 
 
+@metrics.timed('db.clear_favorites')
 def clear_favorites(user_id):
     """
     Function clears up the favorites list.
@@ -86,6 +283,7 @@ def clear_favorites(user_id):
         session.commit()
 
 
+@metrics.timed('db.add_black_list')
 def add_black_list(user_id: int, offer_id: int):
     """
         Function adds an offer to the black list. Offer is permanently hidden from the search.
@@ -101,6 +299,7 @@ def add_black_list(user_id: int, offer_id: int):
         session.commit()
 
 
+@metrics.timed('db.add_favorite_list')
 def add_favorite_list(user_id: str, offer_id: str):
     """
         Function adds the offer to favorites if the user wants to save the offer.
@@ -116,91 +315,236 @@ def add_favorite_list(user_id: str, offer_id: str):
         session.commit()
 
 
-def add_photo(offer_id, photo_url):
+def set_photos(offer_id, photo_url):
     """
-        Function saves links to photos of the offer in the database
+        Function replaces the photo set of the offer in the database: the photos of the offer missing
+    in "photo_url" are removed. A thin wrapper over "bulk_write".
     :param offer_id: id offer
-    :param photo_url: list photo url
+    :param photo_url: list of the attachment identifiers of the photos, the most liked first
+    """
+    bulk_write(photo_rows=[{'offer_id': offer_id, 'photo_url': url, 'position': position}
+                           for position, url in enumerate(dict.fromkeys(photo_url))])
+
+
+@metrics.timed('db.get_photo_sets')
+def get_photo_sets(offer_ids, max_age=PHOTO_SET_TTL):
+    """
+    :param offer_ids: [int, ...]
+    :param max_age: timedelta, the photo sets refreshed earlier are considered expired
+    :return: {offer_id: ['photo<owner_id>_<photo_id>', ...] - the most liked first} for the offers having photo sets
+             on file that haven't expired
     """
     with Session() as session:
-        for url in photo_url:
-            photo_find = session.query(Photo).filter(Photo.photo_url == url).all()
-            if len(photo_find) == 0:
-                photo = Photo(photo_url=url, offer_id=offer_id)
-                session.add(photo)
-            session.commit()
+        rows = session.query(Photo.offer_id, sq.func.array_agg(photo_order())). \
+            filter(Photo.offer_id.in_(offer_ids)). \
+            group_by(Photo.offer_id). \
+            having(sq.func.min(Photo.refreshed_at) > sq.func.now() - max_age). \
+            all()
+    return {offer_id: photos for offer_id, photos in rows}
+
+
+def offer_columns():
+    """
+    Columns selected by get_offer and get_favorite: the offer details followed by
+    an array of the offer's photos (attachment identifiers, the most liked first), aggregated in the same query.
+    The photo urls saved before the attachment identifiers were introduced are left out, they can't be sent.
+    Must be accompanied by an outer join of the Photo table and grouping by Offer.offer_id.
+    """
+    return (Offer.offer_id,
+            Offer.first_name,
+            Offer.last_name,
+            Offer.sex,
+            Offer.bdate,
+            Offer.city,
+            Offer.interest,
+            Offer.interest_tokens,
+            sq.func.array_agg(photo_order()).
+            filter(is_attachment()))
+
+
+def photo_order():
+    """
+    :return: the ordering of the photo urls aggregated into a photo set: the most liked first
+    """
+    return aggregate_order_by(Photo.photo_url, Photo.position, Photo.photo_id)
+
+
+def is_attachment():
+    """
+    :return: an SQL expression: the photo record holds an attachment identifier rather than a legacy url
+    """
+    return Photo.photo_url.like('photo%')
 
 
 def prepare_output(raw):
     """
     Reforms the return from get_offer function to resemble the vk api output.
-    Adds photos as a list to the collection.
+    Photos (aggregated by the query) are added as a list to the collection.
     """
     result = []
-    with Session() as session:
-        for element in raw:
-            photos = session.query(Photo.photo_url).filter(Photo.offer_id == element[0]).all()
-            result.append({'id': element[0],
-                           'first_name': element[1],
-                           'last_name': element[2],
-                           'sex': element[3],
-                           'bdate': element[4],
-                           'city': {'id': element[5]},
-                           'interests': element[6],
-                           'photos': [photo[0] for photo in photos]})
+    for element in raw:
+        result.append({'id': element[0],
+                       'first_name': element[1],
+                       'last_name': element[2],
+                       'sex': element[3],
+                       'bdate': element[4],
+                       'city': {'id': element[5]},
+                       'interests': element[6],
+                       'interest_tokens': element[7],
+                       'photos': element[8] or []})
     return result
 
 
-def get_offer(criteria, user_id):
+def birthdate_range(criteria):
+    """
+    :return: the earliest and the latest birthdate matching the age range of the criteria
+    """
+    today = datetime.utcnow()
+    return today - timedelta(days=365 * criteria['age_to']), today - timedelta(days=365 * criteria['age_from'])
+
+
+def in_segment(query, criteria):
+    """
+    Filters the query of the Offer table by the city, sex and age range of the criteria.
+    """
+    birthdate_from, birthdate_to = birthdate_range(criteria)
+    return query.filter(Offer.city == criteria['city']). \
+        filter(Offer.sex == criteria['sex']). \
+        filter(Offer.bdate.between(birthdate_from, birthdate_to))
+
+
+@metrics.timed('db.count_offers')
+def count_offers(criteria):
+    """
+    :return: the number of offers in DB matching the criteria (regardless of the users they are linked to)
+    """
+    with Session() as session:
+        return in_segment(session.query(sq.func.count(Offer.offer_id)), criteria).scalar()
+
+
+@metrics.timed('db.link_offer')
+def link_offer(user_id, offer_id):
+    """
+    Function links an offer from the shared pool to the user, once it has been shown to the user.
+    The offer may have been evicted by then (evict_offers), while waiting in the stream of the dialogue:
+    nothing is linked in this case.
+    """
+    with Session.begin() as session:
+        offer = sq.select(sq.literal(user_id), Offer.offer_id, sq.literal(0), sq.literal(0)). \
+            where(Offer.offer_id == offer_id)
+        session.execute(insert(UserOffer).
+                        from_select(['user_id', 'offer_id', 'black_list', 'favorite_list'], offer).
+                        on_conflict_do_nothing(index_elements=['user_id', 'offer_id']))
+        session.query(Offer).filter(Offer.offer_id == offer_id).update({'last_shown_at': sq.func.now()})
+
+
+@metrics.timed('db.get_linked_offers')
+def get_linked_offers(user_id):
+    """
+    :return: a set of ids of the offers linked to the user: shown, blacklisted or saved to favorites
+    """
+    with Session() as session:
+        return {offer[0] for offer in session.query(UserOffer.offer_id).filter(UserOffer.user_id == user_id).all()}
+
+
+@metrics.timed('db.get_segment_demand')
+def get_segment_demand():
+    """
+    :return: [(city, sex, bdate, number of users), ...] - users grouped by the details the search criteria are formed of
+    """
+    with Session() as session:
+        return session.query(User.city, User.sex, User.bdate, sq.func.count(User.user_id)). \
+            group_by(User.city, User.sex, User.bdate).all()
+
+
+def interest_score(interests):
+    """
+    :return: an SQL expression: the number of the offer's interest tokens found among "interests"
+    """
+    targets = sq.cast(interests, ARRAY(sq.String))
+    token = sq.func.unnest(Offer.interest_tokens).column_valued('token')
+    return sq.select(sq.func.count(sq.distinct(token))).where(token == sq.any_(targets)).scalar_subquery()
+
+
+@metrics.timed('db.get_offer')
+def get_offer(criteria, user_id, limit=None, shared=False):
     """
         Function takes a structure produced by the form_criteria func and
     :returns: a list of offers that fit the criteria.
+    Offers are requested together with their photos within a single query. The offers having no photos
+    that can be sent as attachments (the ones saved with the legacy photo urls) are skipped: they are crawled
+    again once found by a search.
+    The offers sharing the user's interests come first, ranked by the number of matching interests.
+    These are looked up through the inverted (GIN) index of interest tokens, so the best matches
+    are found without scanning the rest of the candidates.
+    :param limit: the maximum number of offers to return (None - no limit)
+    :param shared: False - the offers linked to the user (except for blacklist and favorites) are returned
+                   True - the offers are taken from the shared pool: all the offers of the segment, found for any user
+                          or prefetched, except for the ones linked to the user (already shown, blacklisted or
+                          saved to favorites). The offers are to be linked with link_offer once they are shown.
     """
 
-    today = datetime.utcnow()
-    birthdate_from = today - timedelta(days=365 * criteria['age_to'])
-    birthdate_to = today - timedelta(days=365 * criteria['age_from'])
+    interests = criteria.get('interests')
 
     with Session() as session:
-        offer = session.query(Offer.offer_id,
-                              Offer.first_name,
-                              Offer.last_name,
-                              Offer.sex,
-                              Offer.bdate,
-                              Offer.city,
-                              Offer.interest).\
-            filter(Offer.city == criteria['city']). \
-            filter(Offer.sex == criteria['sex']). \
-            filter(Offer.bdate.between(birthdate_from, birthdate_to)). \
-            join(UserOffer, UserOffer.offer_id == Offer.offer_id). \
-            join(User, User.user_id == UserOffer.user_id). \
-            filter(User.user_id == user_id). \
-            filter(UserOffer.black_list == 0). \
-            filter(UserOffer.favorite_list == 0). \
-            all()
+        def candidates():
+            query = in_segment(session.query(*offer_columns()), criteria)
+            if shared:
+                query = query.filter(~sq.exists().
+                                     where(UserOffer.user_id == user_id).
+                                     where(UserOffer.offer_id == Offer.offer_id))
+            else:
+                query = query. \
+                    join(UserOffer, UserOffer.offer_id == Offer.offer_id). \
+                    filter(UserOffer.user_id == user_id). \
+                    filter(UserOffer.black_list == 0). \
+                    filter(UserOffer.favorite_list == 0)
+            return query. \
+                outerjoin(Photo, Photo.offer_id == Offer.offer_id). \
+                group_by(Offer.offer_id). \
+                having(sq.func.count(Photo.photo_id).filter(is_attachment()) > 0)
+
+        offer = []
+        rest = candidates()
+        if interests:
+            targets = sq.cast(interests, ARRAY(sq.String))
+            offer = candidates(). \
+                filter(Offer.interest_tokens.overlap(targets)). \
+                order_by(interest_score(interests).desc(), Offer.offer_id). \
+                limit(limit). \
+                all()
+            rest = rest.filter(sq.or_(Offer.interest_tokens.is_(None),
+                                      sq.not_(Offer.interest_tokens.overlap(targets))))
+        if limit is None or len(offer) < limit:
+            offer += rest.limit(None if limit is None else limit - len(offer)).all()
         result = prepare_output(offer)
 
     return result
 
 
-def get_favorite(user_id):
+@metrics.timed('db.get_favorite')
+def get_favorite(user_id, after=0, limit=None):
     """
-        Function provides information about featured offers.
+        Function provides information about featured offers, in the order they have been saved.
+    The list is paginated with a keyset cursor: every offer has a 'cursor' value, the next page starts
+    after the 'cursor' of the last offer of the previous one. The cost of a page doesn't depend on its position.
+    :param after: the 'cursor' of the last offer of the previous page (0 for the first page)
+    :param limit: the page size (the whole list, if None)
     :returns: a list of offers from DB that have been saved to favorites
     """
     with Session() as session:
-        offer = session.query(Offer.offer_id,
-                              Offer.first_name,
-                              Offer.last_name,
-                              Offer.sex,
-                              Offer.bdate,
-                              Offer.city,
-                              Offer.interest).\
+        offer = session.query(*offer_columns(), UserOffer.user_offer_id).\
             join(UserOffer, UserOffer.offer_id == Offer.offer_id). \
-            join(User, User.user_id == UserOffer.user_id). \
-            filter(User.user_id == user_id). \
-            filter(UserOffer.favorite_list == 1).all()
+            filter(UserOffer.user_id == user_id). \
+            filter(UserOffer.favorite_list == 1). \
+            filter(UserOffer.user_offer_id > after). \
+            outerjoin(Photo, Photo.offer_id == Offer.offer_id). \
+            group_by(Offer.offer_id, UserOffer.user_offer_id). \
+            order_by(UserOffer.user_offer_id). \
+            limit(limit).all()
         result = prepare_output(offer)
+    for element, raw in zip(result, offer):
+        element['cursor'] = raw[9]
     return result
 
 
@@ -0,0 +1,128 @@
+"""
+Versioned schema migrations. Every migration is a (version, description, [SQL statement, ...]) tuple.
+Migrations are applied in place on top of the existing tables: statements must be idempotent
+(IF NOT EXISTS), since the tables of a fresh database are created by "create_table" in their final shape.
+New migrations are appended to the end of the list with the next version number.
+The tables of the dialogue state store (Database.models.StateBase) may be kept in a database of their own,
+of any dialect SQLAlchemy supports, so they have a separate list of migrations (STATE_MIGRATIONS),
+applied by "upgrade_state".
+"""
+import sqlalchemy as sq
+
+LOCK_ID = 7364501   # pg_advisory_xact_lock key, keeps concurrently started processes from migrating twice
+STATE_LOCK_ID = 7364502
+
+MIGRATIONS = [
+    (1, 'indexes and unique constraints', [
+        # merge duplicated user-offer pairs keeping blacklist and favorites marks
+        '''UPDATE user_offer SET black_list = duplicates.black_list, favorite_list = duplicates.favorite_list
+           FROM (SELECT MIN(user_offer_id) AS user_offer_id,
+                        MAX(black_list) AS black_list,
+                        MAX(favorite_list) AS favorite_list
+                 FROM user_offer GROUP BY user_id, offer_id HAVING COUNT(*) > 1) AS duplicates
+           WHERE user_offer.user_offer_id = duplicates.user_offer_id''',
+        '''DELETE FROM user_offer USING user_offer AS kept
+           WHERE user_offer.user_id = kept.user_id AND user_offer.offer_id = kept.offer_id
+           AND user_offer.user_offer_id > kept.user_offer_id''',
+        '''DELETE FROM photo USING photo AS kept
+           WHERE photo.photo_url = kept.photo_url AND photo.photo_id > kept.photo_id''',
+        'CREATE INDEX IF NOT EXISTS ix_offer_city_sex_bdate ON offer (city, sex, bdate)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_user_offer_user_id_offer_id ON user_offer (user_id, offer_id)',
+        'CREATE INDEX IF NOT EXISTS ix_user_offer_offer_id ON user_offer (offer_id)',
+        'CREATE INDEX IF NOT EXISTS ix_photo_offer_id ON photo (offer_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_photo_photo_url ON photo (photo_url)',
+    ]),
+    (2, 'normalized interest tokens', [
+        'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS interest_tokens VARCHAR[]',
+        'ALTER TABLE offer ADD COLUMN IF NOT EXISTS interest_tokens VARCHAR[]',
+    ]),
+    (3, 'inverted index of interest tokens', [
+        'CREATE INDEX IF NOT EXISTS ix_offer_interest_tokens ON offer USING gin (interest_tokens)',
+    ]),
+    (4, 'photo set refresh time', [
+        'ALTER TABLE photo ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMP NOT NULL DEFAULT now()',
+        # the photos saved before are the urls of the least liked photos rather than attachment identifiers
+        "UPDATE photo SET refreshed_at = '1970-01-01' WHERE photo_url NOT LIKE 'photo%'",
+    ]),
+    (5, 'offer retention timestamps', [
+        'ALTER TABLE offer ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT now()',
+        'ALTER TABLE offer ADD COLUMN IF NOT EXISTS checked_at TIMESTAMP',
+        'ALTER TABLE offer ADD COLUMN IF NOT EXISTS last_shown_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS ix_offer_checked_at ON offer (checked_at)',
+        'CREATE INDEX IF NOT EXISTS ix_offer_last_shown_at ON offer (last_shown_at)',
+    ]),
+    (6, 'paginated favorites', [
+        # the favorites cursor of the dialogue table is added by STATE_MIGRATIONS
+        'CREATE INDEX IF NOT EXISTS ix_user_offer_favorites ON user_offer (user_id, user_offer_id) '
+        'WHERE favorite_list = 1',
+    ]),
+    (7, 'photo order', [
+        # the photo sets saved before keep the order of the photo ids until refreshed
+        'ALTER TABLE photo ADD COLUMN IF NOT EXISTS position INTEGER NOT NULL DEFAULT 0',
+    ]),
+]
+
+
+# (version, description, [(table, column, column definition), ...]) - the columns added to the state tables
+# unless present. Expressed as columns rather than SQL statements, since "ADD COLUMN IF NOT EXISTS" is not portable.
+STATE_MIGRATIONS = [
+    (1, 'paginated favorites', [('dialogue', 'saved_cursor', 'INTEGER')]),
+]
+
+
+def current_version(connection, table='schema_version'):
+    return connection.execute(sq.text(f'SELECT COALESCE(MAX(version), 0) FROM {table}')).scalar()
+
+
+def create_version_table(connection, table='schema_version'):
+    connection.execute(sq.text(f'CREATE TABLE IF NOT EXISTS {table} ('
+                               'version INTEGER PRIMARY KEY, '
+                               'description VARCHAR NOT NULL, '
+                               'applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'))
+
+
+def record_version(connection, number, description, table='schema_version'):
+    connection.execute(sq.text(f'INSERT INTO {table} (version, description) VALUES (:version, :description)'),
+                       {'version': number, 'description': description})
+
+
+def upgrade(engine):
+    """
+    Applies the migrations that have not been applied to the database yet.
+    All of them are run within a single transaction, so a failed upgrade leaves the schema untouched.
+    :return: the schema version after the upgrade
+    """
+    with engine.begin() as connection:
+        connection.execute(sq.text('SELECT pg_advisory_xact_lock(:lock_id)'), {'lock_id': LOCK_ID})
+        create_version_table(connection)
+        version = current_version(connection)
+        for number, description, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            for statement in statements:
+                connection.execute(sq.text(statement))
+            record_version(connection, number, description)
+            version = number
+    return version
+
+
+def upgrade_state(engine):
+    """
+    Applies the state migrations that have not been applied to the state database yet,
+    within a single transaction. The tables are expected to be created by the state store beforehand.
+    :return: the state schema version after the upgrade
+    """
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(sq.text('SELECT pg_advisory_xact_lock(:lock_id)'), {'lock_id': STATE_LOCK_ID})
+        create_version_table(connection, 'state_schema_version')
+        version = current_version(connection, 'state_schema_version')
+        for number, description, columns in STATE_MIGRATIONS:
+            if number <= version:
+                continue
+            for table, column, definition in columns:
+                if column not in {existing['name'] for existing in sq.inspect(connection).get_columns(table)}:
+                    connection.execute(sq.text(f'ALTER TABLE {table} ADD COLUMN {column} {definition}'))
+            record_version(connection, number, description, 'state_schema_version')
+            version = number
+    return version
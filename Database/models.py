@@ -1,7 +1,9 @@
 import sqlalchemy as sq
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
+StateBase = declarative_base()     # the dialogue state tables, kept in the application DB or a DB of their own
 
 
 class User(Base):
@@ -14,6 +16,7 @@ class User(Base):
     bdate = sq.Column(sq.String, nullable=True)
     city = sq.Column(sq.Integer, nullable=False)
     interest = sq.Column(sq.String, nullable=True)
+    interest_tokens = sq.Column(ARRAY(sq.String), nullable=True)
 
     user_offer = relationship('UserOffer', back_populates='user', cascade='all, delete')
 
@@ -28,10 +31,19 @@ class Offer(Base):
     bdate = sq.Column(sq.Date, nullable=False)
     city = sq.Column(sq.Integer, nullable=False)
     interest = sq.Column(sq.String, nullable=True)
+    interest_tokens = sq.Column(ARRAY(sq.String), nullable=True)
+    created_at = sq.Column(sq.DateTime, nullable=False, server_default=sq.func.now())
+    checked_at = sq.Column(sq.DateTime, nullable=True)      # the last time the account was verified to be active
+    last_shown_at = sq.Column(sq.DateTime, nullable=True)   # the last time the offer was suggested to a user
 
     user_offer = relationship('UserOffer', back_populates='offer', cascade='all, delete')
     photo = relationship('Photo', back_populates='offer', cascade='all, delete')
 
+    __table_args__ = (sq.Index('ix_offer_city_sex_bdate', 'city', 'sex', 'bdate'),
+                      sq.Index('ix_offer_interest_tokens', 'interest_tokens', postgresql_using='gin'),
+                      sq.Index('ix_offer_checked_at', 'checked_at'),
+                      sq.Index('ix_offer_last_shown_at', 'last_shown_at'))
+
 
 class UserOffer(Base):
     __tablename__ = 'user_offer'
@@ -45,16 +57,46 @@ class UserOffer(Base):
     offer = relationship('Offer', back_populates='user_offer')
     user = relationship('User', back_populates='user_offer')
 
+    __table_args__ = (sq.Index('ux_user_offer_user_id_offer_id', 'user_id', 'offer_id', unique=True),
+                      sq.Index('ix_user_offer_offer_id', 'offer_id'),
+                      sq.Index('ix_user_offer_favorites', 'user_id', 'user_offer_id',
+                               postgresql_where=sq.text('favorite_list = 1')))
+
 
 class Photo(Base):
     __tablename__ = 'photo'
 
     photo_id = sq.Column(sq.Integer, primary_key=True)
     offer_id = sq.Column(sq.Integer, sq.ForeignKey('offer.offer_id', ondelete='CASCADE'), nullable=False)
-    photo_url = sq.Column(sq.String, nullable=False)
+    photo_url = sq.Column(sq.String, nullable=False)     # the attachment identifier: photo<owner_id>_<photo_id>
+    position = sq.Column(sq.Integer, nullable=False, server_default='0')    # in the photo set, the most liked first
+    refreshed_at = sq.Column(sq.DateTime, nullable=False, server_default=sq.func.now())
 
     offer = relationship('Offer', back_populates='photo')
 
+    __table_args__ = (sq.Index('ix_photo_offer_id', 'offer_id'),
+                      sq.Index('ux_photo_photo_url', 'photo_url', unique=True))
+
+
+class Dialogue(StateBase):
+    __tablename__ = 'dialogue'
+
+    user_id = sq.Column(sq.Integer, primary_key=True)
+    last_offer = sq.Column(sq.Integer, nullable=True)
+    processing = sq.Column(sq.Boolean, nullable=False, default=False)
+    saved_cursor = sq.Column(sq.Integer, nullable=True)
+    updated_at = sq.Column(sq.DateTime, nullable=False)
+
+
+class OfferCursor(StateBase):
+    __tablename__ = 'offer_cursor'
+
+    offer_cursor_id = sq.Column(sq.Integer, primary_key=True)
+    user_id = sq.Column(sq.Integer, nullable=False)
+    offer = sq.Column(sq.JSON, nullable=False)
+
+    __table_args__ = (sq.Index('ix_offer_cursor_user_id', 'user_id', 'offer_cursor_id'),)
+
 
 def create_table(engine):
     Base.metadata.create_all(engine, checkfirst=True)
@@ -0,0 +1,87 @@
+"""
+Benchmark of the candidates retrieval: latency of connect.get_offer depending on the number of
+cached candidates, compared to the former implementation that requested photos offer by offer.
+Synthetic records are written to the database configured in "Database/postgres_config.py"
+and removed afterwards.
+Run from the root directory: python -m benchmarks.bench_get_offer
+"""
+import statistics
+import time
+from datetime import date, datetime, timedelta
+
+from Database import connect
+from Database.models import Offer, Photo, User, UserOffer
+
+USER_ID = 2100000000
+FIRST_OFFER_ID = 2100000001
+COUNTS = (10, 50, 100, 500, 1000, 2000)
+REPEAT = 5
+CRITERIA = {'city': 1, 'sex': 1, 'age_from': 18, 'age_to': 99, 'interests': []}
+
+
+def seed(count):
+    offers = [{'offer_id': FIRST_OFFER_ID + i,
+               'first_name': 'Bench',
+               'last_name': f'Offer{i}',
+               'sex': CRITERIA['sex'],
+               'bdate': date(1995, 1, 1),
+               'city': CRITERIA['city'],
+               'interest': '',
+               'photos': [f'photo{FIRST_OFFER_ID + i}_{j}' for j in range(3)]} for i in range(count)]
+    connect.add_offers(USER_ID, offers)
+
+
+def cleanup():
+    with connect.Session.begin() as session:
+        session.query(Offer).filter(Offer.offer_id >= FIRST_OFFER_ID).delete()
+        session.query(User).filter(User.user_id == USER_ID).delete()
+
+
+def legacy_get_offer(criteria, user_id):
+    """
+    The former implementation: one query for the offers plus one query per offer for its photos.
+    """
+    today = datetime.utcnow()
+    birthdate_from = today - timedelta(days=365 * criteria['age_to'])
+    birthdate_to = today - timedelta(days=365 * criteria['age_from'])
+    with connect.Session() as session:
+        offers = session.query(*connect.offer_columns()[:7]). \
+            filter(Offer.city == criteria['city']). \
+            filter(Offer.sex == criteria['sex']). \
+            filter(Offer.bdate.between(birthdate_from, birthdate_to)). \
+            join(UserOffer, UserOffer.offer_id == Offer.offer_id). \
+            filter(UserOffer.user_id == user_id). \
+            filter(UserOffer.black_list == 0). \
+            filter(UserOffer.favorite_list == 0). \
+            all()
+        return [(*offer, [photo[0] for photo in
+                          session.query(Photo.photo_url).filter(Photo.offer_id == offer[0]).all()])
+                for offer in offers]
+
+
+def measure(func):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(CRITERIA, USER_ID)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    connect.create_tables()
+    cleanup()
+    connect.add_user(USER_ID, 'Bench', 'User', 2, '01.01.1995', CRITERIA['city'], '')
+    print(f'{"candidates":>10} {"single query, ms":>17} {"per-offer photos, ms":>21}')
+    try:
+        for count in COUNTS:
+            seed(count)
+            found = len(connect.get_offer(CRITERIA, USER_ID))
+            assert found == count, f'get_offer returned {found} of {count} candidates'
+            print(f'{count:>10} {measure(connect.get_offer):>17.1f} {measure(legacy_get_offer):>21.1f}')
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
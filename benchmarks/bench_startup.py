@@ -0,0 +1,86 @@
+"""
+Benchmark of the startup and of the memory taken by the morphological analyzer:
+- the time to import transformer and the time until the analyzer is ready, in a fresh interpreter;
+- the memory of WORKERS forked processes analysing words, when the analyzer is preloaded in the parent
+  before fork (the dictionaries are shared copy-on-write) compared to every worker loading its own copy.
+PSS is the memory of a process with the shared pages divided among the processes sharing them.
+Linux only (the memory is read from /proc). Run from the root directory: python -m benchmarks.bench_startup
+"""
+import gc
+import multiprocessing
+import subprocess
+import sys
+
+WORKERS = 4
+WORDS = ('футбол', 'книги', 'путешествовать', 'рисовать', 'музыка', 'программирование', 'горы', 'танцевать')
+
+IMPORT = """
+import resource, time
+start = time.perf_counter()
+import transformer
+imported = time.perf_counter() - start
+transformer.get_morph()
+ready = time.perf_counter() - start
+print(imported, ready, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+"""
+
+
+def memory(pid):
+    """
+    :return: {'Rss': kB, 'Pss': kB, 'Private_Dirty': kB, ...} of the process
+    """
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        return {line.split(':')[0]: int(line.split()[1]) for line in f if line.split()[-1] == 'kB'}
+
+
+def work(ready, release):
+    import transformer
+    for word in WORDS:
+        transformer.analyse_word(word)
+    ready.put(None)
+    release.wait()
+
+
+def workers(preload):
+    """
+    Forks the workers, waits until every worker has analysed the words and measures their memory.
+    :return: total RSS, total PSS of the workers, MB
+    """
+    import transformer
+    context = multiprocessing.get_context('fork')
+    if preload:
+        transformer.warm_up(background=False)
+        gc.freeze()
+    ready = context.Queue()
+    release = context.Event()
+    processes = [context.Process(target=work, args=(ready, release)) for _ in range(WORKERS)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+    usage = [memory(process.pid) for process in processes]
+    release.set()
+    for process in processes:
+        process.join()
+    return sum(item['Rss'] for item in usage) / 1024, sum(item['Pss'] for item in usage) / 1024
+
+
+def run(*args):
+    output = subprocess.run([sys.executable, *args], capture_output=True, text=True, check=True).stdout
+    return [float(value) for value in output.split()]
+
+
+def main():
+    imported, ready, rss = run('-c', IMPORT)
+    print(f'import transformer: {imported * 1000:.0f} ms, analyzer ready: {ready * 1000:.0f} ms, RSS: {rss:.0f} MB')
+    print(f'{WORKERS} workers {"total RSS, MB":>22} {"total PSS, MB":>14}')
+    for mode, title in (('preload', 'preloaded before fork'), ('separate', 'loaded by every worker')):
+        rss, pss = run('-m', 'benchmarks.bench_startup', mode)
+        print(f'{title:<24} {rss:>12.0f} {pss:>14.0f}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        print(*workers(preload=sys.argv[1] == 'preload'))
+    else:
+        main()
@@ -1,19 +1,50 @@
 import os
+import heapq
 import json
-import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from datetime import date
+from functools import lru_cache
 
 import vk_api
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
-import requests
 from dotenv import load_dotenv
 
+import metrics
+from http_client import get_session
+from outbox import Outbox
+from ratelimit import Scheduler, RateLimited, INTERACTIVE, BACKGROUND, TOO_MANY_REQUESTS
+
+
+def paced_session(token):
+    """
+    Creates a vk_api session, requests of which are paced by a Scheduler rather than by vk_api:
+    the built-in delay and the session-wide lock (that lets only one request at a time) are disabled.
+    The built-in handler of the "too many requests" error (that sleeps and retries endlessly) is removed as well,
+    so that the error reaches the Scheduler and is retried with its pause and backoff.
+    The session works over the shared pool of keep-alive HTTP connections.
+    """
+    vk_session = vk_api.VkApi(token=token, session=get_session())
+    vk_session.RPS_DELAY = 0
+    vk_session.lock = nullcontext()
+    vk_session.error_handlers.pop(vk_api.vk_api.TOO_MANY_RPS_CODE, None)
+    return vk_session
+
 
 class Bot:
     dotenv_path = '.env'
     settings_path = 'settings.cfg'
     base = 'https://api.vk.com/method/'
+    users_get_limit = 1000      # user ids per users.get request
+    rate = 20                   # requests per second allowed for a group token
+    long_poll_wait = 25         # seconds
+    outbox_workers = 4          # threads sending the messages
 
-    def __init__(self):
+    def __init__(self, share=1):
+        """
+        share: the number of processes using the token at the same time, the rate is divided among them
+        """
         if os.path.exists(self.dotenv_path):
             load_dotenv(self.dotenv_path)
         self.key = None
@@ -22,8 +53,29 @@ class Bot:
         self.params = {'group_id': os.environ.get("GROUP_ID"),
                        'access_token': os.environ.get("GROUP_TOKEN"),
                        'v': '5.131'}
-        vk_session = vk_api.VkApi(token=os.environ.get("GROUP_TOKEN"))
+        self.http = get_session()
+        self.scheduler = Scheduler(self.rate / share)
+        vk_session = paced_session(os.environ.get("GROUP_TOKEN"))
         self.vk = vk_session.get_api()
+        self.outbox = Outbox(self.send_message, workers=self.outbox_workers)
+
+    def request(self, method, params, priority=INTERACTIVE, http_method='get'):
+        """
+        Raw API request paced by the token's scheduler. Retried automatically
+        in case of a "too many requests" error.
+        :return: the parsed json of the response
+        """
+        @metrics.timed('vk.' + method)
+        def send():
+            if http_method == 'post':
+                response = self.http.post(self.base + method, data=params).json()
+            else:
+                response = self.http.get(self.base + method, params=params).json()
+            if response.get('error', {}).get('error_code') == TOO_MANY_REQUESTS:
+                raise RateLimited(response['error'].get('error_msg'))
+            return response
+
+        return self.scheduler.call(send, priority=priority)
 
     def get_server(self):
         """
@@ -31,14 +83,14 @@ class Bot:
         :return: "session data successfully received" OR error message
         """
         method = 'groups.getLongPollServer'
-        response = requests.get(self.base + method, params=self.params)
+        response = self.request(method, self.params)
         try:
-            self.key = response.json()['response']['key']
-            self.server = response.json()['response']['server']
-            self.ts = response.json()['response']['ts']
+            self.key = response['response']['key']
+            self.server = response['response']['server']
+            self.ts = response['response']['ts']
             return "session data successfully received"
         except KeyError:
-            return f'{response.json().get("error", {}).get("error_msg", "unknown error")}'
+            return f'{response.get("error", {}).get("error_msg", "unknown error")}'
 
     def get_settings(self):
         """
@@ -48,8 +100,8 @@ class Bot:
         """
         method = 'groups.getLongPollSettings'
         with open(self.settings_path, 'wt', encoding='UTF-8') as settings_file:
-            response = requests.get(self.base + method, params=self.params)
-            settings = response.json().get('response', {}).get('events', 'could not receive settings')
+            response = self.request(method, self.params)
+            settings = response.get('response', {}).get('events', 'could not receive settings')
             json.dump(settings, fp=settings_file, indent=4)
 
     def set_settings(self):
@@ -61,97 +113,163 @@ class Bot:
         with open(self.settings_path, 'rt', encoding='UTF-8') as settings_file:
             settings = json.load(settings_file)
             params = {**self.params, **settings}
-        response = requests.get(self.base + method, params=params)
-        if response.json().get('response') == 1:
+        response = self.request(method, params)
+        if response.get('response') == 1:
             return 'settings successfully changed'
         else:
-            return response.json().get('error', {}).get('error_msg', 'unknown error')
+            return response.get('error', {}).get('error_msg', 'unknown error')
 
+    @metrics.timed('vk.long_poll')
     def listen(self):
         """
-        Send a long poll request with 25 seconds timeout that check's if a message
-        has been sent to the group.
-        :return: A tuple of:
+        Send a long poll request with 25 seconds timeout that check's if messages
+        have been sent to the group. The read timeout of the request exceeds the long poll wait.
+        All the updates of the batch are returned, so that no message gets lost when
+        several of them arrive within one long poll cycle.
+        :return: A list of tuples:
                  Message sender's user id
                  Text of the message
         """
-        url = f'{self.server}?act=a_check&key={self.key}&ts={self.ts}&wait=25'
-        response = requests.get(url, params=self.params)
-        self.ts = response.json().get('ts')
-        if response.json().get('updates'):
-            return (
-                response.json()['updates'][0]['object']['message']['from_id'],
-                response.json()['updates'][0]['object']['message']['text']
-            )
-        else:
-            return None
+        url = f'{self.server}?act=a_check&key={self.key}&ts={self.ts}&wait={self.long_poll_wait}'
+        timeout = (self.http.timeout[0], self.long_poll_wait + self.http.timeout[1])
+        response = self.http.get(url, params=self.params, timeout=timeout).json()
+        if response.get('failed'):
+            if response['failed'] == 1:
+                self.ts = response.get('ts')
+            else:
+                self.get_server()
+            return []
+        self.ts = response.get('ts')
+        return [(update['object']['message']['from_id'], update['object']['message']['text'])
+                for update in response.get('updates', [])
+                if update.get('type') == 'message_new']
 
-    def say(self, recipient: int, message: str):
+    def say(self, recipient: int, message: str, keyboard: str = None):
         """
-        Simple message sending method.
+        Simple message sending method. The message is queued to the outbox and sent asynchronously,
+        after the messages queued to the recipient earlier.
         recipient: user id
         message: text
+        keyboard: the keyboard json (see Bot.keyboard), the keyboard of the user is left as it is if None
         """
-        random_id = random.randint(-2147483648, 2147483647)
-        self.vk.messages.send(user_id=recipient, message=message, random_id=random_id)
+        params = {} if keyboard is None else {'keyboard': keyboard}
+        self.outbox.put(recipient, message=message, **params)
 
-    def suggest(self, recipient: int, name: str, link: str, photos: list):
-        message = f'Я нашел для тебя отличный вариант для знакомства!\n\n' \
-                  f'{name}\n' \
-                  f'{link}\n\n'
-        attachment = ','.join(photos)
-        random_id = random.randint(-2147483648, 2147483647)
+    @metrics.timed('vk.messages.send')
+    def send_message(self, **params):
+        """
+        Synchronous messages.send request, made by the outbox workers.
+        params: the messages.send parameters, random_id included
+        """
+        self.scheduler.call(self.vk.messages.send, **params)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def keyboard(saved_more=False):
+        """
+        :return: the json of the dialogue keyboard, with the "saved more" button (the next page of the favorites)
+                 in the second line, if "saved_more". Built once per variant.
+        """
         keyboard = VkKeyboard(one_time=False)
         keyboard.add_button('next', color=VkKeyboardColor.PRIMARY)
         keyboard.add_button('blacklist', color=VkKeyboardColor.NEGATIVE)
         keyboard.add_button('favorites', color=VkKeyboardColor.POSITIVE)
         keyboard.add_button('saved', color=VkKeyboardColor.PRIMARY)
+        if saved_more:
+            keyboard.add_line()
+            keyboard.add_button('saved more', color=VkKeyboardColor.SECONDARY)
+        return keyboard.get_keyboard()
 
-        self.vk.messages.send(user_id=recipient,
-                              message=message,
-                              attachment=attachment,
-                              random_id=random_id,
-                              keyboard=keyboard.get_keyboard())
+    def suggest(self, recipient: int, name: str, link: str, photos: list):
+        message = f'Я нашел для тебя отличный вариант для знакомства!\n\n' \
+                  f'{name}\n' \
+                  f'{link}\n\n'
+        attachment = ','.join(photos)
+        self.outbox.put(recipient, message=message, attachment=attachment, keyboard=self.keyboard())
 
     def get_users_details(self, user: int):
         method = 'users.get'
         data = {'user_ids': f"{user}", 'fields': 'city, sex, bdate, interests'}
         params = {**self.params, **data}
-        response = requests.get(self.base + method, params=params)
-        return response.json()['response'][0]
+        response = self.request(method, params)
+        return response['response'][0]
+
+    def get_users_status(self, users: list, priority=INTERACTIVE):
+        """
+        Bulk check of the accounts validity. One users.get request is made per "self.users_get_limit" ids.
+        users: [int, ...] - user ids
+        priority: the priority of the requests (ratelimit.INTERACTIVE or ratelimit.BACKGROUND)
+        :return: {user_id: True, if the account is active
+                           False, if the account is deactivated or doesn't exist}
+                 The ids, the status of which could not be received, are omitted.
+        """
+        method = 'users.get'
+        result = {}
+        for start in range(0, len(users), self.users_get_limit):
+            chunk = users[start:start + self.users_get_limit]
+            data = {'user_ids': ','.join(str(user) for user in chunk)}
+            response = self.request(method, {**self.params, **data}, priority=priority, http_method='post')
+            if 'response' not in response:
+                continue
+            active = {account['id']: not account.get('deactivated') for account in response['response']}
+            result.update({user: active.get(user, False) for user in chunk})
+        return result
 
 
 class Searcher(Bot):
     scripts_path = 'vk_scripts/'
+    batch_size = 25     # execute method allows 25 API calls per script
+    rate = 3            # requests per second allowed for a user token
+    search_limit = 1000     # users.search never returns more than 1000 accounts
+    slices_per_call = 2     # users.search slices packed into a single execute request
+    search_workers = 3      # slices requested concurrently
+    crawl_workers = 3       # photo batches requested concurrently
+    top_photos = 3          # the most liked photos taken per account
+    photos_scanned = 200    # the latest photos of an account the most liked ones are chosen from (photos.getAll max)
 
-    def __init__(self):
+    def __init__(self, share=1):
         if os.path.exists(self.dotenv_path):
             load_dotenv(self.dotenv_path)
 
         access_token = os.environ.get("USER_TOKEN")
-        vk_session = vk_api.VkApi(token=access_token)
+        self.http = get_session()
+        self.scheduler = Scheduler(self.rate / share)
+        vk_session = paced_session(access_token)
         self.vk = vk_session.get_api()
 
-    def get_photos_and_details(self, account):
+    @metrics.timed('vk.execute.photos')
+    def get_top_photos_batch(self, accounts, top=None):
         """
-        Executes a vk script "get_photos_and_details".
-        account: {'id': int,
-                  'bdate': str,
-                  'city': {'id': int, 'title': str},
-                  'interests': str,
-                  'sex': int,
-                  'first_name': str,
-                  'last_name': str}
-        :return: A complex nested list with albums and photos in these albums.
+        Executes a vk script "get_top_photos_batch" that requests the photos of several accounts
+        within a single API request (one photos.getAll call per account) and picks the most liked ones.
+        The script returns only the ids and the like counts of the photos, extracted with the "@." vector operator,
+        so it costs a few operations per account regardless of the number of photos: an interpreted selection
+        loop over "self.photos_scanned" photos of "self.batch_size" accounts would run into the "too many
+        operations" limit of execute. The top ones are selected on the client side.
+        accounts: [int, ...] - not more than "self.batch_size" account ids
+        top: the number of photos per account, "self.top_photos" by default
+        :return: {account_id: ['photo<owner_id>_<photo_id>', ...] - the most liked first,
+                              OR None, if the photos of the account could not be received}
+              OR ApiError, if the whole request has failed
         """
-        with open(self.scripts_path + 'get_photos_and_details') as f:
-            code = f.read().replace('<id>', str(account))
+        with open(self.scripts_path + 'get_top_photos_batch') as f:
+            code = f.read().replace('<ids>', json.dumps(list(accounts)))\
+                           .replace('<count>', str(self.photos_scanned))
         try:
-            response = self.vk.execute(code=code)
-            return response
+            response = self.scheduler.call(self.vk.execute, code=code, priority=BACKGROUND)
         except vk_api.exceptions.ApiError as e:
             return e
+        top = top or self.top_photos
+        result = {account: None for account in accounts}
+        for element in response or []:
+            if element.get('error'):
+                continue
+            ids, likes = element.get('ids') or [], element.get('likes') or []
+            best = heapq.nlargest(top, range(len(ids)), key=likes.__getitem__)
+            result[element['id']] = [f"photo{element['id']}_{ids[position]}" for position in best]
+        return result
 
+    @metrics.timed('vk.execute.users.search')
     def search_users(self, criteria):
         """
         criteria: {'city': int,
@@ -168,18 +286,93 @@ class Searcher(Bot):
                            .replace('<age_from>', str(criteria['age_from']))\
                            .replace('<age_to>', str(criteria['age_to']))
         try:
-            response = self.vk.execute(code=code)
+            response = self.scheduler.call(self.vk.execute, code=code, priority=BACKGROUND)
             return response[0]['items'] if response else None
         except vk_api.exceptions.ApiError as e:
             return e
 
+    def search_users_sharded(self, criteria, budget=None):
+        """
+        Sharded mode of search_users, that gets round the limit of 1000 accounts per search.
+        The criteria are split into disjoint slices by birth year. Slices are requested concurrently
+        (within the rate limit of the token), several slices per execute request. A year slice
+        that hits the limit is split further into 12 month slices.
+        criteria: {'city': int,
+                   'sex': int,
+                   'age_to': int,
+                   'age_from': int,
+                   'interests': [str, ...]}
+        budget: ratelimit.Budget spent by every execute request, no more requests are made once it is exhausted
+                (no limit if None)
+        :return: A generator yielding the lists of accounts as the slices are received. Every account is yielded once.
+                 An ApiError is yielded in place of the accounts of the slices, that could not be requested.
+        """
+        year = date.today().year
+        slices = [{'birth_year': birth_year}
+                  for birth_year in range(year - criteria['age_to'] - 1, year - criteria['age_from'] + 1)]
+        queued = deque()
+        seen = set()
 
+        def queue(slices):
+            queued.extend(slices[start:start + self.slices_per_call]
+                          for start in range(0, len(slices), self.slices_per_call))
 
+        with ThreadPoolExecutor(max_workers=self.search_workers) as executor:
+            pending = set()
 
+            def submit():
+                """
+                Keeps up to "self.search_workers" requests in flight, as long as the budget allows.
+                """
+                while queued and len(pending) < self.search_workers:
+                    if budget is not None and not budget.spend():
+                        queued.clear()
+                        break
+                    pending.add(executor.submit(self._search_slices, criteria, queued.popleft()))
 
+            queue(slices)
+            submit()
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        response = future.result()
+                        if isinstance(response, Exception):
+                            yield response
+                            continue
+                        accounts = []
+                        for element in response:
+                            if element.get('error'):
+                                continue
+                            if element['count'] > self.search_limit and not element['slice'].get('birth_month'):
+                                queue([{**element['slice'], 'birth_month': month} for month in range(1, 13)])
+                            for account in element['items']:
+                                if account['id'] not in seen:
+                                    seen.add(account['id'])
+                                    accounts.append(account)
+                        if accounts:
+                            yield accounts
+                    submit()
+            finally:
+                for future in pending:
+                    future.cancel()
 
-
-
-
-
-
+    @metrics.timed('vk.execute.users.search')
+    def _search_slices(self, criteria, slices):
+        """
+        Executes a vk script "users.search.sharded" for the slices of the criteria.
+        :return: [{'slice': {'birth_year': int, 'birth_month': int (optional)},
+                   'count': int,
+                   'items': [account, ...]}, ...]
+              OR ApiError
+        """
+        with open(self.scripts_path + 'users.search.sharded') as f:
+            code = f.read().replace('<slices>', json.dumps(slices))\
+                           .replace('<city>', str(criteria['city']))\
+                           .replace('<sex>', str(criteria['sex']))\
+                           .replace('<age_from>', str(criteria['age_from']))\
+                           .replace('<age_to>', str(criteria['age_to']))
+        try:
+            return self.scheduler.call(self.vk.execute, code=code, priority=BACKGROUND) or []
+        except vk_api.exceptions.ApiError as e:
+            return e
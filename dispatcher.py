@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Runs a single long poll reader and a bounded pool of event handlers on an asyncio event loop.
+    Every update of a long poll batch gets dispatched. Events of the same sender are handled
+    strictly one after another in the order they have been received, while the events of
+    different senders are handled concurrently.
+    poll: a blocking callable returning a list of events - (sender_id, text) tuples
+    handler: a blocking callable that processes a single event
+    max_workers: the number of events that may be handled at the same time
+    max_pending: the number of received events awaiting a handler, upon reaching which
+                 the reader stops polling until the handlers catch up
+    """
+
+    def __init__(self, poll, handler, max_workers=16, max_pending=1000):
+        self.poll = poll
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.queues = {}
+        self.tasks = set()
+
+    def run(self):
+        """
+        Starts the event loop. Blocks forever.
+        """
+        asyncio.run(self._read())
+
+    async def _read(self):
+        loop = asyncio.get_running_loop()
+        reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='long-poll')
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='handler')
+        self.pending = asyncio.Semaphore(self.max_pending)
+        while True:
+            try:
+                events = await loop.run_in_executor(reader, self.poll)
+            except Exception:
+                logger.exception('long poll request failed')
+                await asyncio.sleep(1)
+                continue
+            for event in events:
+                await self.pending.acquire()
+                self._route(event)
+
+    def _route(self, event):
+        """
+        Puts the event to the sender's queue. A drain task is started for the senders
+        that have no events in progress.
+        """
+        sender_id = event[0]
+        sender_queue = self.queues.get(sender_id)
+        if sender_queue is None:
+            sender_queue = self.queues[sender_id] = deque()
+            task = asyncio.create_task(self._drain(sender_id, sender_queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        sender_queue.append(event)
+
+    async def _drain(self, sender_id, sender_queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while sender_queue:
+                event = sender_queue.popleft()
+                try:
+                    await loop.run_in_executor(self.executor, self.handler, event)
+                except Exception:
+                    logger.exception('failed to handle an event from %s', sender_id)
+                finally:
+                    self.pending.release()
+        finally:
+            del self.queues[sender_id]
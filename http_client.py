@@ -0,0 +1,58 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_CONNECTIONS = 4    # number of hosts (api.vk.com, long poll server, ...) to keep pools for
+POOL_SIZE = 32          # keep-alive connections per host, should not be less than the number of concurrent requests
+TIMEOUT = (5, 30)       # connect and read timeouts, seconds
+
+_session = None
+_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session with tunable connection pools and a default timeout for every request.
+    Connections are kept alive and reused, so TCP and TLS handshakes are not repeated for every API call.
+    A timeout passed to a particular request overrides the default one.
+    """
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_session():
+    """
+    :return: the HTTP session shared by all the API clients of the process.
+    The pool size and the default read timeout can be set with the HTTP_POOL_SIZE and HTTP_TIMEOUT
+    environment variables (or in the ".env" file).
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            pool_size = int(os.environ.get('HTTP_POOL_SIZE', POOL_SIZE))
+            timeout = (TIMEOUT[0], float(os.environ.get('HTTP_TIMEOUT', TIMEOUT[1])))
+            _session = PooledSession(pool_size=pool_size, timeout=timeout)
+        return _session
+
+
+def _forget_session():
+    """
+    A forked process must not use the connections of its parent, so it starts with a session of its own.
+    """
+    global _session, _lock
+    _session = None
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_session)
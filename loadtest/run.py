@@ -0,0 +1,210 @@
+"""
+End-to-end load test: synthetic users talk to the bot served by the VK API simulator (loadtest/simulator.py).
+Every user sends a greeting, waits for the first suggestion and asks for the "next" one several times.
+Reported: the latency to the first suggestion and of every reply (p50/p95/p99), messages per second,
+the peak number of threads and the peak memory of the process, the API calls made and the "too many requests"
+errors received.
+The bot works with the database configured in "Database/postgres_config.py", the synthetic records are removed
+afterwards. No real token is used and no request leaves the process.
+Run from the root directory: python -m loadtest.run --users 1000 --arrival-rate 50
+"""
+import argparse
+import heapq
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+
+import main
+from bot import Bot, Searcher
+from dispatcher import Dispatcher
+from http_client import get_session
+from loadtest.simulator import FIRST_ACCOUNT_ID, VkSimulator
+from pipeline import SearchFlights
+from state import MemoryStateStore
+from transformer import segment
+from validity import AccountValidator
+from Database import connect
+from Database.models import Offer, User
+
+FIRST_USER_ID = 1900000000
+GROUP_TOKEN = 'simulator-group-token'
+USER_TOKEN = 'simulator-user-token'
+GREETING = 'привет'
+NEXT = 'next'
+SAMPLE_INTERVAL = 0.5   # seconds between the samples of the number of threads
+
+
+def percentile(values, share):
+    """
+    :return: the nearest-rank percentile of the values (None, if there are none)
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+class Driver:
+    """
+    Replays the synthetic users: the users arrive at "arrival_rate" per second, every user sends a greeting
+    and answers every suggestion with "next" after "think_time" seconds, "nexts" times.
+    A user is done when the last suggestion or any other reply (e.g. "nothing found") is received.
+    """
+
+    def __init__(self, simulator, users, arrival_rate, nexts, think_time):
+        self.simulator = simulator
+        self.users = users
+        self.arrival_rate = arrival_rate
+        self.nexts = nexts
+        self.think_time = think_time
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.timers = []
+        self.started = {}
+        self.last_sent = {}
+        self.first_suggestions = []
+        self.replies = []
+        self.suggestions = defaultdict(int)
+        self.messages = 0
+        self.done = set()
+        self.finished = threading.Event()
+        simulator.on_message(self.on_message)
+
+    def start(self):
+        start = time.monotonic()
+        for number in range(self.users):
+            user_id = FIRST_USER_ID + number
+            self.simulator.add_user(user_id)
+            self.schedule(start + number / self.arrival_rate, user_id, GREETING)
+        threading.Thread(target=self.run_timers, name='driver', daemon=True).start()
+
+    def schedule(self, moment, user_id, text):
+        with self.condition:
+            heapq.heappush(self.timers, (moment, user_id, text))
+            self.condition.notify()
+
+    def run_timers(self):
+        while not self.finished.is_set():
+            with self.condition:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.condition.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                moment, user_id, text = heapq.heappop(self.timers)
+                now = time.monotonic()
+                self.started.setdefault(user_id, now)
+                self.last_sent[user_id] = now
+                self.messages += 1
+            self.simulator.send_message(user_id, text)
+
+    def on_message(self, user_id, params):
+        now = time.monotonic()
+        with self.lock:
+            if user_id not in self.started or user_id in self.done:
+                return
+            sent = self.last_sent.pop(user_id, None)
+            if sent is not None:
+                self.replies.append(now - sent)
+            if params.get('attachment') is not None:
+                if not self.suggestions[user_id]:
+                    self.first_suggestions.append(now - self.started[user_id])
+                self.suggestions[user_id] += 1
+                if self.suggestions[user_id] <= self.nexts:
+                    heapq.heappush(self.timers, (now + self.think_time, user_id, NEXT))
+                    self.condition.notify()
+                    return
+            self.done.add(user_id)
+            if len(self.done) == self.users:
+                self.finished.set()
+
+
+def setup(simulator, mode, workers):
+    """
+    Sets up the bot as main.py does, over the simulator, and starts serving the long poll in the background.
+    """
+    os.environ['GROUP_TOKEN'] = GROUP_TOKEN
+    os.environ['USER_TOKEN'] = USER_TOKEN
+    simulator.mount(get_session())
+    main.bot = Bot()
+    main.searcher = Searcher()
+    main.validator = AccountValidator(main.bot.get_users_status, connect.remove_offers)
+    main.store = MemoryStateStore(timeout=main.DIALOGUE_TIMEOUT)
+    main.dialogues = {}
+    main.searches = SearchFlights(main.search_segment, segment, ttl=main.SEARCH_REPLAY_TTL)
+    main.state_engine = None
+    main.rate_share = 1
+    connect.create_tables()
+    main.bot.get_server()
+    if mode == 'asyncio':
+        dispatcher = Dispatcher(main.bot.listen, main.dispatch, max_workers=workers)
+        threading.Thread(target=dispatcher.run, name='dispatcher', daemon=True).start()
+    else:
+        threading.Thread(target=main.listen, name='listen', daemon=True).start()
+
+
+def cleanup():
+    with connect.Session.begin() as session:
+        session.query(Offer).filter(Offer.offer_id >= FIRST_ACCOUNT_ID).delete()
+        session.query(User).filter(User.user_id >= FIRST_USER_ID, User.user_id < FIRST_ACCOUNT_ID).delete()
+
+
+def report(driver, simulator, elapsed, peak_threads):
+    def milliseconds(values):
+        if not values:
+            return '-'
+        return '  '.join(f'p{round(share * 100)} {percentile(values, share) * 1000:8.1f}' for share in (0.5, 0.95, 0.99))
+
+    stats = simulator.stats()
+    print(f'users: {driver.users}, done: {len(driver.done)}, elapsed: {elapsed:.1f} s')
+    print(f'first suggestion, ms: {milliseconds(driver.first_suggestions)}')
+    print(f'reply, ms:            {milliseconds(driver.replies)}')
+    print(f'messages/sec: {driver.messages / elapsed:.1f} received, '
+          f'{stats["calls"].get("messages.send", 0) / elapsed:.1f} sent')
+    print(f'threads: {peak_threads} peak')
+    print(f'memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB peak RSS')
+    print('API calls: ' + ', '.join(f'{method} {count}' for method, count in sorted(stats['calls'].items())))
+    print(f'too many requests errors: {sum(stats["errors"].values())}')
+
+
+def run():
+    parser = argparse.ArgumentParser(description='VKinder load test against the VK API simulator')
+    parser.add_argument('--users', type=int, default=1000, help='the number of synthetic users')
+    parser.add_argument('--arrival-rate', type=float, default=50, help='new users per second')
+    parser.add_argument('--nexts', type=int, default=3, help='"next" requests made by every user')
+    parser.add_argument('--think-time', type=float, default=0.5, help='seconds a user takes to answer a suggestion')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every API request takes')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='the probability of a random "too many requests" error')
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help='do not emulate the per-token rate limits of vk.com')
+    parser.add_argument('--population', type=int, default=20000, help='the number of accounts to search among')
+    parser.add_argument('--mode', choices=('asyncio', 'threads'), default='asyncio')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the users to be done')
+    args = parser.parse_args()
+
+    rate_limits = None if args.no_rate_limits else {GROUP_TOKEN: Bot.rate, USER_TOKEN: Searcher.rate}
+    simulator = VkSimulator(latency=args.latency, error_rate=args.error_rate, rate_limits=rate_limits,
+                            population=args.population)
+    connect.create_tables()
+    cleanup()
+    setup(simulator, args.mode, args.workers)
+    driver = Driver(simulator, args.users, args.arrival_rate, args.nexts, args.think_time)
+
+    start = time.monotonic()
+    driver.start()
+    peak_threads = 0
+    while not driver.finished.wait(SAMPLE_INTERVAL) and time.monotonic() - start < args.timeout:
+        peak_threads = max(peak_threads, threading.active_count())
+    elapsed = time.monotonic() - start
+    peak_threads = max(peak_threads, threading.active_count())
+
+    report(driver, simulator, elapsed, peak_threads)
+    simulator.stop()
+    cleanup()
+    # the dialogues keep waiting for the users for DIALOGUE_TIMEOUT, there is no point to wait for them
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,271 @@
+"""
+Offline stand-in for the vk.com API. The simulator is a transport adapter of "requests": mounted on
+the shared HTTP session (http_client.get_session), it answers the requests of Bot and Searcher without
+any network access and without real tokens.
+Covered: the groups long poll (groups.getLongPollServer and the long poll server itself), messages.send,
+users.get, users.search and execute with the search and photo scripts of "vk_scripts" (the parameters
+substituted into a script are parsed out of its code). Every API request takes "latency" seconds. The "too many requests" error (code 6)
+is returned when a token exceeds its rate limit and at random with the probability of "error_rate".
+The accounts found by the search are drawn from a synthetic population generated from a seed.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import date
+from urllib.parse import parse_qsl, urlsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter
+
+API_URL = 'https://api.vk.com/'
+LONG_POLL_URL = 'https://lp.vk.local/'
+FIRST_ACCOUNT_ID = 2000000000   # the ids of the population accounts start with
+CITIES = (1, 2, 3)
+INTERESTS = ('футбол', 'книги', 'путешествия', 'музыка', 'кино', 'рисовать', 'танцы', 'программирование',
+             'горы', 'кулинария', 'фотография', 'плавать', 'театр', 'шахматы', 'велосипед')
+FIRST_NAMES = ('Анна', 'Мария', 'Елена', 'Иван', 'Пётр', 'Алексей')
+LAST_NAMES = ('Иванова', 'Смирнова', 'Кузнецова', 'Иванов', 'Смирнов', 'Кузнецов')
+SEARCH_LIMIT = 1000
+TOO_MANY_REQUESTS = 6
+
+
+def profile(user_id, rng, city=None, sex=None):
+    """
+    :return: a synthetic account in the users.search/users.get format
+    """
+    birth = date(rng.randint(1960, 2004), rng.randint(1, 12), rng.randint(1, 28))
+    city = city or rng.choice(CITIES)
+    return {'id': user_id,
+            'first_name': rng.choice(FIRST_NAMES),
+            'last_name': rng.choice(LAST_NAMES),
+            'sex': sex or rng.choice((1, 2)),
+            'bdate': birth.strftime('%d.%m.%Y'),
+            'city': {'id': city, 'title': f'City {city}'},
+            'interests': ', '.join(rng.sample(INTERESTS, rng.randint(0, 4)))}
+
+
+class VkSimulator(BaseAdapter):
+    """
+    latency: seconds every API request takes
+    error_rate: the probability of a random "too many requests" error
+    rate_limits: {access_token: requests per second}, the requests over the limit get the "too many requests" error
+    population: the number of synthetic accounts the search is made among
+    photos: (min, max) - the range of the number of photos of an account
+    deactivated: the share of the deactivated accounts
+    seed: the seed of the synthetic data
+    """
+    updates_kept = 10000    # the long poll history
+
+    def __init__(self, latency=0.05, error_rate=0.0, rate_limits=None, population=20000, photos=(0, 8),
+                 deactivated=0.02, seed=0):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limits = rate_limits or {}
+        self.photos = photos
+        self.deactivated = deactivated
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.updates = []
+        self.ts = 1
+        self.stopped = False
+        self.users = {}
+        self.listeners = []
+        self.history = defaultdict(deque)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.message_ids = itertools.count(1)
+        self.population = defaultdict(list)
+        for number in range(population):
+            account = profile(FIRST_ACCOUNT_ID + number, random.Random(seed + number))
+            self.population[(account['city']['id'], account['sex'])].append(account)
+        self.accounts = {account['id']: account for accounts in self.population.values() for account in accounts}
+
+    def mount(self, session):
+        """
+        Redirects the vk.com API and the long poll requests of the session to the simulator.
+        """
+        session.mount(API_URL, self)
+        session.mount(LONG_POLL_URL, self)
+
+    def add_user(self, user_id, **details):
+        """
+        Registers a user of the bot (a member of the community), the details are generated unless provided.
+        :return: the user's profile
+        """
+        user = {**profile(user_id, random.Random(self.seed - user_id)), **details}
+        with self.lock:
+            self.users[user_id] = user
+        return user
+
+    def send_message(self, user_id, text):
+        """
+        A message from a user to the community: the message_new update is returned by the next long poll request.
+        """
+        with self.condition:
+            self.updates.append({'type': 'message_new',
+                                 'object': {'message': {'from_id': user_id, 'text': text}}})
+            self.ts += 1
+            del self.updates[:-self.updates_kept]
+            self.condition.notify_all()
+
+    def on_message(self, listener):
+        """
+        listener(user_id, params) is called on every message sent by the bot, params are those of messages.send.
+        """
+        self.listeners.append(listener)
+
+    def stop(self):
+        """
+        Releases the pending long poll requests.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def stats(self):
+        """
+        :return: {'calls': {method: int}, 'errors': {method: int} - the number of "too many requests" errors}
+        """
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors)}
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        params = dict(parse_qsl(url.query))
+        if request.body:
+            body = request.body.decode() if isinstance(request.body, bytes) else request.body
+            params.update(parse_qsl(body))
+        if request.url.startswith(LONG_POLL_URL):
+            payload = self.long_poll(int(params.get('ts', 0)), float(params.get('wait', 25)))
+        else:
+            method = url.path.rsplit('/', 1)[-1]
+            payload = self.call(method, params)
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps(payload, ensure_ascii=False).encode()
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def long_poll(self, ts, wait):
+        finish = time.monotonic() + wait
+        with self.condition:
+            while self.ts <= ts and not self.stopped:
+                remaining = finish - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            first = len(self.updates) - (self.ts - ts)
+            return {'ts': self.ts, 'updates': self.updates[max(first, 0):]}
+
+    def call(self, method, params):
+        time.sleep(self.latency)
+        token = params.get('access_token')
+        with self.lock:
+            self.calls[method] += 1
+            if self.limited(token) or self.random.random() < self.error_rate:
+                self.errors[method] += 1
+                return {'error': {'error_code': TOO_MANY_REQUESTS, 'error_msg': 'Too many requests per second',
+                                  'request_params': []}}
+        handler = getattr(self, 'api_' + method.replace('.', '_'), None)
+        if handler is None:
+            return {'error': {'error_code': 3, 'error_msg': 'Unknown method passed', 'request_params': []}}
+        return {'response': handler(params)}
+
+    def limited(self, token):
+        limit = self.rate_limits.get(token)
+        if not limit:
+            return False
+        now = time.monotonic()
+        history = self.history[token]
+        while history and history[0] <= now - 1:
+            history.popleft()
+        if len(history) >= limit:
+            return True
+        history.append(now)
+        return False
+
+    def api_groups_getLongPollServer(self, params):
+        with self.lock:
+            return {'key': 'simulator', 'server': LONG_POLL_URL + 'poll', 'ts': self.ts}
+
+    def api_messages_send(self, params):
+        for listener in self.listeners:
+            listener(int(params['user_id']), params)
+        return next(self.message_ids)
+
+    def api_users_get(self, params):
+        result = []
+        for user_id in (int(user_id) for user_id in params['user_ids'].split(',') if user_id.strip()):
+            account = self.users.get(user_id) or self.accounts.get(user_id)
+            if account is None or random.Random(self.seed + user_id).random() < self.deactivated:
+                result.append({'id': user_id, 'first_name': 'DELETED', 'last_name': '', 'deactivated': 'deleted'})
+            elif params.get('fields'):
+                result.append(account)
+            else:
+                result.append({key: account[key] for key in ('id', 'first_name', 'last_name')})
+        return result
+
+    def api_users_search(self, params):
+        return self.search(params)
+
+    def api_execute(self, params):
+        code = params['code']
+        if 'photos.getAll' in code:
+            accounts = json.loads(re.search(r'var accounts = (\[.*?\]);', code).group(1))
+            count = int(re.search(r'count: (\d+)', code).group(1))
+            result = []
+            for account in accounts:
+                photos = self.get_photos(account)
+                result.append({'id': account, 'count': len(photos),
+                               'ids': [photo['id'] for photo in photos[:count]],
+                               'likes': [photo['likes']['count'] for photo in photos[:count]]})
+            return result
+        criteria = {name: int(re.search(rf'{name}: (\d+)', code).group(1))
+                    for name in ('city', 'sex', 'age_from', 'age_to')}
+        if 'var slices' in code:
+            slices = json.loads(re.search(r'var slices = (\[.*?\]);', code).group(1))
+            result = []
+            for shard in slices:
+                found = self.search({**criteria, **shard})
+                result.append({'slice': shard, **found})
+            return result
+        if 'users.search' in code:
+            return [self.search(criteria)]
+        return []
+
+    def search(self, params):
+        year = date.today().year
+        born_from = year - int(params.get('age_to', 99)) - 1
+        born_to = year - int(params.get('age_from', 14))
+        birth_year = int(params.get('birth_year', 0))
+        birth_month = int(params.get('birth_month', 0))
+        items = []
+        for account in self.population[(int(params.get('city', 1)), int(params.get('sex', 1)))]:
+            day, month, born = map(int, account['bdate'].split('.'))
+            if not born_from <= born <= born_to:
+                continue
+            if birth_year and born != birth_year or birth_month and month != birth_month:
+                continue
+            items.append(account)
+        return {'count': len(items), 'items': items[:SEARCH_LIMIT]}
+
+    def get_photos(self, account):
+        rng = random.Random(self.seed * 7919 + account)
+        return [{'id': number,
+                 'owner_id': account,
+                 'likes': {'count': rng.randint(0, 500)},
+                 'sizes': [{'type': 'x', 'url': f'https://sun.vk.local/{account}_{number}.jpg'}]}
+                for number in range(1, rng.randint(*self.photos) + 1)]
@@ -1,13 +1,33 @@
-from datetime import datetime
+import argparse
+import logging
+import os
 import threading
-import queue
-import time
+from datetime import timedelta
+from functools import partial
 
+import sqlalchemy as sq
 
+import metrics
 from bot import Bot, Searcher
-from transformer import form_criteria, filter_by_interests
+from dispatcher import Dispatcher
+from maintenance import Maintenance
+from pipeline import CrawlPipeline, OfferStream, PhotoCache, SearchFlights
+from prefetch import SegmentPrefetcher
+from ratelimit import BACKGROUND
+from state import MemoryStateStore, SqlStateStore
+from transformer import form_criteria, prepare_offer, segment, sort_interests, to_record, warm_up
+from validity import AccountValidator
+from workers import ShardedDispatcher
 from Database import connect
 
+PREFETCH_SIZE = 50      # accounts checked ahead of the suggestion cursor
+FIRST_RESULTS = 10      # the first suggestion is sent as soon as this number of offers is found...
+FIRST_RESULTS_DEADLINE = 2  # ...or this number of seconds has passed and at least one offer is there
+CANDIDATES_LIMIT = 200  # offers taken from the shared pool per dialogue
+DIALOGUE_TIMEOUT = 600
+FAVORITES_PAGE = 20     # favorites listed per message of the 'saved' command
+SEARCH_REPLAY_TTL = 60  # seconds a completed search is replayed to the new dialogues of the segment
+
 
 def listen():
     """
@@ -15,69 +35,154 @@ def listen():
     event_thread(handle_event function) each time an incoming message is received.
     """
     while True:
-        event = bot.listen()
-        if event:
-            if event[0] not in dialogues:
-                dialogues[event[0]] = threading.Event()
-                processed[event[0]] = threading.Event()
+        for event in bot.listen():
+            register(event)
             event_thread = threading.Thread(target=handle_event,
                                             args=(event,))
             event_thread.start()
 
 
+def register(event):
+    """
+    Opens up a dialogue for the sender of the event in the state store, unless it is already open.
+    """
+    store.open(event[0])
+
+
+def dispatch(event):
+    """
+    Event handler for the Dispatcher (asyncio mode): opens up a dialogue and handles the event.
+    """
+    register(event)
+    handle_event(event)
+
+
+def init_worker(number):
+    """
+    Worker process initializer (processes mode). The API clients, the validator and the connection pools
+    inherited from the parent process are replaced with the ones of the worker.
+    """
+    global bot, searcher, validator, dialogues, searches
+    for engine in {connect.engine, state_engine} - {None}:
+        engine.dispose(close=False)
+    bot = Bot(share=rate_share)
+    searcher = Searcher(share=rate_share)
+    validator = AccountValidator(bot.get_users_status, connect.remove_offers)
+    dialogues = {}
+    searches = SearchFlights(search_segment, segment, ttl=SEARCH_REPLAY_TTL)
+    if metrics.enabled:
+        metrics.reset()
+        start_metrics(args.metrics_port + 1 + number if args.metrics_port else 0, args.metrics_interval)
+
+
+def start_metrics(port, interval):
+    """
+    Exposes the metrics of the process at the local HTTP "port" and/or dumps them to the log every "interval" seconds
+    (0 disables either).
+    """
+    metrics.register_gauge('scheduler.group', bot.scheduler.stats)
+    metrics.register_gauge('scheduler.user', searcher.scheduler.stats)
+    metrics.register_gauge('outbox', bot.outbox.stats)
+    if port:
+        metrics.serve(port)
+    if interval:
+        metrics.start_dump(interval)
+
+
+def start_background_jobs():
+    """
+    Starts the jobs running in the background of the main process: the prefetch of the popular segments,
+    the retention job and the metrics endpoint/dump (as configured).
+    In processes mode these are started once the workers have been forked, so the workers don't inherit the threads.
+    """
+    if args.prefetch_segments:
+        background_validator = AccountValidator(partial(bot.get_users_status, priority=BACKGROUND),
+                                                connect.remove_offers)
+        SegmentPrefetcher(searcher, background_validator, segments=args.prefetch_segments).start()
+
+    if args.maintenance_interval:
+        Maintenance(partial(bot.get_users_status, priority=BACKGROUND), retention=timedelta(days=args.retention_days),
+                    interval=args.maintenance_interval).start()
+
+    if metrics.enabled:
+        start_metrics(args.metrics_port, args.metrics_interval)
+
+
 def check_account(user_id):
     """
-    Checks an account validity.
+    Checks an account validity. The status is taken from the validator cache when possible,
+    the deactivated accounts are removed from DB by the validator.
     :return: False, if invalid
              True, if the account is active
     """
-    account = bot.get_users_details(user_id)
-    return not account.get('deactivated')
+    return validator.is_active(user_id)
+
+
+def upcoming(offers_stream, number=PREFETCH_SIZE):
+    """
+    :return: the ids of the first "number" accounts waiting in the stream (the stream is left intact)
+    """
+    return [offer['id'] for offer in offers_stream.peek(number)]
+
+
+def close_dialogue(user_id):
+    """
+    Forgets the dialogue, so that it is started all over again with the next message from the user.
+    """
+    store.close(user_id)
+    dialogues.pop(user_id, None)
+    metrics.funnel_cancel(user_id)
 
 
 def handle_event(event):
     """
     Function analyses the incoming message and acts accordingly:
-        'next': If the memory holds a record of the previously made suggestion, an event flag is set
-                that unblocks the dialogue in the suggest_thread.
+        'next': If the state store holds a record of the previously made suggestion, an event flag is set
+                that unblocks the dialogue in the suggest_thread. If the suggest_thread is not running
+                in this process (e.g. the process has been restarted), it is started again and continues
+                with the offers pending in the cursor of the dialogue.
         If there was no proposal made so far or the text command is not recognized, the following
         algorythm is realized:
                 - receive sender's details
                 - add user to DB (optional)
                 - form search criteria
-                - request relevant records from DB
-                    if at least 10 records found:
-                - start suggest_thread
-                    else:
-                - start suggest_thread
-                - start request_api_thread
+                - request relevant records from the shared pool in DB: the offers of the user's segment
+                  found for any user or prefetched, that haven't been shown to the user (ranked by matching interests)
+                - start suggest_thread, if any records found
+                    if less than FIRST_RESULTS records found:
+                - start request_api_thread, which streams the offers to the suggest_thread as they are found
+                  (and starts it, unless started already). The search is shared with the other users
+                  of the same segment searching at the same time
         'blacklist'/'favorites': Adds a record to blacklist or favorites in DB
         'clear favorites': Clears the favorites list in DB
-        'saved': sends names and link to the page for every record in favorites
+        'saved': sends names and link to the page for every record in favorites, FAVORITES_PAGE records per message
+        'saved more': sends the next page of favorites
     """
     sender_id, text = event
-    offers_queue = queue.Queue()
+    metrics.count('messages')
 
-    if text == 'next' and last_offers.get(sender_id):
-        dialogues[sender_id].set()
+    last_offer = store.get(sender_id, 'last_offer')
+
+    if text == 'next' and last_offer:
+        wake_up = dialogues.get(sender_id)
+        if wake_up:
+            wake_up.set()
+        else:
+            offers_stream = OfferStream(cursor=store.cursor(sender_id))
+            offers_stream.close()
+            suggest_thread = threading.Thread(target=suggest,
+                                              args=(offers_stream, sender_id))
+            suggest_thread.start()
 
     elif text == 'blacklist' or text == 'favorites':
-        if last_offers.get(sender_id):
-            connect.add_black_list(sender_id, last_offers[sender_id]) if text == 'blacklist' \
-                else connect.add_favorite_list(sender_id, last_offers[sender_id])
+        if last_offer:
+            connect.add_black_list(sender_id, last_offer) if text == 'blacklist' \
+                else connect.add_favorite_list(sender_id, last_offer)
             message = f"Пользователь добавлен(а) в {('чёрный список', 'избранное')[text == 'favorites']}."
             bot.say(sender_id, message)
 
-    elif text == 'saved':
-        favorites = connect.get_favorite(sender_id)
-        for favorite in favorites:
-            passed = check_account(favorite['id'])
-            if not passed:
-                connect.remove_records(favorite['id'])
-                continue
-            message = f"{favorite['first_name']} {favorite['last_name']}: " \
-                      f"https://vk.com/id{favorite['id']}\n"
-            bot.say(sender_id, message=message)
+    elif text == 'saved' or text == 'saved more':
+        send_favorites(sender_id, store.get(sender_id, 'saved_cursor') if text == 'saved more' else None)
 
     elif text == 'clear favorites':
         connect.clear_favorites(sender_id)
@@ -85,179 +190,260 @@ def handle_event(event):
 
     else:
 
-        if last_offers.get(sender_id):
+        if last_offer:
             bot.say(sender_id, 'Пожалуйста, используйте кнопки.')
             return
-        elif processed[sender_id].is_set():
+        elif store.get(sender_id, 'processing'):
             bot.say(sender_id, 'Пожалуйста, подождите, обрабатываю Ваш запрос.')
             return
 
-        processed[sender_id].set()
+        store.set(sender_id, 'processing', True)
+        metrics.funnel_start(sender_id)
         details = bot.get_users_details(sender_id)
-        connect.add_user(details['id'],
-                         details['first_name'],
-                         details['last_name'],
-                         details['sex'],
-                         details.get('bdate'),
-                         details.get('city', {}).get('id', 1),
-                         details.get('interests'))
-
-        search_params = form_criteria(details)
+        interests = details.get('interests')
+        saved = connect.get_interests(sender_id)
+        if saved is not None and saved[1] is not None and (saved[0] or '') == (interests or ''):
+            interest_tokens = saved[1]
+        else:
+            interest_tokens = sort_interests(interests or '')
+            connect.add_user(details['id'],
+                             details['first_name'],
+                             details['last_name'],
+                             details['sex'],
+                             details.get('bdate'),
+                             details.get('city', {}).get('id', 1),
+                             details.get('interests'),
+                             interest_tokens)
+
+        search_params = form_criteria(details, interest_tokens)
         if not search_params:
             bot.say(sender_id,
                     'Вы должны установить параметр "пол" в Вашем аккаунте, чтобы пользоваться ботом!')
+            close_dialogue(sender_id)
             return
 
-        offers_from_db = connect.get_offer(search_params, sender_id)
-
-        if offers_from_db and len(offers_from_db) >= 10:
-            filtered = filter_by_interests(search_params, offers_from_db)
+        offers_from_db = connect.get_offer(search_params, sender_id, limit=CANDIDATES_LIMIT, shared=True)
+        offers_stream = OfferStream(offers_from_db, cursor=store.cursor(sender_id))
 
-            for account in filtered:
-                offers_queue.put(account)
-            suggest_thread = threading.Thread(target=suggest,
-                                              args=(offers_queue, sender_id))
-            suggest_thread.start()
+        if len(offers_from_db) >= FIRST_RESULTS:
+            offers_stream.close()
         else:
+            exclude = connect.get_linked_offers(sender_id) | {offer['id'] for offer in offers_from_db}
             request_api_thread = threading.Thread(target=get_accounts_from_api,
-                                                  args=(search_params, sender_id, offers_queue))
+                                                  args=(search_params, sender_id, offers_stream, exclude,
+                                                        bool(offers_from_db)))
             request_api_thread.start()
+        if offers_from_db:
+            suggest_thread = threading.Thread(target=suggest,
+                                              args=(offers_stream, sender_id))
+            suggest_thread.start()
 
 
-def get_accounts_from_api(search_params, sender_id, offers_queue):
+def send_favorites(user_id, cursor=None):
     """
-    Function requests the API for accounts matching the "search_params".
-    Then recursively requests for a list of albums and photos in each of the albums.
-    In case at least three photos are present, saves the account to DB and adds it up
-    to the queue that is used by the suggest_thread for making proposals while the search is
-    still in progress.
+    Sends a page of the user's favorites in a single message: FAVORITES_PAGE records after the "cursor"
+    (from the beginning of the list, if None). The accounts of the page are verified in bulk, the deactivated
+    ones are skipped. If the list goes on, the keyboard gets the "saved more" button and the cursor of the page
+    is kept in the state store.
     """
-    def add_to_db(accounts):
-        counter = 0
-
-        for account in accounts:
-
-            offer_id = account['id']
-            raw = searcher.get_photos_and_details(offer_id, )
-            if isinstance(raw, Exception):
-                return counter
-            try:
-                raw = sum(raw, [])
-            except TypeError:
-                continue
-                
-
-            photos = {photo['sizes'][-1]['url']: photo['likes']['count'] for photo in raw}
-            photos = [pair[0] for pair in sorted(photos.items(), key=lambda x: x[1])][:3]
-            if len(photos) < 3:
-                continue
+    page = connect.get_favorite(user_id, after=cursor or 0, limit=FAVORITES_PAGE + 1)
+    more = len(page) > FAVORITES_PAGE
+    page = page[:FAVORITES_PAGE]
+    if not page:
+        bot.say(user_id, 'Список "Избранное" пуст.' if cursor is None else 'Больше в "Избранном" никого нет.',
+                keyboard=bot.keyboard())
+        store.set(user_id, 'saved_cursor', None)
+        return
+
+    statuses = validator.check([favorite['id'] for favorite in page])
+    lines = [f"{favorite['first_name']} {favorite['last_name']}: https://vk.com/id{favorite['id']}"
+             for favorite in page if statuses[favorite['id']]]
+    message = '\n'.join(lines) or 'Страницы этих пользователей удалены.'
+    bot.say(user_id, message, keyboard=bot.keyboard(saved_more=more))
+    store.set(user_id, 'saved_cursor', page[-1]['cursor'] if more else None)
+
+
+def get_accounts_from_api(search_params, sender_id, offers_stream, exclude=frozenset(), suggesting=False):
+    """
+    Function subscribes the stream to the search of the accounts matching the "search_params" (see search_segment).
+    The search is shared by the dialogues of the same segment (city, sex, age band): if another user of the segment
+    has started it a moment ago, the dialogue joins it and receives the accounts found so far and the following ones,
+    a search completed within SEARCH_REPLAY_TTL seconds is not repeated but replayed.
+    The accounts from "exclude" (already in the stream, shown before, blacklisted or saved to favorites) are skipped.
+    The stream is closed once the search is over.
+    The suggest_thread is started with the first accounts found, unless it is "suggesting" already.
+    """
+    flight = searches.join(search_params, offers_stream, exclude)
+    if suggesting:
+        return
+    if flight.wait_found():
+        suggest_thread = threading.Thread(target=suggest,
+                                          args=(offers_stream, sender_id))
+        suggest_thread.start()
+    elif flight.failure:
+        bot.say(sender_id, 'На сегодня я израсходовал лимиты поиска, возвращайтесь завтра!')
+        close_dialogue(sender_id)
+    else:
+        suggest(offers_stream, sender_id)
 
-            first_name = f"{account['first_name']}"
-            last_name = f"{account['last_name']}"
 
-            if not all([account.get('bdate'), account.get('city'), account.get('sex')]):
-                continue
-            else:
-                bdate = account['bdate']
-                city = account['city']
-                sex = account['sex']
-
-            try:
-                bdate = datetime.strptime(bdate, '%d.%m.%Y').date()
-            except ValueError:
+def search_segment(search_params, flight):
+    """
+    Function requests the API for accounts matching the "search_params". The search is sharded by birth dates
+    to find more than 1000 accounts, the accounts of every shard are passed to the crawl as soon as the shard
+    is received.
+    The crawl (pipeline.CrawlPipeline) requests the most liked photos of the accounts concurrently, packing up to
+    "searcher.batch_size" accounts into a single execute request. The photo sets of the offers already on file
+    are taken from DB instead, unless expired. The accounts having at least three photos
+    are saved to DB in bulk and put to the flight (pipeline.SearchFlight), that passes them on to the streams
+    of the dialogues waiting for the search, in the order the accounts have been found.
+    The search and the crawl stop when all the streams are cancelled (the dialogues are over) or the API fails.
+    The offers are not linked to the users until they are shown.
+    :return: the API error the search or the crawl has failed with OR None
+    """
+    def save(offers):
+        connect.add_offers(None, [to_record(offer) for offer in offers])
+
+    fetch = PhotoCache(searcher.get_top_photos_batch, connect.get_photo_sets)
+    crawl = CrawlPipeline(fetch, prepare_offer, save, flight,
+                          batch_size=searcher.batch_size, fetchers=searcher.crawl_workers)
+    failure = None
+    try:
+        for accounts in searcher.search_users_sharded(search_params):
+            if isinstance(accounts, Exception):
+                failure = accounts
                 continue
+            flight.mark_found()
+            if not crawl.submit(accounts):
+                break
+    finally:
+        crawl.close()
+    return failure or crawl.failure
 
-            interests = account.get('interests', '')
-
-            connect.add_offer(sender_id,
-                              offer_id,
-                              first_name,
-                              last_name,
-                              sex,
-                              bdate,
-                              city['id'],
-                              interests)
-            connect.add_photo(offer_id, photos)
-            counter += 1
-            offers_queue.put({'id': offer_id,
-                              'first_name': first_name,
-                              'last_name': last_name,
-                              'sex': sex,
-                              'bdate': bdate,
-                              'city': city,
-                              'interests': interests,
-                              'photos': photos})
-
-        return counter
-
-    api_search_result = searcher.search_users(search_params)
-    if isinstance(api_search_result, Exception):
-        bot.say(sender_id, 'На сегодня я израсходовал лимиты поиска, возвращайтесь завтра!')
-        return    
-    suggest_thread = threading.Thread(target=suggest,
-                                      args=(offers_queue, sender_id))
-    suggest_thread.start()
-    count = add_to_db(api_search_result)
-        
-        
-def suggest(offers_queue, user_id):
+
+def suggest(offers_stream, user_id):
     """
-    Function checks if the queue with accounts has at least 10 elements and starts sending proposals
-    to the interlocutor.
+    Function waits until the stream with accounts has at least FIRST_RESULTS elements (or FIRST_RESULTS_DEADLINE
+    passes) and starts sending proposals to the interlocutor as soon as there is anything to offer.
     Before sending a message it checks if the suggested user is valid (not deactivated) and removes it
-    from DB otherwise.
-    After sending a message it awaits for the "next" command to continue offering from the queue.
+    from DB otherwise. The accounts next in the stream are checked in bulk in the background,
+    so that their status is already known when they are due.
+    After sending a message it awaits for the "next" command to continue offering from the stream.
     In case there is no message from user for over 10 minutes it finshes the dialogue (to be started all
-    over again, when user comes back next time)
-    In case the queue runs empty, the user receives a notice and is suggested to come back later.
+    over again, when user comes back next time) and cancels the stream, so that the search for the user stops.
+    In case the stream is over, the user receives a notice and is suggested to come back later.
+    The dialogue is finished and the stream is cancelled in case of an error as well.
     """
-    while True:
-        if offers_queue.qsize() >= 10:
-            break
-        time.sleep(1)
-
     def suggest():
+        """
+        :return: True, if a suggestion has been sent
+                 False, if the stream is over
+        """
         passed = False
         while not passed:
-            suggestion = offers_queue.get()
+            suggestion = offers_stream.get()
+            if suggestion is None:
+                return False
             passed = check_account(suggestion['id'])
-            if not passed:
-                connect.remove_records(suggestion['id'])
+        validator.prefetch(upcoming(offers_stream))
 
         name = f"{suggestion['first_name']} {suggestion['last_name']}"
         link = f"https://vk.com/id{suggestion['id']}"
         photos = suggestion['photos']
         bot.suggest(user_id, name, link, photos)
-        last_offers[user_id] = suggestion['id']
-
-    suggest()
-    while offers_queue.qsize() > 0:
-        if dialogues[user_id].wait(timeout=600):
-            dialogues[user_id].clear()
-            suggest()
-            if offers_queue.qsize() == 0:
-                message = "Предложений больше нет. Возвращайтесь в другой раз!"
-                bot.say(user_id, message)
-            continue
-
-        del(dialogues[user_id])
-        del(last_offers[user_id])
-        del(processed[user_id])
-        break
-    
-        
+        metrics.funnel_done(user_id)
+        metrics.count('suggestions')
+        connect.link_offer(user_id, suggestion['id'])
+        store.set(user_id, 'last_offer', suggestion['id'])
+        return True
+
+    wake_up = dialogues.setdefault(user_id, threading.Event())
+    try:
+        offers_stream.wait_ready(FIRST_RESULTS, FIRST_RESULTS_DEADLINE)
+        validator.check(upcoming(offers_stream))
+
+        if not suggest():
+            bot.say(user_id, "К сожалению, я не нашел подходящих предложений. Возвращайтесь в другой раз!")
+        else:
+            while wake_up.wait(timeout=DIALOGUE_TIMEOUT):
+                wake_up.clear()
+                if not suggest():
+                    message = "Предложений больше нет. Возвращайтесь в другой раз!"
+                    bot.say(user_id, message)
+                    break
+    finally:
+        offers_stream.cancel()
+        close_dialogue(user_id)
+
+
 if __name__ == '__main__':
-    bot = Bot()
-    searcher = Searcher()
-    accounts = []
-    dialogues = {}
-    last_offers = {}
-    processed = {}
-    
+    parser = argparse.ArgumentParser(description='VKinder chatbot')
+    parser.add_argument('--mode', choices=('asyncio', 'threads', 'processes'), default='asyncio',
+                        help='asyncio: a single event loop with a bounded pool of handlers; '
+                             'threads: a new thread for every incoming message; '
+                             'processes: a long poll reader routing the messages to worker processes by sender')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='the number of messages handled at the same time in asyncio mode '
+                             '(in every worker process in processes mode)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='the number of worker processes in processes mode')
+    parser.add_argument('--state', choices=('memory', 'database'), default='memory',
+                        help='memory: the dialogues are kept in the memory of the process; '
+                             'database: the dialogues are kept in a database shared by several bot processes '
+                             'and survive restarts')
+    parser.add_argument('--state-url', default=None,
+                        help='SQLAlchemy URL of the database for the dialogues (e.g. sqlite:///state.db), '
+                             'the application database by default')
+    parser.add_argument('--prefetch-segments', type=int, default=20,
+                        help='the number of the most popular segments (city, sex, age band) to keep warm pools of '
+                             'offers for; 0 disables prefetching')
+    parser.add_argument('--maintenance-interval', type=float, default=86400,
+                        help='seconds between the runs of the retention job (verification of the stale offers, '
+                             'eviction of the offers not shown for long, pruning of the photos); 0 disables the job')
+    parser.add_argument('--retention-days', type=float, default=30,
+                        help='offers not shown to anyone for this number of days are evicted')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve the metrics as JSON at http://127.0.0.1:PORT/ (the worker processes '
+                             'in processes mode use the following ports); 0 disables the endpoint')
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help='dump the metrics to the log every METRICS_INTERVAL seconds; 0 disables the dump')
+    args = parser.parse_args()
+
+    # the API rate limits are divided among the processes making requests: the workers and the main process
+    # running the background jobs
+    background_jobs = bool(args.prefetch_segments or args.maintenance_interval)
+    rate_share = args.processes + background_jobs if args.mode == 'processes' else 1
+    bot = Bot(share=rate_share)
+    searcher = Searcher(share=rate_share)
+    validator = AccountValidator(bot.get_users_status, connect.remove_offers)
+    dialogues = {}      # wake-up flags of the suggest_threads running in this process
+    searches = SearchFlights(search_segment, segment, ttl=SEARCH_REPLAY_TTL)     # the searches in this process
+
     connect.create_tables()
-    
+
+    state_engine = None
+    if args.state == 'database':
+        state_engine = sq.create_engine(args.state_url) if args.state_url else connect.engine
+        store = SqlStateStore(state_engine, timeout=DIALOGUE_TIMEOUT)
+    else:
+        store = MemoryStateStore(timeout=DIALOGUE_TIMEOUT)
+
+    if args.metrics_port or args.metrics_interval:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(name)s %(levelname)s %(message)s')
+        metrics.enable()
+
     bot.get_server()
-    
-    listen_thread = threading.Thread(target=listen)
-    listen_thread.start()
 
+    # the worker processes share the analyzer preloaded before fork, otherwise it is loaded in the background
+    # while the bot is already listening
+    warm_up(background=args.mode != 'processes')
+    if args.mode != 'processes':
+        start_background_jobs()
+    if args.mode == 'asyncio':
+        Dispatcher(bot.listen, dispatch, max_workers=args.workers).run()
+    elif args.mode == 'processes':
+        ShardedDispatcher(bot.listen, dispatch, args.processes, initializer=init_worker,
+                          max_workers=args.workers, on_start=start_background_jobs).run()
+    else:
+        listen_thread = threading.Thread(target=listen)
+        listen_thread.start()
@@ -0,0 +1,155 @@
+import argparse
+import logging
+import threading
+import time
+from datetime import timedelta
+from functools import partial
+
+import metrics
+from transformer import sort_interests
+from Database import connect
+
+
+logger = logging.getLogger(__name__)
+
+
+class Maintenance:
+    """
+    Background retention job keeping the offer, user_offer and photo tables compact:
+        verify: the accounts of the offers not verified for "recheck" are checked in bulk,
+                the deactivated ones are removed
+        evict: the offers not shown to anyone for "retention" are evicted (the ones saved to favorites
+               or blacklisted by somebody are kept): the ones never shown are removed, the photos of the others
+               are removed, while the links keep the record of whom they have been shown to
+        prune: the photo records of no use are removed
+        tokenize: the interests of the offers saved before the interest tokens were introduced are analysed,
+                  so that the offers are ranked by the matching interests
+    Everything is done in chunks of "chunk" rows, one short transaction (and at most one API request) per chunk,
+    with a pause of "pause" seconds between the chunks, so that the job never holds the tables or the API
+    for long. The API requests are made with background priority.
+    fetch_status: a callable taking a list of ids and returning {id: True if active, False otherwise}
+                  (Bot.get_users_status)
+    interval: seconds between the runs
+    verify_limit: the maximum number of offers verified per run
+    """
+
+    def __init__(self, fetch_status, recheck=timedelta(days=7), retention=timedelta(days=30), chunk=500, pause=1,
+                 interval=86400, verify_limit=20000):
+        self.fetch_status = fetch_status
+        self.recheck = recheck
+        self.retention = retention
+        self.chunk = chunk
+        self.pause = pause
+        self.interval = interval
+        self.verify_limit = verify_limit
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name='maintenance', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('maintenance failed')
+
+    def run_once(self):
+        """
+        :return: {'verified': int - the number of offers verified,
+                  'deactivated': int - the number of offers removed as deactivated,
+                  'evicted': int - the number of offers evicted as not shown for too long,
+                  'photos': int - the number of photo records removed,
+                  'tokenized': int - the number of offers the interests of which have been analysed}
+        """
+        verified, deactivated = self.verify()
+        report = {'verified': verified, 'deactivated': deactivated, 'evicted': self.evict(), 'photos': self.prune(),
+                  'tokenized': self.tokenize()}
+        for name, rows in report.items():
+            metrics.count(f'maintenance.{name}', rows)
+        logger.info('maintenance: %s offers verified, %s deactivated removed, %s evicted, %s photos pruned, '
+                    '%s offers tokenized', *report.values())
+        return report
+
+    def verify(self):
+        """
+        :return: the number of offers verified, the number of the deactivated ones removed
+        """
+        verified = deactivated = 0
+        while verified < self.verify_limit and not self.stopped.is_set():
+            offers = connect.get_unchecked_offers(self.recheck, min(self.chunk, self.verify_limit - verified))
+            if not offers:
+                break
+            statuses = self.fetch_status(offers)
+            if not statuses:
+                break
+            inactive = [offer for offer, active in statuses.items() if not active]
+            if inactive:
+                connect.remove_offers(inactive)
+            connect.mark_checked([offer for offer, active in statuses.items() if active])
+            verified += len(statuses)
+            deactivated += len(inactive)
+            self.stopped.wait(self.pause)
+        return verified, deactivated
+
+    def evict(self):
+        return self._in_chunks(partial(connect.evict_offers, self.retention))
+
+    def prune(self):
+        return self._in_chunks(connect.prune_photos)
+
+    def tokenize(self):
+        return self._in_chunks(self._tokenize_chunk)
+
+    @staticmethod
+    def _tokenize_chunk(limit):
+        """
+        :return: the number of offers the interests of which have been analysed
+        """
+        offers = connect.get_untokenized_offers(limit)
+        if offers:
+            connect.set_interest_tokens({offer_id: sort_interests(interest or '') for offer_id, interest in offers})
+        return len(offers)
+
+    def _in_chunks(self, step):
+        """
+        Calls step(chunk) until it processes less than a chunk.
+        :return: the total number of rows processed
+        """
+        total = 0
+        while not self.stopped.is_set():
+            processed = step(self.chunk)
+            total += processed
+            if processed < self.chunk:
+                break
+            self.stopped.wait(self.pause)
+        return total
+
+
+if __name__ == '__main__':
+    from bot import Bot
+    from ratelimit import BACKGROUND
+
+    parser = argparse.ArgumentParser(description='VKinder database maintenance: a single run of the retention job')
+    parser.add_argument('--retention-days', type=float, default=30,
+                        help='offers not shown to anyone for this number of days are removed')
+    parser.add_argument('--recheck-days', type=float, default=7,
+                        help='offers not verified for this number of days are verified again')
+    parser.add_argument('--chunk', type=int, default=500, help='rows per transaction')
+    parser.add_argument('--pause', type=float, default=1, help='seconds between the chunks')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    connect.create_tables()
+    bot = Bot()
+    job = Maintenance(partial(bot.get_users_status, priority=BACKGROUND),
+                      recheck=timedelta(days=args.recheck_days), retention=timedelta(days=args.retention_days),
+                      chunk=args.chunk, pause=args.pause)
+    start = time.monotonic()
+    report = job.run_once()
+    print(f'{report["verified"]} offers verified, {report["deactivated"]} deactivated removed, '
+          f'{report["evicted"]} evicted, {report["photos"]} photos pruned, {report["tokenized"]} offers tokenized '
+          f'in {time.monotonic() - start:.1f} s')
@@ -0,0 +1,221 @@
+"""
+Built-in instrumentation: timers and counters around the stages of the message handling
+(long poll, users.get, users.search, the photo crawl, morphological analysis, DB calls) and the per-user
+funnel from the first message to the first suggestion.
+The metrics are off by default: a timed function then costs a single flag check per call.
+Once enabled, the metrics are available as JSON from a local HTTP endpoint (serve) and/or dumped
+to the log periodically (start_dump).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+SAMPLES = 1000      # the latest timings kept per timer for the percentiles
+MAX_FUNNELS = 10000     # dialogues tracked by the funnel at the same time, the oldest ones are dropped beyond
+
+enabled = False
+_lock = threading.Lock()
+_timings = defaultdict(lambda: deque(maxlen=SAMPLES))
+_totals = defaultdict(lambda: [0, 0.0, 0.0])   # name: [count, total seconds, max seconds]
+_counters = defaultdict(int)
+_funnels = {}
+_gauges = {}
+_disabled = nullcontext()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def observe(name, seconds):
+    """
+    Records a timing of the "name" stage.
+    """
+    with _lock:
+        _timings[name].append(seconds)
+        totals = _totals[name]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+
+
+def count(name, value=1):
+    if enabled:
+        with _lock:
+            _counters[name] += value
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+def timer(name):
+    """
+    Context manager timing the enclosed block as the "name" stage.
+    """
+    return _Timer(name) if enabled else _disabled
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function as the "name" stage.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def funnel_start(user_id):
+    """
+    Marks the first message of a dialogue.
+    """
+    if enabled:
+        with _lock:
+            _funnels.setdefault(user_id, time.perf_counter())
+            if len(_funnels) > MAX_FUNNELS:
+                del _funnels[next(iter(_funnels))]
+
+
+def funnel_done(user_id, stage='funnel.first_suggestion'):
+    """
+    Records the time passed since the first message of the dialogue as the "stage" timing.
+    """
+    if enabled:
+        with _lock:
+            start = _funnels.pop(user_id, None)
+        if start is not None:
+            observe(stage, time.perf_counter() - start)
+
+
+def funnel_cancel(user_id):
+    """
+    Forgets the dialogue that is over without a suggestion (nothing found, the search has failed, etc.).
+    """
+    if enabled:
+        with _lock:
+            _funnels.pop(user_id, None)
+
+
+def register_gauge(name, func):
+    """
+    func() is called on every snapshot, its (json serializable) return is reported as the "name" gauge,
+    e.g. the stats of a Scheduler.
+    """
+    _gauges[name] = func
+
+
+def percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+def snapshot():
+    """
+    :return: {'pid': int,
+              'timers': {name: {'count': int, 'total': float, 'max': float, 'p50': float, 'p95': float, 'p99': float}},
+              'counters': {name: int},
+              'gauges': {name: any}}
+              The timings are in seconds, the percentiles are taken over the latest SAMPLES timings.
+    """
+    with _lock:
+        timings = {name: sorted(samples) for name, samples in _timings.items()}
+        totals = {name: list(totals) for name, totals in _totals.items()}
+        counters = dict(_counters)
+    timers = {}
+    for name, ordered in timings.items():
+        calls, total, longest = totals[name]
+        timers[name] = {'count': calls, 'total': round(total, 6), 'max': round(longest, 6),
+                        **{f'p{round(share * 100)}': round(percentile(ordered, share), 6)
+                           for share in (0.5, 0.95, 0.99)}}
+    gauges = {}
+    for name, func in list(_gauges.items()):
+        try:
+            gauges[name] = func()
+        except Exception as e:
+            gauges[name] = repr(e)
+    return {'pid': os.getpid(), 'timers': timers, 'counters': counters, 'gauges': gauges}
+
+
+def reset():
+    """
+    Forgets the collected metrics, e.g. in a forked worker process.
+    """
+    with _lock:
+        _timings.clear()
+        _totals.clear()
+        _counters.clear()
+        _funnels.clear()
+
+
+def _forget_lock():
+    """
+    A process forked while another thread of the parent holds the lock would wait for it forever.
+    """
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_lock)
+
+
+def start_dump(interval):
+    """
+    Logs a snapshot every "interval" seconds in a background thread.
+    """
+    def dump():
+        while True:
+            time.sleep(interval)
+            logger.info('metrics %s', json.dumps(snapshot(), ensure_ascii=False))
+
+    threading.Thread(target=dump, name='metrics-dump', daemon=True).start()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps(snapshot(), ensure_ascii=False, indent=2).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    """
+    Serves the snapshot as JSON at http://host:port/ in a background thread.
+    :return: the server
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
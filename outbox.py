@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from vk_api.exceptions import ApiHttpError
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT_ERRORS = {1, 6, 9, 10}    # vk.com API error codes: unknown, too many requests, flood control, server error
+
+
+def is_transient(error):
+    """
+    :return: True, if the request that has raised the error is worth retrying: the API errors from
+             TRANSIENT_ERRORS and the network errors
+    """
+    return isinstance(error, (requests.RequestException, ApiHttpError)) \
+        or getattr(error, 'code', None) in TRANSIENT_ERRORS
+
+
+def new_random_id():
+    return random.randint(-2147483648, 2147483647)
+
+
+class Outbox:
+    """
+    Asynchronous delivery of the outgoing messages. The messages are queued and sent by "workers" dedicated threads,
+    so that the dialogues never wait for messages.send.
+    The messages to the same recipient are sent one at a time in the order they have been queued,
+    the messages to different recipients are sent concurrently.
+    A message failed with a transient error is retried with an exponential backoff, up to "max_retries" times;
+    the other messages of the recipient wait meanwhile. Every message gets its random_id once, when queued,
+    so a retry of a message that has actually been delivered is dropped by vk.com as a duplicate.
+    send: a callable sending a message, takes the messages.send parameters as keyword arguments (Bot.send_message)
+    """
+
+    def __init__(self, send, workers=4, max_retries=5, backoff=1, max_backoff=30):
+        self.send = send
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        self.queues = {}        # recipient: deque of the messages, the one being sent first
+        self.ready = deque()    # recipients, the first message of which is due to be sent
+        self.delayed = []       # (due time, number, recipient) of the messages waiting for a retry
+        self.numbers = itertools.count()
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        for number in range(workers):
+            threading.Thread(target=self._work, name=f'outbox-{number}', daemon=True).start()
+
+    def put(self, recipient, **params):
+        """
+        Queues a message to the recipient.
+        params: the messages.send parameters except user_id and random_id
+        """
+        message = {'params': {**params, 'user_id': recipient, 'random_id': new_random_id()}, 'attempts': 0}
+        with self.condition:
+            queue = self.queues.setdefault(recipient, deque())
+            queue.append(message)
+            if len(queue) == 1:
+                self.ready.append(recipient)
+                self.condition.notify()
+
+    def stats(self):
+        """
+        :return: {'queued': int - the number of messages waiting to be sent,
+                  'sent': int, 'retried': int, 'dropped': int}
+        """
+        with self.condition:
+            return {'queued': sum(len(queue) for queue in self.queues.values()),
+                    'sent': self.sent, 'retried': self.retried, 'dropped': self.dropped}
+
+    def _next(self):
+        """
+        Blocks until a message is due to be sent.
+        :return: the recipient, the message
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self.ready.append(heapq.heappop(self.delayed)[2])
+                if self.ready:
+                    recipient = self.ready.popleft()
+                    return recipient, self.queues[recipient][0]
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def _work(self):
+        while True:
+            recipient, message = self._next()
+            try:
+                self.send(**message['params'])
+                delivered = True
+            except Exception as e:
+                delivered = False
+                if is_transient(e) and message['attempts'] < self.max_retries:
+                    self._retry(recipient, message)
+                    continue
+                logger.warning('message to %s dropped after %s attempts: %r', recipient, message['attempts'] + 1, e)
+            with self.condition:
+                if delivered:
+                    self.sent += 1
+                else:
+                    self.dropped += 1
+                    metrics.count('outbox.dropped')
+                queue = self.queues[recipient]
+                queue.popleft()
+                if queue:
+                    self.ready.append(recipient)
+                    self.condition.notify()
+                else:
+                    del self.queues[recipient]
+
+    def _retry(self, recipient, message):
+        delay = min(self.backoff * 2 ** message['attempts'], self.max_backoff)
+        metrics.count('outbox.retries')
+        with self.condition:
+            message['attempts'] += 1
+            self.retried += 1
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.numbers), recipient))
+            self.condition.notify()
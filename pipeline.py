@@ -0,0 +1,419 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from state import MemoryCursor
+
+
+logger = logging.getLogger(__name__)
+
+
+class OfferStream:
+    """
+    Producer/consumer stream of offers prepared for a single user.
+    The producer (get_accounts_from_api) puts the offers as they are found and closes the stream
+    when the search is over. The consumer (suggest) is woken up as soon as an offer is available
+    or the end of stream is reached, no polling is involved. The consumer cancels the stream when
+    the dialogue is over, so that the producer stops searching for the offers nobody is waiting for.
+    The offers are kept in a cursor of a state store (in the memory of the process by default).
+    """
+
+    def __init__(self, offers=(), cursor=None):
+        self.offers = MemoryCursor() if cursor is None else cursor
+        self.offers.extend(offers)
+        self.closed = False
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.offers)
+
+    def put(self, offer):
+        self.extend([offer])
+
+    def extend(self, offers):
+        with self.condition:
+            self.offers.extend(offers)
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        End-of-stream signal: no more offers are going to be put.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def cancel(self):
+        """
+        Signal from the consumer: no more offers are going to be taken.
+        """
+        with self.condition:
+            self.cancelled = True
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait_for_room(self, limit):
+        """
+        Blocks while the stream holds "limit" offers or more, that is while the producer is far enough ahead
+        of the consumer.
+        :return: False, if the stream has been cancelled
+        """
+        with self.condition:
+            while len(self.offers) >= limit and not self.cancelled:
+                self.condition.wait()
+            return not self.cancelled
+
+    def wait_ready(self, threshold, deadline):
+        """
+        Blocks until at least "threshold" offers are available, the stream is closed
+        or "deadline" seconds have passed, whichever comes first.
+        :return: the number of offers available
+        """
+        finish = time.monotonic() + deadline
+        with self.condition:
+            while len(self.offers) < threshold and not self.closed:
+                remaining = finish - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return len(self.offers)
+
+    def get(self, timeout=None):
+        """
+        Takes the next offer, waiting for one to be put if necessary.
+        :return: the offer
+             OR: None, if the stream is over or no offer has been put within "timeout" seconds
+        """
+        finish = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                offer = self.offers.pop()
+                if offer is not None:
+                    self.condition.notify_all()
+                    return offer
+                if self.closed:
+                    return None
+                remaining = None if finish is None else finish - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def peek(self, number):
+        """
+        :return: the first "number" offers in the stream (the stream is left intact)
+        """
+        with self.condition:
+            return self.offers.peek(number)
+
+
+class CrawlPipeline:
+    """
+    Concurrent crawl of the accounts found by the search, feeding an OfferStream (or a SearchFlight):
+        fetch stage: the photos of the accounts are requested in batches of "batch_size" accounts,
+                     up to "fetchers" batches at the same time
+        write stage: a single writer prepares the offers of the fetched batches and saves them to DB,
+                     all the batches fetched by then in one transaction, then puts the offers to the stream
+                     in the order the accounts have been submitted
+    Backpressure: submit() blocks while "max_pending" batches are being fetched or waiting to be written,
+    and while the stream holds "max_buffered" offers not taken by the consumer.
+    The crawl is cancelled when the stream is cancelled (the dialogue is over), a batch could not be fetched
+    (e.g. the API limits are exhausted) or the offers could not be written: the batches not fetched yet are dropped.
+    fetch: [account_id, ...] -> {account_id: photos OR None} OR Exception
+    prepare: (account, photos) -> offer OR None
+    save: [offer, ...] -> None
+    """
+
+    def __init__(self, fetch, prepare, save, stream, batch_size=25, fetchers=3, max_pending=6, max_buffered=100):
+        self.fetch = fetch
+        self.prepare = prepare
+        self.save = save
+        self.stream = stream
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.executor = ThreadPoolExecutor(max_workers=fetchers, thread_name_prefix='crawl')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.finished = False
+        self.failure = None
+        self.found = 0
+        self.writer = threading.Thread(target=self._write, name='crawl-writer', daemon=True)
+        self.writer.start()
+
+    @property
+    def cancelled(self):
+        return self.failure is not None or self.stream.cancelled
+
+    def submit(self, accounts):
+        """
+        Queues the accounts for fetching.
+        :return: False, if the crawl has been cancelled
+        """
+        for start in range(0, len(accounts), self.batch_size):
+            batch = accounts[start:start + self.batch_size]
+            if not self.stream.wait_for_room(self.max_buffered):
+                return False
+            while not self.slots.acquire(timeout=1):
+                if self.cancelled:
+                    return False
+            if self.cancelled:
+                self.slots.release()
+                return False
+            future = self.executor.submit(self.fetch, [account['id'] for account in batch])
+            with self.condition:
+                self.pending.append((batch, future))
+                self.condition.notify_all()
+            future.add_done_callback(self._notify)
+        return not self.cancelled
+
+    def close(self):
+        """
+        Waits until the submitted batches are written (or dropped, if the crawl has been cancelled).
+        :return: the number of offers found
+        """
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+        self.writer.join()
+        self.executor.shutdown(cancel_futures=True)
+        return self.found
+
+    def _notify(self, future):
+        with self.condition:
+            self.condition.notify_all()
+
+    def _write(self):
+        while True:
+            with self.condition:
+                while not (self.pending and self.pending[0][1].done()) and not (self.finished and not self.pending):
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                fetched = []
+                while self.pending and self.pending[0][1].done():
+                    fetched.append(self.pending.popleft())
+            for _ in fetched:
+                self.slots.release()
+            try:
+                self._write_batches(fetched)
+            except Exception as e:
+                logger.exception('failed to write the crawled offers')
+                self.failure = e
+            if self.cancelled:
+                self._drop()
+
+    def _write_batches(self, fetched):
+        """
+        Prepares the offers of the fetched batches, saves them to DB in one go and puts them to the stream.
+        """
+        offers = []
+        for batch, future in fetched:
+            if self.cancelled or future.cancelled():
+                continue
+            try:
+                photos = future.result()
+            except Exception as e:
+                photos = e
+            if isinstance(photos, Exception):
+                self.failure = photos
+                continue
+            offers.extend(offer for offer in (self.prepare(account, photos.get(account['id']))
+                                              for account in batch) if offer)
+        if offers and not self.cancelled:
+            self.save(offers)
+            self.stream.extend(offers)
+            self.found += len(offers)
+
+    def _drop(self):
+        """
+        Drops the batches that haven't been fetched yet.
+        """
+        with self.condition:
+            for batch, future in self.pending:
+                future.cancel()
+
+
+class PhotoCache:
+    """
+    Photo fetch (the "fetch" stage of CrawlPipeline) that takes the photo sets of the offers already on file
+    from DB, so that only the accounts new to the bot or the expired photo sets are crawled.
+    fetch: [account_id, ...] -> {account_id: photos OR None} OR Exception - the API request
+    lookup: [account_id, ...] -> {account_id: photos} - the photo sets on file that haven't expired
+    """
+
+    def __init__(self, fetch, lookup):
+        self.fetch = fetch
+        self.lookup = lookup
+
+    def __call__(self, accounts):
+        cached = self.lookup(accounts)
+        missing = [account for account in accounts if account not in cached]
+        if not missing:
+            return cached
+        fetched = self.fetch(missing)
+        if isinstance(fetched, Exception):
+            return fetched
+        return {**fetched, **cached}
+
+
+class SearchFlight:
+    """
+    A search shared by the dialogues of the same segment. The flight stands for the stream of the CrawlPipeline
+    of the search: the offers found are put to the streams of all the subscribed dialogues (except the offers
+    excluded by a dialogue), a dialogue subscribed later receives the offers found by then first.
+    The streams are closed when the search is over. The search is cancelled when all the subscribed streams are
+    cancelled (the flight is abandoned then and takes no more subscribers).
+    """
+    poll = 0.5      # seconds between the checks of the streams for room, the consumers don't notify the flight
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.subscribers = []   # (stream, exclude)
+        self.offers = []
+        self.found = False
+        self.closed = False
+        self.abandoned = False
+        self.failure = None
+        self.finished = None
+
+    @property
+    def cancelled(self):
+        with self.condition:
+            return self._abandoned()
+
+    def _abandoned(self):
+        if not self.closed and self.subscribers and all(stream.cancelled for stream, _ in self.subscribers):
+            self.abandoned = True
+        return self.abandoned
+
+    def subscribe(self, stream, exclude=frozenset()):
+        """
+        Puts the offers found so far to the stream and subscribes it to the following ones.
+        exclude: the ids of the offers not to be put to the stream
+        :return: False, if the flight has been abandoned
+        """
+        with self.condition:
+            if self._abandoned():
+                return False
+            stream.extend([offer for offer in self.offers if offer['id'] not in exclude])
+            if self.closed:
+                stream.close()
+            else:
+                self.subscribers.append((stream, exclude))
+            return True
+
+    def mark_found(self):
+        """
+        Signal from the search: the first accounts have been found.
+        """
+        with self.condition:
+            self.found = True
+            self.condition.notify_all()
+
+    def wait_found(self):
+        """
+        Blocks until the search finds the first accounts or is over.
+        :return: True, if any accounts have been found
+        """
+        with self.condition:
+            while not self.found and not self.closed:
+                self.condition.wait()
+            return self.found
+
+    def extend(self, offers):
+        with self.condition:
+            self.offers.extend(offers)
+            for stream, exclude in self.subscribers:
+                if not stream.cancelled:
+                    stream.extend([offer for offer in offers if offer['id'] not in exclude])
+
+    def wait_for_room(self, limit):
+        """
+        Blocks while every stream still consuming holds "limit" offers or more.
+        :return: False, if the flight has been abandoned
+        """
+        with self.condition:
+            while not self._abandoned() and all(len(stream) >= limit
+                                                for stream, _ in self.subscribers if not stream.cancelled):
+                self.condition.wait(self.poll)
+            return not self.abandoned
+
+    def close(self, failure=None):
+        """
+        End of the search: the subscribed streams are closed.
+        failure: the exception the search has failed with, if any
+        """
+        with self.condition:
+            self._abandoned()
+            self.closed = True
+            self.failure = failure
+            self.finished = time.monotonic()
+            for stream, _ in self.subscribers:
+                stream.close()
+            self.subscribers = []
+            self.condition.notify_all()
+
+
+class SearchFlights:
+    """
+    Single-flight registry of the searches: the dialogues of the same segment (the "key" of the criteria)
+    starting at about the same time join the search in flight instead of repeating it, each one receiving
+    the offers it hasn't seen. A completed search is replayed to the dialogues joining within "ttl" seconds.
+    The failed and the abandoned searches are not replayed.
+    search: (criteria, flight) -> the exception the search has failed with OR None.
+            Runs the search in the calling thread, feeding the flight.
+    key: criteria -> the key of the segment (transformer.segment)
+    """
+
+    def __init__(self, search, key, ttl=60):
+        self.search = search
+        self.key = key
+        self.ttl = ttl
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def join(self, criteria, stream, exclude=frozenset()):
+        """
+        Subscribes the stream to the search of the criteria segment, starting the search in the background
+        unless it is in flight or has been completed within "ttl" seconds.
+        exclude: the ids of the offers not to be put to the stream
+        :return: the SearchFlight
+        """
+        key = self.key(criteria)
+        with self.lock:
+            self._expire()
+            flight = self.flights.get(key)
+            if flight is not None and flight.subscribe(stream, exclude):
+                metrics.count('search.joined')
+                return flight
+            flight = SearchFlight()
+            flight.subscribe(stream, exclude)
+            self.flights[key] = flight
+        metrics.count('search.started')
+        threading.Thread(target=self._run, args=(key, criteria, flight), name='search', daemon=True).start()
+        return flight
+
+    def _run(self, key, criteria, flight):
+        failure = None
+        try:
+            failure = self.search(criteria, flight)
+        except Exception as e:
+            logger.exception('search %s failed', key)
+            failure = e
+        finally:
+            flight.close(failure)
+            if failure is not None or flight.abandoned:
+                with self.lock:
+                    if self.flights.get(key) is flight:
+                        del self.flights[key]
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [key for key, flight in self.flights.items()
+                    if flight.finished is not None and now - flight.finished > self.ttl]:
+            del self.flights[key]
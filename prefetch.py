@@ -0,0 +1,119 @@
+import logging
+import threading
+from collections import Counter
+
+from pipeline import PhotoCache
+from ratelimit import Budget, BudgetExhausted
+from transformer import form_criteria, prepare_offer, segment, to_record
+from Database import connect
+
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentPrefetcher:
+    """
+    Background worker that keeps warm pools of offers for the most popular segments (city, sex, age band),
+    so that a new user finds the offers in DB rather than waits for the search.
+    The demand is estimated from the users saved to DB: the segment of a user is the form_criteria output.
+    All the API requests are made with background priority, so they never delay the dialogues.
+    searcher: Searcher
+    validator: AccountValidator - the accounts are checked before they are added to a pool
+    segments: the number of the most popular segments to keep warm
+    pool_size: the number of offers in DB a segment is considered warm with
+    interval: seconds between the refreshes
+    budget: the maximum number of API requests per refresh (the searches and the photo crawl, the photo sets
+            taken from DB are not counted)
+    """
+
+    def __init__(self, searcher, validator, segments=20, pool_size=200, interval=3600, budget=300):
+        self.searcher = searcher
+        self.validator = validator
+        self.segments = segments
+        self.pool_size = pool_size
+        self.interval = interval
+        self.budget = budget
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name='prefetch', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('segment prefetch failed')
+            self.stopped.wait(self.interval)
+
+    def refresh(self):
+        """
+        Fills up the pools of the popular segments that run short of offers, within the API budget.
+        :return: the number of offers added
+        """
+        budget = Budget(self.budget)
+        added = 0
+        for criteria, users in self.popular_segments():
+            missing = self.pool_size - connect.count_offers(criteria)
+            if missing <= 0:
+                continue
+            found = self.warm_up(criteria, missing, budget)
+            added += found
+            logger.info('segment %s (%s users): %s offers added', segment(criteria), users, found)
+            if budget.exhausted or self.stopped.is_set():
+                break
+        logger.info('prefetch: %s offers added, %s API requests made', added, budget.spent)
+        return added
+
+    def popular_segments(self):
+        """
+        :return: [(criteria, number of users), ...] for the most popular segments, the most popular first
+        """
+        demand = Counter()
+        for city, sex, bdate, users in connect.get_segment_demand():
+            criteria = form_criteria({'city': {'id': city}, 'sex': sex, 'bdate': bdate or ''}, [])
+            if criteria:
+                demand[segment(criteria)] += users
+        return [({'city': city, 'sex': sex, 'age_from': age_from, 'age_to': age_to, 'interests': []}, users)
+                for (city, sex, age_from, age_to), users in demand.most_common(self.segments)]
+
+    def warm_up(self, criteria, missing, budget):
+        """
+        Searches for the accounts of the segment and saves the valid ones having photos to DB
+        (not linked to any user) until "missing" offers are added or the budget is spent.
+        budget: ratelimit.Budget spent by every search and photo request
+        :return: the number of offers added
+        """
+        def fetch(accounts):
+            if not budget.spend():
+                return BudgetExhausted()
+            return self.searcher.get_top_photos_batch(accounts)
+
+        photos = PhotoCache(fetch, connect.get_photo_sets)
+        added = 0
+        search = self.searcher.search_users_sharded(criteria, budget=budget)
+        try:
+            for accounts in search:
+                if isinstance(accounts, Exception):
+                    break
+                for start in range(0, len(accounts), self.searcher.batch_size):
+                    if added >= missing or self.stopped.is_set():
+                        return added
+                    batch = accounts[start:start + self.searcher.batch_size]
+                    raw_batch = photos([account['id'] for account in batch])
+                    if isinstance(raw_batch, Exception):
+                        return added
+                    offers = [offer for offer in (prepare_offer(account, raw_batch.get(account['id']))
+                                                  for account in batch) if offer]
+                    statuses = self.validator.check([offer['id'] for offer in offers])
+                    offers = [offer for offer in offers if statuses[offer['id']]]
+                    connect.add_offers(None, [to_record(offer) for offer in offers])
+                    added += len(offers)
+                if added >= missing:
+                    break
+        finally:
+            search.close()
+        return added
@@ -0,0 +1,146 @@
+import heapq
+import itertools
+import threading
+import time
+
+import metrics
+
+INTERACTIVE = 0     # requests a user is waiting for: messages, users.get
+BACKGROUND = 1      # search and photo crawling
+PRIORITIES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+WAIT_TIMERS = {priority: f'ratelimit.wait.{name}' for priority, name in PRIORITIES.items()}
+
+TOO_MANY_REQUESTS = 6   # vk.com API error code
+
+
+class RateLimited(Exception):
+    """
+    Raised when the API replies with the "too many requests per second" error to a raw request.
+    """
+    code = TOO_MANY_REQUESTS
+
+
+class BudgetExhausted(Exception):
+    """
+    Returned (or raised) in place of the response of a request the Budget doesn't allow.
+    """
+
+
+class Budget:
+    """
+    The number of API requests a job (e.g. a refresh of the prefetched segments) is allowed to make.
+    Every request of the job spends it before it is made.
+    """
+
+    def __init__(self, requests):
+        self.left = requests
+        self.spent = 0
+        self.lock = threading.Lock()
+
+    @property
+    def exhausted(self):
+        return self.left <= 0
+
+    def spend(self, requests=1):
+        """
+        :return: False, if the budget doesn't allow the requests (nothing is spent then)
+        """
+        with self.lock:
+            if self.left < requests:
+                return False
+            self.left -= requests
+            self.spent += requests
+            return True
+
+
+class Scheduler:
+    """
+    Token bucket scheduler of the API requests made with a single access token.
+    Requests wait for a token in the order of their priority (INTERACTIVE before BACKGROUND),
+    and in the order of arrival within the same priority.
+    A "too many requests" error suspends all the requests of the token for an exponentially growing pause,
+    after which the request is retried.
+    rate: the number of requests per second allowed for the token (may be fractional, when the token
+          is shared by several processes)
+    burst: the capacity of the bucket, not less than one request
+    """
+
+    def __init__(self, rate, burst=None, max_retries=5, backoff=0.5):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.condition = threading.Condition()
+        self.calls = {priority: 0 for priority in PRIORITIES}
+        self.throttled = 0
+
+    def call(self, func, *args, priority=INTERACTIVE, **kwargs):
+        """
+        Calls func(*args, **kwargs) as soon as the rate limit allows, retrying it in case
+        of a "too many requests" error.
+        :return: the func return
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, 'code', None) != TOO_MANY_REQUESTS or attempt == self.max_retries:
+                    raise
+                self.pause(self.backoff * 2 ** attempt)
+
+    def acquire(self, priority=INTERACTIVE):
+        """
+        Blocks until a token is available and all the requests of higher priority
+        (or of the same priority that have arrived earlier) have been let through.
+        """
+        with metrics.timer(WAIT_TIMERS[priority]), self.condition:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.waiting[0] != ticket:
+                    self.condition.wait()
+                elif now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    break
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.calls[priority] += 1
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        """
+        Suspends the requests of the token, e.g. after a "too many requests" error.
+        """
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.throttled += 1
+
+    def stats(self):
+        """
+        :return: {'queued': {'interactive': int, 'background': int} - the number of requests waiting,
+                  'calls': {'interactive': int, 'background': int} - the number of requests let through,
+                  'throttled': int - the number of "too many requests" errors}
+        """
+        with self.condition:
+            queued = {name: 0 for name in PRIORITIES.values()}
+            for priority, _ in self.waiting:
+                queued[PRIORITIES[priority]] += 1
+            return {'queued': queued,
+                    'calls': {PRIORITIES[priority]: calls for priority, calls in self.calls.items()},
+                    'throttled': self.throttled}
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
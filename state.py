@@ -0,0 +1,186 @@
+"""
+Dialogue state stores. A store keeps the state of every open dialogue:
+    'last_offer': the id of the current suggestion (None, if nothing has been suggested yet)
+    'processing': True, while the user's request is being processed
+    'saved_cursor': the position in the favorites list the next page of the 'saved' command starts after
+and the cursor of the offers pending to be suggested in the dialogue.
+MemoryStateStore serves a single process. SqlStateStore keeps the state in a database shared by several
+bot processes, so that the dialogues survive restarts of the processes.
+"""
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import sessionmaker
+
+from Database.migrations import upgrade_state
+from Database.models import Dialogue, OfferCursor, StateBase
+
+
+class MemoryCursor:
+    """
+    Pending offers of a dialogue kept in the memory of the process.
+    """
+
+    def __init__(self):
+        self.offers = deque()
+
+    def __len__(self):
+        return len(self.offers)
+
+    def extend(self, offers):
+        self.offers.extend(offers)
+
+    def pop(self):
+        """
+        :return: the next offer OR None, if the cursor is empty
+        """
+        return self.offers.popleft() if self.offers else None
+
+    def peek(self, number):
+        return [self.offers[position] for position in range(min(number, len(self.offers)))]
+
+    def clear(self):
+        self.offers.clear()
+
+
+class MemoryStateStore:
+    """
+    Dialogue state kept in the memory of the process. Thread-safe.
+    timeout: seconds of inactivity after which a dialogue is considered closed
+    """
+    fields = {'last_offer': None, 'processing': False, 'saved_cursor': None}
+
+    def __init__(self, timeout=600):
+        self.timeout = timeout
+        self.dialogues = {}
+        self.cursors = {}
+        self.lock = threading.Lock()
+
+    def open(self, user_id):
+        """
+        Opens up a dialogue, unless it is open already. Either way the dialogue is prolonged.
+        :return: True, if the dialogue has been opened anew
+        """
+        now = time.monotonic()
+        with self.lock:
+            dialogue = self.dialogues.get(user_id)
+            if dialogue and dialogue['updated'] > now - self.timeout:
+                dialogue['updated'] = now
+                return False
+            self.dialogues[user_id] = {**self.fields, 'updated': now}
+            self.cursors[user_id] = MemoryCursor()
+            return True
+
+    def close(self, user_id):
+        with self.lock:
+            self.dialogues.pop(user_id, None)
+            self.cursors.pop(user_id, None)
+
+    def get(self, user_id, field):
+        with self.lock:
+            return self.dialogues.get(user_id, self.fields).get(field)
+
+    def set(self, user_id, field, value):
+        with self.lock:
+            if user_id in self.dialogues:
+                self.dialogues[user_id][field] = value
+
+    def cursor(self, user_id):
+        with self.lock:
+            return self.cursors.setdefault(user_id, MemoryCursor())
+
+
+class SqlCursor:
+    """
+    Pending offers of a dialogue kept in the "offer_cursor" table.
+    Offers are taken with "SELECT ... FOR UPDATE SKIP LOCKED", so each of them is taken by one process only.
+    """
+
+    def __init__(self, session_maker, user_id):
+        self.Session = session_maker
+        self.user_id = user_id
+
+    def __len__(self):
+        with self.Session() as session:
+            return session.query(OfferCursor).filter(OfferCursor.user_id == self.user_id).count()
+
+    def extend(self, offers):
+        rows = [OfferCursor(user_id=self.user_id, offer={**offer, 'bdate': str(offer.get('bdate'))})
+                for offer in offers]
+        if rows:
+            with self.Session.begin() as session:
+                session.add_all(rows)
+
+    def pop(self):
+        with self.Session.begin() as session:
+            row = session.query(OfferCursor). \
+                filter(OfferCursor.user_id == self.user_id). \
+                order_by(OfferCursor.offer_cursor_id). \
+                with_for_update(skip_locked=True). \
+                first()
+            if row is None:
+                return None
+            session.delete(row)
+            return row.offer
+
+    def peek(self, number):
+        with self.Session() as session:
+            return [row[0] for row in session.query(OfferCursor.offer).
+                    filter(OfferCursor.user_id == self.user_id).
+                    order_by(OfferCursor.offer_cursor_id).
+                    limit(number).all()]
+
+    def clear(self):
+        with self.Session.begin() as session:
+            session.query(OfferCursor).filter(OfferCursor.user_id == self.user_id).delete()
+
+
+class SqlStateStore:
+    """
+    Dialogue state kept in the "dialogue" and "offer_cursor" tables of a database
+    (the application database or any other one SQLAlchemy supports, e.g. SQLite).
+    The tables are created if missing and upgraded in place otherwise (see Database.migrations.upgrade_state).
+    engine: SQLAlchemy engine
+    timeout: seconds of inactivity after which a dialogue is considered closed
+    """
+    fields = MemoryStateStore.fields
+
+    def __init__(self, engine, timeout=600):
+        StateBase.metadata.create_all(engine, checkfirst=True)
+        upgrade_state(engine)
+        self.Session = sessionmaker(bind=engine)
+        self.timeout = timeout
+
+    def open(self, user_id):
+        """
+        Opens up a dialogue, unless it is open already. Either way the dialogue is prolonged.
+        :return: True, if the dialogue has been opened anew
+        """
+        now = datetime.utcnow()
+        with self.Session.begin() as session:
+            dialogue = session.get(Dialogue, user_id, with_for_update=True)
+            if dialogue and dialogue.updated_at > now - timedelta(seconds=self.timeout):
+                dialogue.updated_at = now
+                return False
+            session.merge(Dialogue(user_id=user_id, updated_at=now, **self.fields))
+            session.query(OfferCursor).filter(OfferCursor.user_id == user_id).delete()
+            return True
+
+    def close(self, user_id):
+        with self.Session.begin() as session:
+            session.query(Dialogue).filter(Dialogue.user_id == user_id).delete()
+            session.query(OfferCursor).filter(OfferCursor.user_id == user_id).delete()
+
+    def get(self, user_id, field):
+        with self.Session() as session:
+            dialogue = session.get(Dialogue, user_id)
+            return getattr(dialogue, field) if dialogue else self.fields[field]
+
+    def set(self, user_id, field, value):
+        with self.Session.begin() as session:
+            session.query(Dialogue).filter(Dialogue.user_id == user_id).update({field: value})
+
+    def cursor(self, user_id):
+        return SqlCursor(self.Session, user_id)
@@ -0,0 +1,160 @@
+import json
+import os
+import re
+import threading
+import unittest
+from datetime import date
+
+import vk_api
+
+from bot import Searcher
+from ratelimit import Budget, Scheduler
+
+
+SCRIPTS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vk_scripts', '')
+
+
+class Api:
+    """
+    vk_api stand-in answering the execute requests with reply(code).
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.scripts = []
+
+    def execute(self, code):
+        self.scripts.append(code)
+        return self.reply(code)
+
+
+class CannedSearcher(Searcher):
+    """
+    Searcher over canned execute responses, no token or network involved.
+    """
+    scripts_path = SCRIPTS_PATH
+
+    def __init__(self, reply):
+        self.scheduler = Scheduler(rate=1000)
+        self.vk = Api(reply)
+
+
+def api_error(code=10):
+    return vk_api.exceptions.ApiError(None, 'execute', {}, {}, {'error_code': code, 'error_msg': 'Internal error'})
+
+
+class TopPhotosTest(unittest.TestCase):
+
+    def test_most_liked_photos_come_first(self):
+        searcher = CannedSearcher(lambda code: [
+            {'id': 1, 'count': 5, 'ids': [11, 12, 13, 14, 15], 'likes': [3, 50, 0, 7, 50]},
+            {'id': 2, 'count': 1, 'ids': [21], 'likes': [4]}])
+        self.assertEqual(searcher.get_top_photos_batch([1, 2]),
+                         {1: ['photo1_12', 'photo1_15', 'photo1_14'], 2: ['photo2_21']})
+
+    def test_top_is_configurable(self):
+        searcher = CannedSearcher(lambda code: [{'id': 1, 'count': 3, 'ids': [11, 12, 13], 'likes': [1, 2, 3]}])
+        self.assertEqual(searcher.get_top_photos_batch([1], top=1), {1: ['photo1_13']})
+
+    def test_accounts_without_photos(self):
+        searcher = CannedSearcher(lambda code: [{'id': 1, 'count': 0, 'ids': [], 'likes': []},
+                                                {'id': 2, 'error': 1}])
+        self.assertEqual(searcher.get_top_photos_batch([1, 2, 3]), {1: [], 2: None, 3: None})
+
+    def test_failed_request(self):
+        def reply(code):
+            raise api_error()
+
+        searcher = CannedSearcher(reply)
+        self.assertIsInstance(searcher.get_top_photos_batch([1]), vk_api.exceptions.ApiError)
+
+    def test_script_parameters(self):
+        searcher = CannedSearcher(lambda code: [])
+        searcher.get_top_photos_batch([1, 2])
+        script = searcher.vk.scripts[0]
+        self.assertIn('var accounts = [1, 2];', script)
+        self.assertIn(f'count: {searcher.photos_scanned}', script)
+        self.assertNotIn('<ids>', script)
+        self.assertNotIn('<count>', script)
+
+
+
+CRITERIA = {'city': 1, 'sex': 1, 'age_from': 30, 'age_to': 32, 'interests': []}
+YEARS = list(range(date.today().year - 33, date.today().year - 29))
+CROWDED = YEARS[1]      # the year slice hitting the limit of 1000 accounts
+SHARED = 42             # the account found by every slice
+
+
+class Search:
+    """
+    users.search stand-in: the slice of the CROWDED year holds 1000 accounts of 1500, its month slices hold
+    the accounts of the year slice along with new ones. The other slices hold two accounts.
+    """
+
+    def __init__(self):
+        self.slices = []
+        self.lock = threading.Lock()
+
+    def __call__(self, code):
+        slices = json.loads(re.search(r'var slices = (.*);', code).group(1))
+        with self.lock:
+            self.slices.extend(slices)
+        return [self.search(element) for element in slices]
+
+    @staticmethod
+    def search(element):
+        year, month = element['birth_year'], element.get('birth_month')
+        if year == CROWDED and month is None:
+            ids, count = range(1000), 1500
+        elif year == CROWDED:
+            ids = [month * 100 + number for number in range(50)]
+            count = len(ids)
+        else:
+            ids, count = [year * 10, year * 10 + 1], 2
+        return {'slice': element, 'count': count,
+                'items': [{'id': account_id} for account_id in [SHARED, *ids]]}
+
+
+class ShardedSearchTest(unittest.TestCase):
+
+    def test_crowded_year_is_split_into_months(self):
+        search = Search()
+        searcher = CannedSearcher(search)
+        found = [account['id'] for accounts in searcher.search_users_sharded(CRITERIA) for account in accounts]
+        self.assertCountEqual(search.slices, [{'birth_year': year} for year in YEARS] +
+                              [{'birth_year': CROWDED, 'birth_month': month} for month in range(1, 13)])
+        self.assertEqual(len(found), len(set(found)))
+        months = {month * 100 + number for month in range(1, 13) for number in range(50)}
+        self.assertEqual(set(found), {SHARED} | set(range(1000)) | months |
+                         {year * 10 + number for year in YEARS if year != CROWDED for number in (0, 1)})
+
+    def test_slices_are_packed_into_execute_requests(self):
+        searcher = CannedSearcher(Search())
+        list(searcher.search_users_sharded(CRITERIA))
+        self.assertEqual(len(searcher.vk.scripts), (len(YEARS) + 12) // searcher.slices_per_call)
+
+    def test_budget_stops_the_search(self):
+        searcher = CannedSearcher(Search())
+        budget = Budget(1)
+        found = list(searcher.search_users_sharded(CRITERIA, budget=budget))
+        self.assertEqual(len(searcher.vk.scripts), 1)
+        self.assertEqual(len(found), 1)
+        self.assertTrue(budget.exhausted)
+
+    def test_failed_request_is_yielded(self):
+        search = Search()
+
+        def reply(code):
+            if str(CROWDED) in re.search(r'var slices = (.*);', code).group(1):
+                raise api_error()
+            return search(code)
+
+        searcher = CannedSearcher(reply)
+        found = list(searcher.search_users_sharded(CRITERIA))
+        errors = [element for element in found if isinstance(element, Exception)]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(searcher.vk.scripts), len(YEARS) // searcher.slices_per_call)
+
+
+if __name__ == '__main__':
+    unittest.main()
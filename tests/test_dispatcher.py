@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from dispatcher import Dispatcher
+
+
+def serve(dispatcher, done, timeout=5):
+    """
+    Runs the dispatcher until done() returns True or "timeout" seconds pass.
+    """
+    async def run():
+        reader = asyncio.ensure_future(dispatcher._read())
+        finish = time.monotonic() + timeout
+        while not done() and time.monotonic() < finish:
+            await asyncio.sleep(0.01)
+        reader.cancel()
+        dispatcher.executor.shutdown(wait=True)
+    asyncio.run(run())
+
+
+class Poll:
+    """
+    Long poll returning the batches given, then nothing.
+    """
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def __call__(self):
+        if self.batches:
+            return self.batches.pop(0)
+        time.sleep(0.01)
+        return []
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def test_events_of_a_sender_are_handled_in_order(self):
+        events = [(sender, str(number)) for number in range(20) for sender in range(5)]
+        handled = []
+        lock = threading.Lock()
+
+        def handler(event):
+            time.sleep(0.001 * (event[0] % 3))
+            with lock:
+                handled.append(event)
+
+        dispatcher = Dispatcher(Poll([events[:40], events[40:]]), handler, max_workers=4)
+        serve(dispatcher, lambda: len(handled) == len(events))
+        self.assertCountEqual(handled, events)
+        for sender in range(5):
+            self.assertEqual([text for sender_id, text in handled if sender_id == sender],
+                             [str(number) for number in range(20)])
+
+    def test_events_of_a_sender_are_not_handled_concurrently(self):
+        active = {}
+        overlaps = []
+        handled = []
+        lock = threading.Lock()
+
+        def handler(event):
+            with lock:
+                if active.get(event[0]):
+                    overlaps.append(event)
+                active[event[0]] = True
+            time.sleep(0.005)
+            with lock:
+                active[event[0]] = False
+                handled.append(event)
+
+        events = [(number % 2, str(number)) for number in range(10)]
+        dispatcher = Dispatcher(Poll([events]), handler, max_workers=4)
+        serve(dispatcher, lambda: len(handled) == len(events))
+        self.assertEqual(len(handled), 10)
+        self.assertEqual(overlaps, [])
+
+    def test_different_senders_are_handled_concurrently(self):
+        started = threading.Barrier(3, timeout=2)
+        handled = []
+
+        def handler(event):
+            started.wait()
+            handled.append(event)
+
+        events = [(sender, 'hi') for sender in range(3)]
+        dispatcher = Dispatcher(Poll([events]), handler, max_workers=3)
+        serve(dispatcher, lambda: len(handled) == len(events))
+        self.assertFalse(started.broken)
+        self.assertEqual(len(handled), 3)
+
+    def test_failed_handler_does_not_stop_the_sender(self):
+        handled = []
+
+        def handler(event):
+            if event[1] == 'fail':
+                raise ValueError(event)
+            handled.append(event)
+
+        events = [(1, 'first'), (1, 'fail'), (1, 'last')]
+        dispatcher = Dispatcher(Poll([events]), handler, max_workers=2)
+        with self.assertLogs('dispatcher', 'ERROR'):
+            serve(dispatcher, lambda: len(handled) == 2 and not dispatcher.queues)
+        self.assertEqual(handled, [(1, 'first'), (1, 'last')])
+        self.assertEqual(dispatcher.queues, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import json
+import time
+import unittest
+import urllib.request
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        metrics.enable()
+        self.addCleanup(self.disable)
+
+    @staticmethod
+    def disable():
+        metrics.enabled = False
+        metrics.reset()
+        metrics._gauges.clear()
+
+    def test_timed(self):
+        @metrics.timed('stage')
+        def stage(value):
+            time.sleep(0.01)
+            return value
+
+        self.assertEqual(stage(1), 1)
+        stage(2)
+        timer = metrics.snapshot()['timers']['stage']
+        self.assertEqual(timer['count'], 2)
+        self.assertGreaterEqual(timer['max'], 0.01)
+        self.assertGreaterEqual(timer['total'], 0.02)
+        self.assertLessEqual(timer['p50'], timer['p99'])
+
+    def test_timed_records_failed_calls(self):
+        @metrics.timed('stage')
+        def stage():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            stage()
+        self.assertEqual(metrics.snapshot()['timers']['stage']['count'], 1)
+
+    def test_timer(self):
+        with metrics.timer('block'):
+            pass
+        self.assertEqual(metrics.snapshot()['timers']['block']['count'], 1)
+
+    def test_count(self):
+        metrics.count('suggestions')
+        metrics.count('suggestions', 2)
+        self.assertEqual(metrics.snapshot()['counters'], {'suggestions': 3})
+
+    def test_funnel(self):
+        metrics.funnel_start(1)
+        metrics.funnel_start(1)     # a later message of the same dialogue
+        metrics.funnel_start(2)
+        metrics.funnel_done(1)
+        metrics.funnel_done(1)      # a later suggestion of the same dialogue
+        self.assertEqual(metrics.snapshot()['timers']['funnel.first_suggestion']['count'], 1)
+        self.assertEqual(list(metrics._funnels), [2])
+
+    def test_cancelled_funnel_is_forgotten(self):
+        metrics.funnel_start(1)
+        metrics.funnel_cancel(1)
+        metrics.funnel_done(1)
+        self.assertEqual(metrics._funnels, {})
+        self.assertNotIn('funnel.first_suggestion', metrics.snapshot()['timers'])
+
+    def test_funnels_are_bounded(self):
+        for user_id in range(metrics.MAX_FUNNELS + 10):
+            metrics.funnel_start(user_id)
+        self.assertEqual(len(metrics._funnels), metrics.MAX_FUNNELS)
+        self.assertNotIn(0, metrics._funnels)
+        self.assertIn(metrics.MAX_FUNNELS + 9, metrics._funnels)
+
+    def test_disabled_metrics_are_not_collected(self):
+        metrics.enabled = False
+
+        @metrics.timed('stage')
+        def stage():
+            return 1
+
+        self.assertEqual(stage(), 1)
+        with metrics.timer('block'):
+            pass
+        metrics.count('suggestions')
+        metrics.funnel_start(1)
+        metrics.funnel_done(1)
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot['timers'], snapshot['counters']), ({}, {}))
+        self.assertEqual(metrics._funnels, {})
+
+    def test_gauges(self):
+        metrics.register_gauge('queue', lambda: {'queued': 3})
+        metrics.register_gauge('broken', lambda: 1 / 0)
+        gauges = metrics.snapshot()['gauges']
+        self.assertEqual(gauges['queue'], {'queued': 3})
+        self.assertIn('ZeroDivisionError', gauges['broken'])
+
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        self.assertEqual(metrics.percentile(ordered, 0.5), 50)
+        self.assertEqual(metrics.percentile(ordered, 0.99), 99)
+        self.assertEqual(metrics.percentile([7], 0.95), 7)
+
+    def test_endpoint(self):
+        metrics.count('suggestions')
+        server = metrics.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/', timeout=5) as response:
+            self.assertEqual(response.headers['Content-Type'], 'application/json; charset=utf-8')
+            body = json.loads(response.read())
+        self.assertEqual(body['counters'], {'suggestions': 1})
+        self.assertEqual(set(body), {'pid', 'timers', 'counters', 'gauges'})
+
+
+if __name__ == '__main__':
+    unittest.main()
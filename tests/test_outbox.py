@@ -0,0 +1,129 @@
+import threading
+import time
+import unittest
+
+import requests
+
+from outbox import Outbox, is_transient
+from ratelimit import RateLimited
+
+
+class Recipient:
+    """
+    messages.send stand-in: records the calls and fails the ones planned to fail.
+    failures: {message: [exception, ...]} - the exceptions raised by the successive attempts to send the message
+    """
+
+    def __init__(self, failures=None, delay=0):
+        self.failures = failures or {}
+        self.delay = delay
+        self.calls = []
+        self.delivered = []
+        self.lock = threading.Lock()
+
+    def __call__(self, **params):
+        time.sleep(self.delay)
+        with self.lock:
+            self.calls.append(params)
+            planned = self.failures.get(params['message'])
+            if planned:
+                raise planned.pop(0)
+            self.delivered.append(params)
+
+
+def settle(outbox, timeout=5):
+    """
+    Waits until every queued message is sent or dropped.
+    """
+    finish = time.monotonic() + timeout
+    while outbox.stats()['queued'] and time.monotonic() < finish:
+        time.sleep(0.005)
+    return outbox.stats()
+
+
+class IsTransientTest(unittest.TestCase):
+
+    def test_transient_errors(self):
+        self.assertTrue(is_transient(RateLimited()))
+        self.assertTrue(is_transient(requests.ConnectionError()))
+
+    def test_permanent_errors(self):
+        error = Exception()
+        error.code = 901    # can't send messages to the user without permission
+        self.assertFalse(is_transient(error))
+        self.assertFalse(is_transient(ValueError()))
+
+
+class OutboxTest(unittest.TestCase):
+
+    def test_messages_are_sent_with_the_recipient(self):
+        recipient = Recipient()
+        outbox = Outbox(recipient, workers=2)
+        outbox.put(1, message='hello', keyboard='{}')
+        self.assertEqual(settle(outbox), {'queued': 0, 'sent': 1, 'retried': 0, 'dropped': 0})
+        params = recipient.delivered[0]
+        self.assertEqual((params['user_id'], params['message'], params['keyboard']), (1, 'hello', '{}'))
+        self.assertIn('random_id', params)
+
+    def test_messages_to_a_recipient_keep_their_order(self):
+        recipient = Recipient(delay=0.001)
+        outbox = Outbox(recipient, workers=4)
+        for number in range(20):
+            for user_id in (1, 2, 3):
+                outbox.put(user_id, message=f'{user_id} {number}')
+        self.assertEqual(settle(outbox)['sent'], 60)
+        for user_id in (1, 2, 3):
+            self.assertEqual([params['message'] for params in recipient.delivered if params['user_id'] == user_id],
+                             [f'{user_id} {number}' for number in range(20)])
+
+    def test_transient_error_is_retried(self):
+        recipient = Recipient({'hello': [RateLimited(), requests.ConnectionError()]})
+        outbox = Outbox(recipient, workers=1, backoff=0.01)
+        outbox.put(1, message='hello')
+        self.assertEqual(settle(outbox), {'queued': 0, 'sent': 1, 'retried': 2, 'dropped': 0})
+        self.assertEqual(len(recipient.calls), 3)
+
+    def test_retry_keeps_the_random_id(self):
+        recipient = Recipient({'hello': [RateLimited()]})
+        outbox = Outbox(recipient, workers=1, backoff=0.01)
+        outbox.put(1, message='hello')
+        outbox.put(1, message='bye')
+        settle(outbox)
+        first, retry, other = recipient.calls
+        self.assertEqual(first['random_id'], retry['random_id'])
+        self.assertNotEqual(first['random_id'], other['random_id'])
+
+    def test_retry_holds_back_the_next_messages_of_the_recipient(self):
+        recipient = Recipient({'first': [RateLimited()]})
+        outbox = Outbox(recipient, workers=2, backoff=0.05)
+        outbox.put(1, message='first')
+        outbox.put(1, message='second')
+        outbox.put(2, message='other')
+        settle(outbox)
+        messages = [params['message'] for params in recipient.delivered]
+        self.assertLess(messages.index('first'), messages.index('second'))
+        self.assertLess(messages.index('other'), messages.index('first'))
+
+    def test_retries_are_limited(self):
+        recipient = Recipient({'hello': [RateLimited() for _ in range(5)]})
+        outbox = Outbox(recipient, workers=1, max_retries=2, backoff=0.01)
+        outbox.put(1, message='hello')
+        outbox.put(1, message='bye')
+        with self.assertLogs('outbox', 'WARNING'):
+            stats = settle(outbox)
+        self.assertEqual(stats, {'queued': 0, 'sent': 1, 'retried': 2, 'dropped': 1})
+        self.assertEqual([params['message'] for params in recipient.calls], ['hello'] * 3 + ['bye'])
+
+    def test_permanent_error_drops_the_message(self):
+        recipient = Recipient({'hello': [ValueError()]})
+        outbox = Outbox(recipient, workers=1, backoff=0.01)
+        outbox.put(1, message='hello')
+        outbox.put(1, message='bye')
+        with self.assertLogs('outbox', 'WARNING'):
+            stats = settle(outbox)
+        self.assertEqual(stats, {'queued': 0, 'sent': 1, 'retried': 0, 'dropped': 1})
+        self.assertEqual([params['message'] for params in recipient.delivered], ['bye'])
+
+
+if __name__ == '__main__':
+    unittest.main()
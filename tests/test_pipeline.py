@@ -0,0 +1,391 @@
+import threading
+import time
+import unittest
+
+from pipeline import CrawlPipeline, OfferStream, SearchFlight, SearchFlights
+
+
+def offers(*ids):
+    return [{'id': offer_id} for offer_id in ids]
+
+
+def accounts(*ids):
+    return [{'id': account_id} for account_id in ids]
+
+
+def fetch(account_ids):
+    """
+    Photo fetch answering the later batches first.
+    """
+    time.sleep(0.01 * (5 - min(account_ids) % 5))
+    return {account_id: [f'photo{account_id}'] for account_id in account_ids}
+
+
+def prepare(account, photos):
+    return {'id': account['id'], 'photos': photos} if photos else None
+
+
+def later(func, *args, delay=0.05):
+    """
+    Calls func(*args) in a background thread after "delay" seconds.
+    """
+    thread = threading.Timer(delay, func, args)
+    thread.start()
+    return thread
+
+
+class OfferStreamTest(unittest.TestCase):
+
+    def test_get_returns_the_offers_in_order(self):
+        stream = OfferStream(offers(1, 2))
+        stream.extend(offers(3))
+        self.assertEqual([stream.get(timeout=0)['id'] for _ in range(3)], [1, 2, 3])
+        self.assertEqual(len(stream), 0)
+
+    def test_get_waits_for_an_offer(self):
+        stream = OfferStream()
+        later(stream.put, {'id': 1})
+        self.assertEqual(stream.get(timeout=2), {'id': 1})
+
+    def test_get_times_out(self):
+        stream = OfferStream()
+        started = time.monotonic()
+        self.assertIsNone(stream.get(timeout=0.05))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_get_returns_the_rest_after_close(self):
+        stream = OfferStream(offers(1))
+        stream.close()
+        self.assertEqual(stream.get(), {'id': 1})
+        self.assertIsNone(stream.get())
+
+    def test_close_wakes_up_the_consumer(self):
+        stream = OfferStream()
+        later(stream.close)
+        self.assertIsNone(stream.get(timeout=2))
+        self.assertFalse(stream.cancelled)
+
+    def test_cancel_wakes_up_the_consumer(self):
+        stream = OfferStream()
+        later(stream.cancel)
+        self.assertIsNone(stream.get(timeout=2))
+        self.assertTrue(stream.cancelled)
+        self.assertTrue(stream.closed)
+
+    def test_wait_for_room_returns_at_once_below_the_limit(self):
+        stream = OfferStream(offers(1))
+        self.assertTrue(stream.wait_for_room(2))
+
+    def test_wait_for_room_waits_for_the_consumer(self):
+        stream = OfferStream(offers(1, 2))
+        later(stream.get)
+        started = time.monotonic()
+        self.assertTrue(stream.wait_for_room(2))
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+        self.assertEqual(len(stream), 1)
+
+    def test_cancel_wakes_up_the_producer(self):
+        stream = OfferStream(offers(1, 2))
+        later(stream.cancel)
+        self.assertFalse(stream.wait_for_room(2))
+
+    def test_wait_ready_returns_at_the_threshold(self):
+        stream = OfferStream(offers(1))
+        later(stream.extend, offers(2, 3))
+        self.assertEqual(stream.wait_ready(3, deadline=2), 3)
+
+    def test_wait_ready_returns_at_the_deadline(self):
+        stream = OfferStream(offers(1))
+        self.assertEqual(stream.wait_ready(3, deadline=0.05), 1)
+
+    def test_wait_ready_returns_on_close(self):
+        stream = OfferStream(offers(1))
+        later(stream.close)
+        started = time.monotonic()
+        self.assertEqual(stream.wait_ready(3, deadline=2), 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_peek_leaves_the_stream_intact(self):
+        stream = OfferStream(offers(1, 2, 3))
+        self.assertEqual(stream.peek(2), offers(1, 2))
+        self.assertEqual(stream.peek(5), offers(1, 2, 3))
+        self.assertEqual(len(stream), 3)
+
+
+class CrawlPipelineTest(unittest.TestCase):
+
+    def crawl(self, fetch=fetch, save=None, stream=None, **kwargs):
+        self.saved = []
+        self.stream = OfferStream() if stream is None else stream
+        return CrawlPipeline(fetch, prepare, save or self.saved.extend, self.stream, **kwargs)
+
+    def test_offers_are_put_in_the_order_submitted(self):
+        crawl = self.crawl(batch_size=2, fetchers=3)
+        self.assertTrue(crawl.submit(accounts(*range(10))))
+        self.assertEqual(crawl.close(), 10)
+        self.assertEqual([offer['id'] for offer in self.stream.peek(10)], list(range(10)))
+        self.assertEqual(self.saved, self.stream.peek(10))
+
+    def test_accounts_without_photos_are_skipped(self):
+        crawl = self.crawl(fetch=lambda ids: {account_id: [] if account_id % 2 else ['photo'] for account_id in ids})
+        crawl.submit(accounts(*range(6)))
+        self.assertEqual(crawl.close(), 3)
+        self.assertEqual([offer['id'] for offer in self.stream.peek(6)], [0, 2, 4])
+
+    def test_fetch_failure_cancels_the_crawl(self):
+        failure = RuntimeError('limits exhausted')
+
+        def failing(account_ids):
+            if 4 in account_ids:
+                return failure
+            return fetch(account_ids)
+
+        crawl = self.crawl(fetch=failing, batch_size=2, fetchers=1, max_pending=1)
+        crawl.submit(accounts(*range(4)))
+        self.assertFalse(crawl.submit(accounts(*range(4, 20))))
+        self.assertEqual(crawl.close(), 4)
+        self.assertIs(crawl.failure, failure)
+        self.assertTrue(crawl.cancelled)
+
+    def test_fetch_exception_cancels_the_crawl(self):
+        def failing(account_ids):
+            raise ConnectionError()
+
+        crawl = self.crawl(fetch=failing)
+        crawl.submit(accounts(1))
+        self.assertEqual(crawl.close(), 0)
+        self.assertIsInstance(crawl.failure, ConnectionError)
+
+    def test_save_failure_cancels_the_crawl(self):
+        def failing(offers):
+            raise RuntimeError('DB is down')
+
+        crawl = self.crawl(save=failing, batch_size=2, fetchers=1, max_pending=1)
+        with self.assertLogs('pipeline', 'ERROR'):
+            finished = threading.Thread(target=lambda: crawl.submit(accounts(*range(20))))
+            finished.start()
+            finished.join(timeout=5)
+            self.assertFalse(finished.is_alive())
+            self.assertEqual(crawl.close(), 0)
+        self.assertIsInstance(crawl.failure, RuntimeError)
+        self.assertEqual(len(self.stream), 0)
+
+    def test_cancelled_stream_stops_the_crawl(self):
+        stream = OfferStream()
+        crawl = self.crawl(stream=stream, batch_size=2, max_buffered=4)
+        later(stream.cancel)
+        self.assertFalse(crawl.submit(accounts(*range(20))))
+        crawl.close()
+        self.assertLessEqual(len(self.saved), 6)
+
+    def test_submit_waits_for_the_consumer(self):
+        crawl = self.crawl(batch_size=2, max_pending=1, max_buffered=4)
+        self.addCleanup(self.stream.cancel)
+        submitted = threading.Thread(target=crawl.submit, args=(accounts(*range(10)),), daemon=True)
+        submitted.start()
+        submitted.join(timeout=0.5)
+        self.assertTrue(submitted.is_alive())
+        self.assertGreaterEqual(len(self.stream), 4)
+        self.assertLess(len(self.stream), 10)
+        taken = []
+        while submitted.is_alive():
+            offer = self.stream.get(timeout=0.1)
+            if offer:
+                taken.append(offer['id'])
+        self.assertEqual(crawl.close(), 10)
+        taken.extend(offer['id'] for offer in self.stream.peek(10))
+        self.assertEqual(taken, list(range(10)))
+
+
+class SearchFlightTest(unittest.TestCase):
+
+    def test_offers_are_put_to_every_subscriber(self):
+        flight = SearchFlight()
+        first, second = OfferStream(), OfferStream()
+        flight.subscribe(first)
+        flight.subscribe(second, exclude={2})
+        flight.extend(offers(1, 2, 3))
+        self.assertEqual(first.peek(5), offers(1, 2, 3))
+        self.assertEqual(second.peek(5), offers(1, 3))
+
+    def test_late_subscriber_gets_the_offers_found_so_far(self):
+        flight = SearchFlight()
+        flight.subscribe(OfferStream())
+        flight.extend(offers(1, 2))
+        late = OfferStream()
+        self.assertTrue(flight.subscribe(late, exclude={1}))
+        flight.extend(offers(3))
+        self.assertEqual(late.peek(5), offers(2, 3))
+
+    def test_close_closes_the_streams(self):
+        flight = SearchFlight()
+        stream = OfferStream()
+        flight.subscribe(stream)
+        flight.close()
+        self.assertTrue(stream.closed)
+        self.assertIsNotNone(flight.finished)
+
+    def test_subscriber_of_a_closed_flight_gets_a_replay(self):
+        flight = SearchFlight()
+        flight.subscribe(OfferStream())
+        flight.extend(offers(1, 2))
+        flight.close()
+        replay = OfferStream()
+        self.assertTrue(flight.subscribe(replay))
+        self.assertEqual(replay.peek(5), offers(1, 2))
+        self.assertTrue(replay.closed)
+
+    def test_flight_is_abandoned_when_every_stream_is_cancelled(self):
+        flight = SearchFlight()
+        first, second = OfferStream(), OfferStream()
+        flight.subscribe(first)
+        flight.subscribe(second)
+        first.cancel()
+        self.assertFalse(flight.cancelled)
+        second.cancel()
+        self.assertTrue(flight.cancelled)
+        self.assertFalse(flight.subscribe(OfferStream()))
+        flight.close()
+        self.assertTrue(flight.abandoned)
+
+    def test_cancelled_stream_gets_no_offers(self):
+        flight = SearchFlight()
+        cancelled, stream = OfferStream(), OfferStream()
+        flight.subscribe(cancelled)
+        flight.subscribe(stream)
+        cancelled.cancel()
+        flight.extend(offers(1))
+        self.assertEqual(len(cancelled), 0)
+        self.assertEqual(len(stream), 1)
+
+    def test_wait_for_room_waits_for_the_slowest_consumer_to_catch_up(self):
+        flight = SearchFlight()
+        flight.poll = 0.01
+        first, second = OfferStream(), OfferStream()
+        flight.subscribe(first)
+        flight.subscribe(second)
+        flight.extend(offers(1, 2))
+        later(first.get)
+        started = time.monotonic()
+        self.assertTrue(flight.wait_for_room(2))
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+    def test_wait_for_room_returns_when_abandoned(self):
+        flight = SearchFlight()
+        flight.poll = 0.01
+        stream = OfferStream()
+        flight.subscribe(stream)
+        flight.extend(offers(1, 2))
+        later(stream.cancel)
+        self.assertFalse(flight.wait_for_room(2))
+
+    def test_wait_found(self):
+        flight = SearchFlight()
+        later(flight.mark_found)
+        self.assertTrue(flight.wait_found())
+        empty = SearchFlight()
+        later(empty.close)
+        self.assertFalse(empty.wait_found())
+
+
+class Search:
+    """
+    Search feeding the flight with the offers given, once released.
+    """
+
+    def __init__(self, found=offers(1, 2, 3), failure=None):
+        self.found = found
+        self.failure = failure
+        self.released = threading.Event()
+        self.calls = 0
+
+    def __call__(self, criteria, flight):
+        self.calls += 1
+        self.released.wait(5)
+        if flight.cancelled:
+            return None
+        flight.extend(self.found)
+        return self.failure
+
+
+def segment(criteria):
+    return criteria['segment']
+
+
+class SearchFlightsTest(unittest.TestCase):
+
+    def finish(self, search, flight):
+        search.released.set()
+        finish = time.monotonic() + 5
+        while flight.finished is None and time.monotonic() < finish:
+            time.sleep(0.005)
+
+    def test_dialogues_of_a_segment_join_the_search_in_flight(self):
+        search = Search()
+        flights = SearchFlights(search, segment)
+        first, second, other = OfferStream(), OfferStream(), OfferStream()
+        flight = flights.join({'segment': 'a', 'user': 1}, first)
+        self.assertIs(flights.join({'segment': 'a', 'user': 2}, second, exclude={2}), flight)
+        self.assertIsNot(flights.join({'segment': 'b'}, other), flight)
+        self.finish(search, flight)
+        self.assertEqual(search.calls, 2)
+        self.assertEqual(first.peek(5), offers(1, 2, 3))
+        self.assertEqual(second.peek(5), offers(1, 3))
+        self.assertTrue(first.closed and second.closed)
+
+    def test_completed_search_is_replayed(self):
+        search = Search()
+        flights = SearchFlights(search, segment)
+        flight = flights.join({'segment': 'a'}, OfferStream())
+        self.finish(search, flight)
+        replay = OfferStream()
+        self.assertIs(flights.join({'segment': 'a'}, replay, exclude={1}), flight)
+        self.assertEqual(search.calls, 1)
+        self.assertEqual(replay.peek(5), offers(2, 3))
+        self.assertTrue(replay.closed)
+
+    def test_completed_search_expires(self):
+        search = Search()
+        flights = SearchFlights(search, segment, ttl=0.05)
+        flight = flights.join({'segment': 'a'}, OfferStream())
+        self.finish(search, flight)
+        time.sleep(0.06)
+        self.assertIsNot(flights.join({'segment': 'a'}, OfferStream()), flight)
+        self.assertEqual(search.calls, 2)
+
+    def test_failed_search_is_not_replayed(self):
+        search = Search(failure=RuntimeError('limits exhausted'))
+        flights = SearchFlights(search, segment)
+        flight = flights.join({'segment': 'a'}, OfferStream())
+        self.finish(search, flight)
+        self.assertIs(flight.failure, search.failure)
+        self.assertIsNot(flights.join({'segment': 'a'}, OfferStream()), flight)
+
+    def test_search_exception_closes_the_flight(self):
+        def failing(criteria, flight):
+            raise RuntimeError('search failed')
+
+        flights = SearchFlights(failing, segment)
+        stream = OfferStream()
+        with self.assertLogs('pipeline', 'ERROR'):
+            flight = flights.join({'segment': 'a'}, stream)
+            self.assertIsNone(stream.get(timeout=2))
+        self.assertIsInstance(flight.failure, RuntimeError)
+
+    def test_abandoned_search_is_not_joined(self):
+        search = Search()
+        flights = SearchFlights(search, segment)
+        stream = OfferStream()
+        flight = flights.join({'segment': 'a'}, stream)
+        stream.cancel()
+        joined = OfferStream()
+        self.assertIsNot(flights.join({'segment': 'a'}, joined), flight)
+        self.finish(search, flight)
+        self.assertTrue(flight.abandoned)
+        self.assertEqual(len(stream), 0)
+        self.assertEqual(joined.wait_ready(3, deadline=2), 3)
+        self.assertEqual(joined.peek(5), offers(1, 2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import threading
+import time
+import unittest
+
+from ratelimit import BACKGROUND, INTERACTIVE, RateLimited, Scheduler
+
+
+class Flaky:
+    """
+    API call failing with the "too many requests" error "failures" times before it succeeds.
+    """
+
+    def __init__(self, failures, error=RateLimited):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error()
+        return value
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_call_returns_the_result(self):
+        scheduler = Scheduler(rate=100)
+        self.assertEqual(scheduler.call(lambda a, b=0: a + b, 1, b=2), 3)
+        self.assertEqual(scheduler.stats()['calls'], {'interactive': 1, 'background': 0})
+
+    def test_too_many_requests_is_retried(self):
+        scheduler = Scheduler(rate=100, backoff=0.01)
+        func = Flaky(2)
+        self.assertEqual(scheduler.call(func, 'ok'), 'ok')
+        self.assertEqual(func.calls, 3)
+        self.assertEqual(scheduler.stats()['throttled'], 2)
+
+    def test_retries_are_limited(self):
+        scheduler = Scheduler(rate=100, max_retries=2, backoff=0.01)
+        func = Flaky(5)
+        with self.assertRaises(RateLimited):
+            scheduler.call(func, 'ok')
+        self.assertEqual(func.calls, 3)
+
+    def test_other_errors_are_not_retried(self):
+        scheduler = Scheduler(rate=100)
+        func = Flaky(1, error=ValueError)
+        with self.assertRaises(ValueError):
+            scheduler.call(func, 'ok')
+        self.assertEqual(func.calls, 1)
+        self.assertEqual(scheduler.stats()['throttled'], 0)
+
+    def test_pause_delays_the_next_request(self):
+        scheduler = Scheduler(rate=100)
+        scheduler.pause(0.1)
+        started = time.monotonic()
+        scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_rate_is_respected(self):
+        scheduler = Scheduler(rate=20, burst=1)
+        started = time.monotonic()
+        for _ in range(5):
+            scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 4 / 20 - 0.01)
+
+    def test_fractional_rate(self):
+        scheduler = Scheduler(rate=0.5)
+        self.assertEqual(scheduler.capacity, 1)
+        scheduler.acquire()
+        started = time.monotonic()
+        scheduler.tokens = 0.95
+        scheduler.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_interactive_requests_go_first(self):
+        scheduler = Scheduler(rate=100)
+        scheduler.pause(0.2)
+        order = []
+        lock = threading.Lock()
+
+        def request(priority, name):
+            scheduler.acquire(priority)
+            with lock:
+                order.append(name)
+
+        requests = [(BACKGROUND, 'background 0'), (BACKGROUND, 'background 1'), (INTERACTIVE, 'interactive')]
+        threads = []
+        for priority, name in requests:
+            threads.append(threading.Thread(target=request, args=(priority, name)))
+            threads[-1].start()
+            while sum(scheduler.stats()['queued'].values()) < len(threads):
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertEqual(order, ['interactive', 'background 0', 'background 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+
+import sqlalchemy as sq
+
+from state import MemoryStateStore, SqlStateStore
+
+
+def offers(*ids):
+    return [{'id': offer_id, 'first_name': 'Name', 'bdate': '1.1.1990'} for offer_id in ids]
+
+
+class StateStoreTests:
+    """
+    The behaviour shared by the state stores, run against every backend.
+    """
+
+    def store(self, timeout=600):
+        raise NotImplementedError
+
+    def test_open_starts_a_dialogue_once(self):
+        store = self.store()
+        self.assertTrue(store.open(1))
+        self.assertFalse(store.open(1))
+        self.assertTrue(store.open(2))
+
+    def test_new_dialogue_has_the_defaults(self):
+        store = self.store()
+        store.open(1)
+        self.assertIsNone(store.get(1, 'last_offer'))
+        self.assertFalse(store.get(1, 'processing'))
+        self.assertIsNone(store.get(1, 'saved_cursor'))
+
+    def test_set_and_get(self):
+        store = self.store()
+        store.open(1)
+        store.open(2)
+        store.set(1, 'last_offer', 10)
+        store.set(1, 'processing', True)
+        store.set(1, 'saved_cursor', 5)
+        self.assertEqual((store.get(1, 'last_offer'), store.get(1, 'processing'), store.get(1, 'saved_cursor')),
+                         (10, True, 5))
+        self.assertIsNone(store.get(2, 'last_offer'))
+
+    def test_closed_dialogue_is_forgotten(self):
+        store = self.store()
+        store.open(1)
+        store.set(1, 'last_offer', 10)
+        store.cursor(1).extend(offers(1))
+        store.close(1)
+        self.assertIsNone(store.get(1, 'last_offer'))
+        self.assertEqual(len(store.cursor(1)), 0)
+        self.assertTrue(store.open(1))
+
+    def test_set_of_a_missing_dialogue_is_ignored(self):
+        store = self.store()
+        store.set(1, 'last_offer', 10)
+        self.assertIsNone(store.get(1, 'last_offer'))
+
+    def test_expired_dialogue_is_opened_anew(self):
+        store = self.store(timeout=0)
+        store.open(1)
+        store.set(1, 'last_offer', 10)
+        store.cursor(1).extend(offers(1))
+        self.assertTrue(store.open(1))
+        self.assertIsNone(store.get(1, 'last_offer'))
+        self.assertEqual(len(store.cursor(1)), 0)
+
+    def test_cursor(self):
+        store = self.store()
+        store.open(1)
+        store.open(2)
+        cursor = store.cursor(1)
+        cursor.extend(offers(1, 2, 3))
+        store.cursor(2).extend(offers(4))
+        self.assertEqual(len(store.cursor(1)), 3)
+        self.assertEqual([offer['id'] for offer in cursor.peek(2)], [1, 2])
+        self.assertEqual(cursor.pop(), offers(1)[0])
+        self.assertEqual([offer['id'] for offer in store.cursor(1).peek(5)], [2, 3])
+        cursor.clear()
+        self.assertIsNone(cursor.pop())
+        self.assertEqual(len(store.cursor(2)), 1)
+
+
+class MemoryStateStoreTest(StateStoreTests, unittest.TestCase):
+
+    def store(self, timeout=600):
+        return MemoryStateStore(timeout=timeout)
+
+
+class SqlStateStoreTest(StateStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.engine = sq.create_engine(f"sqlite:///{os.path.join(directory.name, 'state.db')}")
+        self.addCleanup(self.engine.dispose)
+
+    def store(self, timeout=600):
+        return SqlStateStore(self.engine, timeout=timeout)
+
+    def test_state_is_shared_by_the_stores(self):
+        first, second = self.store(), self.store()
+        self.assertTrue(first.open(1))
+        self.assertFalse(second.open(1))
+        first.set(1, 'last_offer', 10)
+        first.cursor(1).extend(offers(1, 2))
+        self.assertEqual(second.get(1, 'last_offer'), 10)
+        self.assertEqual(second.cursor(1).pop()['id'], 1)
+        self.assertEqual(first.cursor(1).pop()['id'], 2)
+
+    def test_existing_tables_are_upgraded(self):
+        with self.engine.begin() as connection:
+            connection.execute(sq.text('CREATE TABLE dialogue (user_id INTEGER PRIMARY KEY, last_offer INTEGER, '
+                                       'processing BOOLEAN NOT NULL, updated_at DATETIME NOT NULL)'))
+            connection.execute(sq.text("INSERT INTO dialogue VALUES (1, 10, 0, '2100-01-01 00:00:00')"))
+        store = self.store()
+        self.assertFalse(store.open(1))
+        self.assertEqual(store.get(1, 'last_offer'), 10)
+        self.assertIsNone(store.get(1, 'saved_cursor'))
+        store.set(1, 'saved_cursor', 5)
+        self.assertEqual(store.get(1, 'saved_cursor'), 5)
+        self.store()
+        with self.engine.connect() as connection:
+            versions = connection.execute(sq.text('SELECT version FROM state_schema_version')).scalars().all()
+        self.assertEqual(versions, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
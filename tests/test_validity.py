@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+
+from validity import AccountValidator
+
+
+class Api:
+    """
+    Bot.get_users_status stand-in: the accounts from "deactivated" are inactive, the rest are active.
+    """
+
+    def __init__(self, deactivated=()):
+        self.deactivated = set(deactivated)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def __call__(self, accounts):
+        with self.lock:
+            self.requests.append(list(accounts))
+        return {account: account not in self.deactivated for account in accounts}
+
+
+class AccountValidatorTest(unittest.TestCase):
+
+    def validator(self, deactivated=(), **kwargs):
+        self.api = Api(deactivated)
+        self.purged = []
+        return AccountValidator(self.api, self.purged.extend, **kwargs)
+
+    def test_accounts_are_checked_in_bulk(self):
+        validator = self.validator(deactivated={2})
+        self.assertEqual(validator.check([1, 2, 3]), {1: True, 2: False, 3: True})
+        self.assertEqual(self.api.requests, [[1, 2, 3]])
+
+    def test_inactive_accounts_are_purged(self):
+        validator = self.validator(deactivated={2, 3})
+        validator.check([1, 2, 3])
+        self.assertEqual(self.purged, [2, 3])
+
+    def test_cached_status_is_not_requested_again(self):
+        validator = self.validator(deactivated={2})
+        validator.check([1, 2])
+        self.assertEqual(validator.check([1, 2, 3]), {1: True, 2: False, 3: True})
+        self.assertFalse(validator.is_active(2))
+        self.assertEqual(self.api.requests, [[1, 2], [3]])
+        self.assertEqual(self.purged, [2])
+
+    def test_status_expires(self):
+        validator = self.validator(ttl=0.05)
+        validator.check([1])
+        time.sleep(0.06)
+        validator.check([1])
+        self.assertEqual(self.api.requests, [[1], [1]])
+        self.assertEqual(list(validator.cache), [1])
+
+    def test_cache_is_bounded(self):
+        validator = self.validator(max_entries=3)
+        validator.check([1, 2])
+        validator.check([3, 4])
+        self.assertEqual(list(validator.cache), [2, 3, 4])
+        validator.check([2])
+        validator.check([1])
+        self.assertEqual(list(validator.cache), [3, 4, 1])
+        self.assertEqual(self.api.requests, [[1, 2], [3, 4], [1]])
+
+    def test_unknown_status_is_considered_active(self):
+        validator = AccountValidator(lambda accounts: {}, self.fail)
+        self.assertTrue(validator.is_active(1))
+
+    def test_prefetch_caches_the_status(self):
+        validator = self.validator(deactivated={2})
+        validator.prefetch([1, 2])
+        finish = time.monotonic() + 5
+        while (validator.in_progress or len(validator.cache) < 2) and time.monotonic() < finish:
+            time.sleep(0.005)
+        self.assertEqual(validator.check([1, 2]), {1: True, 2: False})
+        self.assertEqual(self.api.requests, [[1, 2]])
+        self.assertEqual(self.purged, [2])
+
+    def test_prefetch_skips_the_cached_accounts(self):
+        validator = self.validator()
+        validator.check([1])
+        validator.prefetch([1])
+        self.assertEqual(validator.in_progress, set())
+        self.assertEqual(self.api.requests, [[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
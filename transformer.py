@@ -1,14 +1,51 @@
 import pymorphy2
 import string
+import threading
 from datetime import datetime
+from functools import lru_cache
 
+import metrics
 
-morph = pymorphy2.MorphAnalyzer()
 
+STOP_LIST = ('ходить', 'смотреть', 'играть', 'делать', 'заниматься', 'слушать')
+WORD_CACHE_SIZE = 100000
+PHOTOS_PER_OFFER = 3
 
-def form_criteria(user):
+_morph = None
+_morph_lock = threading.Lock()
+
+
+def get_morph():
+    """
+    :return: the morphological analyzer. Loading its dictionaries takes seconds and a lot of memory,
+    so it is loaded on the first demand rather than on import (see warm_up).
+    """
+    global _morph
+    if _morph is None:
+        with _morph_lock:
+            if _morph is None:
+                _morph = pymorphy2.MorphAnalyzer()
+    return _morph
+
+
+def warm_up(background=True):
+    """
+    Loads the morphological analyzer ahead of the first message.
+    background: True - in a background thread, so that the bot starts listening at once
+                False - right away, e.g. before forking the worker processes, which then share
+                        the dictionaries with the parent instead of loading their own copies
+    """
+    if background:
+        threading.Thread(target=get_morph, name='morph-warm-up', daemon=True).start()
+    else:
+        get_morph()
+
+
+def form_criteria(user, interest_tokens=None):
     """
     The function forms search criteria based on the user's details.
+    If the user's "interest_tokens" (the output of sort_interests) are provided, they are used as they are,
+    otherwise the user's interests are analysed.
     user: {'id': int,
            'bdate': str,
             city': {'id': int, 'title': str},
@@ -48,62 +85,112 @@ def form_criteria(user):
         criteria['age_from'] = min_age
         criteria['age_to'] = 99
 
-    if user.get('interests'):
+    if interest_tokens is not None:
+        criteria['interests'] = list(interest_tokens)
+    elif user.get('interests'):
         criteria['interests'] = sort_interests(user['interests'])
     else:
         criteria['interests'] = []
     return criteria
 
 
-def sort_interests(raw):
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+@metrics.timed('morph.parse')
+def analyse_word(word):
     """
-    Linguistic analysis function that picks out nouns and verbs in
-    infinitive form and sorts them in lexicographic order, to allow comparison of the interests fields.
+    Morphological analysis of a single word. The results are kept in a bounded LRU cache,
+    since parsing is the most CPU-consuming operation of the application.
+    :return: the normal form of the word, if it is a noun or an infinitive (which is not in the stop list)
+         OR: None
+    """
+    parsed = get_morph().parse(word)
+    if not parsed:
+        return None
+    tag = parsed[0].tag
+    if 'NOUN' in tag or 'INFN' in tag and word not in STOP_LIST:
+        return parsed[0].normal_form
+    return None
 
 
+def prepare_offer(account, photos):
+    """
+    Forms an offer from an account found by the users.search and the account's photos.
+    account: {'id': int,
+              'bdate': str,
+              'city': {'id': int, 'title': str},
+              'interests': str,
+              'sex': int,
+              'first_name': str,
+              'last_name': str}
+    photos: ['photo<owner_id>_<photo_id>', ...] - the attachment identifiers of the account's most liked photos,
+            the most liked first (Searcher.get_top_photos_batch output)
+    :return: offer: {'id': int,
+                     'first_name': str,
+                     'last_name': str,
+                     'sex': int,
+                     'bdate': datetime.date,
+                     'city': {'id': int, 'title': str},
+                     'interests': str,
+                     'interest_tokens': [str, ...],
+                     'photos': [str, ...]} - PHOTOS_PER_OFFER most liked photos
+         OR: None, if the account has less than PHOTOS_PER_OFFER photos or lacks the birthdate, city or sex
+    """
+    if not photos or len(photos) < PHOTOS_PER_OFFER:
+        return None
+    photos = list(photos[:PHOTOS_PER_OFFER])
+
+    if not all([account.get('bdate'), account.get('city'), account.get('sex')]):
+        return None
+    try:
+        bdate = datetime.strptime(account['bdate'], '%d.%m.%Y').date()
+    except ValueError:
+        return None
+
+    interests = account.get('interests', '')
+    return {'id': account['id'],
+            'first_name': f"{account['first_name']}",
+            'last_name': f"{account['last_name']}",
+            'sex': account['sex'],
+            'bdate': bdate,
+            'city': account['city'],
+            'interests': interests,
+            'interest_tokens': sort_interests(interests),
+            'photos': photos}
+
+
+def to_record(offer):
+    """
+    Reforms an offer (the output of prepare_offer) to the input of connect.add_offers.
+    """
+    return {'offer_id': offer['id'],
+            'first_name': offer['first_name'],
+            'last_name': offer['last_name'],
+            'sex': offer['sex'],
+            'bdate': offer['bdate'],
+            'city': offer['city']['id'],
+            'interest': offer['interests'],
+            'interest_tokens': offer['interest_tokens'],
+            'photos': offer['photos']}
+
+
+def segment(criteria):
+    """
+    :return: the key of the criteria segment: (city, sex, age_from, age_to)
+    """
+    return criteria['city'], criteria['sex'], criteria['age_from'], criteria['age_to']
+
+
+@metrics.timed('morph.sort_interests')
+def sort_interests(raw):
+    """
+    Linguistic analysis function that picks out nouns and verbs in
+    infinitive form, brings them to normal form and sorts them in lexicographic order,
+    to allow comparison of the interests fields.
+    The output is stored in the DB along with the interests ("interest_tokens"),
+    so that the interests are not analysed again when matching.
     """
-    stop_list = ['ходить', 'смотреть', 'играть', 'делать', 'заниматься', 'слушать']
     stripper = str.maketrans({char: '' for char in string.punctuation})
     interests = [interest.translate(stripper).lower() for interest in raw.split()
                  if len(interest) >= 4]
-    interests = filter(lambda word: morph.parse(word) and 'NOUN' in morph.parse(word)[0].tag
-                                    or 'INFN' in morph.parse(word)[0].tag and word not in stop_list,
-                       interests)
-    return sorted(interests)
-
-
-def filter_by_interests(criteria, candidates):
-    """
-    Takes the search criteria and the list of accounts, finds the accounts with matching interests,
-    sorts them by the number of matching words and puts these accounts in the head of the list.
-    criteria: {'city': int,
-               'sex': int,
-               'age_to': int,
-               'age_from': int,
-               'interests': [str, ...]}
-    candidates:  [{'id': int,
-                   'bdate': str,
-                   'city': {'id': int, 'title': str},
-                   'interests': str,
-                   'sex': int,
-                   'first_name': str,
-                   'last_name': str}, ...]
-    :return: "candidates" reordered
-    """
-    perfect_matches = {}
-    for candidate in candidates:
-        if candidate.get('interests'):
-            counter = 0
-            for target in criteria['interests']:
-                for interest in sort_interests(candidate['interests']):
-                    if target == interest:
-                        counter += 1
-            if counter > 0:
-                perfect_matches[counter] = candidate
-
-    for candidate in perfect_matches.values():
-        if candidate in candidates:
-            candidates.remove(candidate)
-
-    return [perfect_matches[count] for count in sorted(perfect_matches.keys(), reverse=True)] + \
-           [candidate for candidate in candidates if candidate not in perfect_matches.values()]
+    interests = [analyse_word(word) for word in interests]
+    return sorted(word for word in interests if word)
@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class AccountValidator:
+    """
+    Validity service that checks the accounts in bulk and keeps their status in a TTL cache.
+    fetch_status: a callable taking a list of ids and returning {id: True if active, False otherwise}
+                  (Bot.get_users_status)
+    purge: a callable removing the deactivated accounts from DB in bulk (connect.remove_offers)
+    ttl: number of seconds the status of an account is considered up to date
+    max_entries: the maximum number of accounts cached, the ones cached the longest ago are dropped first
+    """
+
+    def __init__(self, fetch_status, purge, ttl=3600, max_entries=100000):
+        self.fetch_status = fetch_status
+        self.purge = purge
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache = OrderedDict()     # account: (active, expires), the ones expiring first come first
+        self.in_progress = set()
+        self.lock = threading.Lock()
+
+    def check(self, accounts):
+        """
+        Checks the accounts validity. Only the accounts missing in the cache (or outdated)
+        are requested from the API, all of them within a single bulk request.
+        The deactivated accounts are removed from DB with a single bulk delete.
+        :return: {account_id: True, if the account is active
+                              False, if it has been deactivated}
+                 The accounts the status of which could not be received are considered active.
+        """
+        now = time.monotonic()
+        result = {}
+        missing = []
+        with self.lock:
+            for account in accounts:
+                cached = self.cache.get(account)
+                if cached and cached[1] > now:
+                    result[account] = cached[0]
+                else:
+                    missing.append(account)
+
+        if missing:
+            fetched = self.fetch_status(missing)
+            self._store(fetched)
+            deactivated = [account for account, active in fetched.items() if not active]
+            if deactivated:
+                self.purge(deactivated)
+            result.update({account: fetched.get(account, True) for account in missing})
+        return result
+
+    def is_active(self, account):
+        return self.check([account])[account]
+
+    def prefetch(self, accounts):
+        """
+        Checks the accounts in a background thread, so that their status is already cached
+        by the time they are suggested. The accounts that are cached or being checked are skipped.
+        """
+        now = time.monotonic()
+        with self.lock:
+            accounts = [account for account in accounts
+                        if account not in self.in_progress
+                        and not (account in self.cache and self.cache[account][1] > now)]
+            self.in_progress.update(accounts)
+        if not accounts:
+            return
+
+        def prefetch():
+            try:
+                self.check(accounts)
+            finally:
+                with self.lock:
+                    self.in_progress.difference_update(accounts)
+
+        threading.Thread(target=prefetch, daemon=True).start()
+
+    def _store(self, statuses):
+        """
+        Caches the statuses and drops the outdated entries, as well as the oldest ones beyond "max_entries".
+        All the entries live for the same ttl, so the order of the cache is the order of their expiry.
+        """
+        now = time.monotonic()
+        expires = now + self.ttl
+        with self.lock:
+            for account, active in statuses.items():
+                self.cache[account] = (active, expires)
+                self.cache.move_to_end(account)
+            while self.cache and (len(self.cache) > self.max_entries or next(iter(self.cache.values()))[1] <= now):
+                self.cache.popitem(last=False)
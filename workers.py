@@ -0,0 +1,204 @@
+import gc
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import queue
+import threading
+import time
+from collections import deque
+
+import metrics
+from dispatcher import Dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedDispatcher:
+    """
+    Runs a single long poll reader in the current process and N worker processes handling the events.
+    Every event is routed to a worker by its sender_id, so the events of the same sender are always handled
+    by the same worker, in the order they have been received. Each worker runs a Dispatcher, that is
+    the events of different senders are handled concurrently within a worker as well.
+    Every event is kept in the current process until the worker acknowledges it has been handled.
+    A worker that has died (crashed, got killed) is restarted by the supervisor, and the events it hasn't
+    acknowledged (the ones waiting in its queue and the ones it was handling) are replayed to it in order,
+    ahead of the new events of the worker. An event handled right before the worker died may thus be handled twice.
+    The workers are forked from the main thread, so they inherit everything set up in the current process
+    before run() is called. The objects existing by then are frozen (excluded from garbage collection), so that
+    the collections in the workers don't touch them and the memory pages stay shared copy-on-write with the parent.
+    The threads of the current process are not inherited, so the background jobs are better started with "on_start",
+    once the workers have been forked.
+    poll: a blocking callable returning a list of events - (sender_id, text) tuples
+    handler: a blocking callable that processes a single event
+    processes: the number of worker processes
+    initializer: a callable run in every worker process before it starts handling the events,
+                 receives the number of the worker
+    max_workers: the number of events handled at the same time in every worker process
+    max_pending: the number of events waiting in the queue of a worker, upon reaching which
+                 the reader stops polling until the worker catches up
+    on_start: a callable run in the current process once the workers have been started
+    """
+    check_interval = 1  # seconds between the checks of the workers
+    retry_interval = 0.01   # seconds between the attempts to put an event to a full queue
+
+    def __init__(self, poll, handler, processes, initializer=None, max_workers=16, max_pending=1000, on_start=None):
+        self.poll = poll
+        self.handler = handler
+        self.processes = processes
+        self.initializer = initializer
+        self.on_start = on_start
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.context = multiprocessing.get_context('fork')
+        self.queues = [self.context.Queue(max_pending) for _ in range(processes)]
+        self.workers = [None] * processes
+        self.acks = [None] * processes              # the receiving ends of the acknowledgement pipes
+        self.unacked = [{} for _ in range(processes)]   # number: event, the events not acknowledged by the worker
+        self.backlogs = [deque() for _ in range(processes)]     # the events to be replayed to the restarted worker
+        self.numbers = itertools.count()
+        self.lock = threading.Lock()
+
+    def run(self):
+        """
+        Starts the worker processes and the long poll reader, then supervises the workers
+        in the current (main) thread. Blocks forever.
+        """
+        gc.freeze()
+        for number in range(self.processes):
+            self._start(number)
+        if self.on_start:
+            self.on_start()
+        threading.Thread(target=self.read, name='long-poll', daemon=True).start()
+        self.supervise()
+
+    def read(self):
+        """
+        Keeps reading the long poll and routing the events.
+        """
+        while True:
+            try:
+                events = self.poll()
+            except Exception:
+                logger.exception('long poll request failed')
+                time.sleep(1)
+                continue
+            for event in events:
+                self.route(event)
+
+    def route(self, event):
+        """
+        Puts the event to the queue of the sender's worker. Blocks while the queue is full
+        or the events replayed to the worker are waiting to be put.
+        """
+        worker = event[0] % self.processes
+        number = next(self.numbers)
+        while True:
+            with self.lock:
+                if self._replay(worker):
+                    try:
+                        self.queues[worker].put_nowait((*event, number))
+                        self.unacked[worker][number] = event
+                        return
+                    except queue.Full:
+                        pass
+            time.sleep(self.retry_interval)
+
+    def supervise(self):
+        """
+        Collects the acknowledgements of the workers and restarts the workers that have exited.
+        """
+        while True:
+            workers = {acks: worker for worker, acks in enumerate(self.acks)}
+            for acks in multiprocessing.connection.wait(list(workers), timeout=self.check_interval):
+                self._acknowledge(workers[acks])
+            with self.lock:
+                for number in range(self.processes):
+                    self._replay(number)
+            for number, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    logger.error('worker %s exited with code %s, restarting', number, worker.exitcode)
+                    self._restart(number)
+
+    def _acknowledge(self, worker):
+        """
+        Forgets the events the worker has acknowledged.
+        """
+        acks = self.acks[worker]
+        try:
+            while acks.poll():
+                number = acks.recv()
+                with self.lock:
+                    self.unacked[worker].pop(number, None)
+        except (EOFError, OSError):
+            pass    # the worker has died, the pipe is replaced on restart
+
+    def _start(self, number):
+        acks, worker_acks = self.context.Pipe(duplex=False)
+        worker = self.context.Process(target=self._work, args=(number, self.queues[number], worker_acks),
+                                      name=f'worker-{number}', daemon=True)
+        worker.start()
+        worker_acks.close()
+        self.workers[number] = worker
+        self.acks[number] = acks
+
+    def _restart(self, number):
+        """
+        The queue of a dead worker is abandoned as it is, since the worker could have died holding its lock.
+        The events the worker hasn't acknowledged are put to the backlog of the worker, which is replayed
+        to a new queue before any new event is routed to the worker, so the order of events is kept.
+        """
+        self.workers[number].join()
+        self._acknowledge(number)
+        self.acks[number].close()
+        with self.lock:
+            stale_queue = self.queues[number]
+            self.queues[number] = self.context.Queue(self.max_pending)
+            self._start(number)
+            replayed = [(*event, event_number) for event_number, event in sorted(self.unacked[number].items())]
+            self.backlogs[number] = deque(replayed)
+            self._replay(number)
+        stale_queue.cancel_join_thread()
+        stale_queue.close()
+        if replayed:
+            logger.warning('%s events replayed to worker %s', len(replayed), number)
+            metrics.count('workers.replayed', len(replayed))
+
+    def _replay(self, worker):
+        """
+        Puts the backlog of the worker to its queue, as much as the queue takes. Never blocks.
+        Called under the lock.
+        :return: True, if the backlog is empty
+        """
+        backlog = self.backlogs[worker]
+        while backlog:
+            try:
+                self.queues[worker].put_nowait(backlog[0])
+            except queue.Full:
+                return False
+            backlog.popleft()
+        return True
+
+    def _work(self, number, worker_queue, acks):
+        if self.initializer:
+            self.initializer(number)
+        lock = threading.Lock()
+
+        def handle(item):
+            try:
+                self.handler(item[:2])
+            finally:
+                with lock:
+                    acks.send(item[2])
+
+        def poll():
+            events = [worker_queue.get()]
+            while len(events) < self.max_workers:
+                try:
+                    events.append(worker_queue.get_nowait())
+                except queue.Empty:
+                    break
+            return events
+
+        Dispatcher(poll, handle, max_workers=self.max_workers, max_pending=self.max_pending).run()